@@ -0,0 +1,203 @@
+"""
+测试协作式取消
+"""
+
+import asyncio
+import os
+import signal
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from viby.utils.cancel import CancellationToken, cancel_on_interrupt
+from viby.utils.stream import StreamBuffer
+
+
+def test_token_runs_callbacks_once():
+    """测试取消时回调只执行一次，已移除的回调不执行"""
+    token = CancellationToken()
+    calls = []
+    token.add_callback(lambda: calls.append("a"))
+    remove = token.add_callback(lambda: calls.append("b"))
+    remove()
+
+    token.cancel()
+    token.cancel()
+
+    assert token.cancelled
+    assert calls == ["a"]
+
+    # 已取消时注册的回调立即执行
+    token.add_callback(lambda: calls.append("c"))
+    assert calls == ["a", "c"]
+
+
+def test_token_ignores_failing_callback():
+    """测试回调出错不影响其他回调"""
+    token = CancellationToken()
+    calls = []
+
+    def _fail():
+        raise RuntimeError("boom")
+
+    with patch("viby.utils.cancel.logger"):
+        token.add_callback(_fail)
+        token.add_callback(lambda: calls.append("ok"))
+        token.cancel()
+
+    assert calls == ["ok"]
+
+
+def test_token_wakes_stream_buffer():
+    """测试取消令牌立即唤醒等待中的读取端，而不是等到下一次轮询"""
+    token = CancellationToken()
+    buffer = StreamBuffer(cancel_event=token)
+    threading.Timer(0.05, token.cancel).start()
+
+    start = time.monotonic()
+    assert list(buffer.frames(interval=5)) == []
+    assert time.monotonic() - start < 1
+
+
+def test_call_llm_closes_stream_on_cancel():
+    """测试取消时立即关闭模型响应流"""
+    from viby.llm.models import ModelManager
+
+    closed = threading.Event()
+
+    class _BlockingStream:
+        def __iter__(self):
+            # 模拟阻塞在网络读取上，直到连接被关闭
+            closed.wait(5)
+            raise ConnectionError("stream closed")
+
+        def close(self):
+            closed.set()
+
+    client = MagicMock()
+    client.chat.completions.create.return_value = _BlockingStream()
+
+    with (
+        patch("viby.llm.models.SessionManager"),
+        patch("viby.llm.models.CompactionManager"),
+    ):
+        manager = ModelManager()
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+
+    start = time.monotonic()
+    with patch.object(manager, "_create_api_client", return_value=client):
+        chunks = list(
+            manager._call_llm([], {"model": "m", "base_url": "http://x"}, token)
+        )
+
+    assert chunks == []
+    assert closed.is_set()
+    assert time.monotonic() - start < 1
+    client.close.assert_called_once()
+
+
+def test_mcp_call_cancels_coroutine():
+    """测试取消 MCP 调用时同时取消事件循环中的协程"""
+    from viby.mcp.client import _run_coroutine_in_persistent_loop
+
+    cancelled = threading.Event()
+
+    async def _slow():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    token = CancellationToken()
+    threading.Timer(0.05, token.cancel).start()
+
+    start = time.monotonic()
+    try:
+        _run_coroutine_in_persistent_loop(_slow(), token)
+    except Exception as e:
+        error = e
+    else:
+        error = None
+
+    assert error is not None
+    assert cancelled.wait(1)
+    assert time.monotonic() - start < 1
+
+
+def test_interrupt_cancels_token():
+    """测试代码块内的 Ctrl+C 取消令牌，退出后恢复原来的信号处理函数"""
+    previous = signal.getsignal(signal.SIGINT)
+    with cancel_on_interrupt() as token:
+        os.kill(os.getpid(), signal.SIGINT)
+        assert token.wait(1)
+    assert signal.getsignal(signal.SIGINT) is previous
+
+
+def test_interrupt_cancels_slow_mcp_tool_call():
+    """测试执行 MCP 工具时按下 Ctrl+C 取消正在进行的调用"""
+    from viby.llm.nodes.execute_tool_node import ExecuteToolNode
+
+    started = threading.Event()
+    cancelled = threading.Event()
+
+    class _SlowClient:
+        async def call_tool(self, server_name, tool_name, arguments):
+            started.set()
+            try:
+                await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    async def _get_client():
+        return _SlowClient()
+
+    tool_info = {
+        "tool_name": "slow_tool",
+        "parameters": {},
+        "selected_server": "slow_server",
+    }
+    with (
+        patch("viby.mcp.client._get_or_create_global_mcp_client_async", _get_client),
+        patch.object(ExecuteToolNode, "_print_tool_call_info"),
+    ):
+        # 工具调用开始后再模拟按下 Ctrl+C
+        threading.Thread(
+            target=lambda: started.wait(5) and os.kill(os.getpid(), signal.SIGINT)
+        ).start()
+        start = time.monotonic()
+        result = ExecuteToolNode().exec(tool_info)
+
+    assert result["cancelled"] is True
+    assert cancelled.wait(1)
+    assert time.monotonic() - start < 2
+
+
+def test_execute_tool_node_passes_live_token():
+    """测试执行 MCP 工具时传入未取消的令牌，Ctrl+C 取消令牌而不抛出 KeyboardInterrupt"""
+    from viby.llm.nodes.execute_tool_node import ExecuteToolNode
+
+    tokens = []
+
+    def _call_tool(tool_name, server_name, arguments, cancel_token=None):
+        tokens.append(cancel_token)
+        assert cancel_token is not None and not cancel_token.is_set()
+        os.kill(os.getpid(), signal.SIGINT)
+        assert cancel_token.wait(1)
+        return {"cancelled": True}
+
+    tool_info = {
+        "tool_name": "slow_tool",
+        "parameters": {},
+        "selected_server": "slow_server",
+    }
+    with (
+        patch("viby.llm.nodes.execute_tool_node.call_tool", _call_tool),
+        patch.object(ExecuteToolNode, "_print_tool_call_info"),
+    ):
+        result = ExecuteToolNode().exec(tool_info)
+
+    assert result == {"cancelled": True}
+    assert tokens[0].is_set()
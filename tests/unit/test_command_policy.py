@@ -0,0 +1,158 @@
+"""
+测试yolo模式的命令策略引擎
+"""
+
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from viby.config.app_config import ShellConfig
+from viby.tools import command_policy
+from viby.tools.command_policy import CommandPolicy, benchmark, split_units
+
+
+@pytest.fixture(autouse=True)
+def mock_logger():
+    """模拟日志记录器，避免其他测试残留的日志处理器影响"""
+    with patch("viby.tools.command_policy.logger") as logger:
+        yield logger
+
+
+def test_split_units_pipelines_and_chains():
+    """测试按管道、命令链和子shell拆分"""
+    assert split_units("ls | grep x && (cd src; make) || echo 'a; b'") == [
+        "ls",
+        "grep x",
+        "cd src",
+        "make",
+        "echo 'a; b'",
+    ]
+
+
+def test_split_units_compound_commands():
+    """测试复合命令的保留字被跳过，其后的命令单独成为单元"""
+    assert split_units("for f in *.log; do gzip $f; done") == [
+        "f in '*.log'",
+        "gzip '$f'",
+    ]
+    assert split_units("if test -f x; then make; else echo no; fi") == [
+        "test -f x",
+        "make",
+        "echo no",
+    ]
+
+
+def test_split_units_redirects_and_wrappers():
+    """测试重定向单独成为单元，包装命令和环境变量赋值被去掉"""
+    assert split_units("FOO=1 nohup make 2>/dev/null") == ["> /dev/null", "make 2"]
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "ls && rm -rf build",
+        "cat file | xargs rm",
+        "echo ok; sudo reboot",
+        'echo "$(rm -rf ~)"',
+        "echo `shred secret`",
+        "bash -c 'rm -rf /'",
+        "(cd /tmp && rm x)",
+        "echo a#b; rm -rf /",
+        "echo data > /dev/sda",
+        "cat x >> /etc/hosts",
+        "/bin/rm file",
+        "find . -name '*.tmp' -delete",
+        ":(){ :|:& };:",
+        "echo 'unclosed",
+        "for f in *; do rm $f; done",
+        "if true; then rm -rf x; fi",
+        "if false; then :; elif true; then :; else sudo reboot; fi",
+        "while true; do dd if=/dev/zero of=x; done",
+        "until false; do shred x; done",
+        "case $x in a) rm -rf /;; esac",
+        "select f in a b; do rm $f; done",
+        "function clean { rm -rf build; }; clean",
+        "if ! rm x; then :; fi",
+        "find . | xargs -I {} rm {}",
+        "find . | xargs -i rm {}",
+        "find . | xargs -n 1 -P 4 shred",
+        "find . | xargs --max-procs=4 rm",
+        "timeout -s KILL 5 rm -rf x",
+        "timeout --signal KILL -k 1 5 rm -rf x",
+        "env -u HOME rm -rf x",
+        "env -C /tmp -- rm -rf x",
+        "env -S 'rm -rf x'",
+        "env --split-string='sudo reboot'",
+        "stdbuf -o L rm x",
+        "stdbuf -i 0 -e L dd if=/dev/zero of=x",
+        "nice -n 5 rm -rf x",
+        "ionice -c 3 -n 7 rm -rf x",
+    ],
+)
+def test_unsafe_commands(command):
+    """测试隐藏在管道、命令链和子shell中的危险命令"""
+    assert CommandPolicy().is_unsafe(command) is True
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        "git add . && git commit -m 'rm -rf /'",
+        "echo '$(rm -rf /)'",
+        "ls 2>/dev/null | wc -l",
+        "chmod +x perm.sh",
+        "terraform plan",
+        "find . -name '*.py' | xargs -I {} wc -l {}",
+        "timeout -s KILL 5 make test",
+    ],
+)
+def test_safe_commands(command):
+    """测试不会误判安全命令"""
+    assert CommandPolicy().is_unsafe(command) is False
+
+
+def test_user_rules_priority():
+    """测试用户拒绝规则优先于允许规则，允许规则优先于内置规则"""
+    policy = CommandPolicy(
+        allow_rules=(r"^rm\s+-rf\s+build$", r"^git\s"),
+        deny_rules=(r"^git\s+push\s.*--force",),
+    )
+
+    assert policy.is_unsafe("make && rm -rf build") is False
+    assert policy.is_unsafe("rm -rf src") is True
+    assert policy.is_unsafe("git push origin main") is False
+    assert policy.is_unsafe("git push origin main --force") is True
+
+
+def test_invalid_user_rule_ignored():
+    """测试无效的用户规则被忽略"""
+    policy = CommandPolicy(deny_rules=("(unclosed",))
+
+    assert policy.is_unsafe("ls") is False
+    assert policy.is_unsafe("rm x") is True
+
+
+def test_policy_cached_by_config_mtime(tmp_path):
+    """测试策略按配置文件修改时间缓存，文件修改后重新加载规则"""
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("shell:\n  deny_rules: ['^make']\n", encoding="utf-8")
+    config = SimpleNamespace(config_path=config_path, shell=ShellConfig())
+
+    with patch.object(command_policy, "_policy_cache", None):
+        policy = command_policy.get_command_policy(config)
+        assert policy.is_unsafe("make") is True
+        assert command_policy.get_command_policy(config) is policy
+
+        config_path.write_text("shell:\n  allow_rules: ['^rm x$']\n", encoding="utf-8")
+        with patch.object(command_policy, "_config_mtime", -1):
+            policy = command_policy.get_command_policy(config)
+
+        assert config.shell.deny_rules == []
+        assert policy.is_unsafe("make") is False
+        assert policy.is_unsafe("rm x") is False
+
+
+def test_check_stays_fast_with_many_rules():
+    """测试规则集很大时单次检查仍在毫秒以内"""
+    assert benchmark(extra_rules=500, iterations=50) < 0.001
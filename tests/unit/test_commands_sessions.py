@@ -4,7 +4,7 @@
 """
 
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import ANY, patch, MagicMock
 
 # 模拟文本管理器初始化
 with patch("viby.locale.text_manager", MagicMock()):
@@ -119,11 +119,57 @@ class TestSessionsCommand:
 
         # 验证调用和返回值
         mock_session_manager.get_history.assert_called_once_with(
-            limit=5, session_id=None
+            limit=5, session_id=None, before_id=None, preview_chars=257
         )
         mock_format.assert_called_once()
         assert result == 0
 
+    @patch("viby.commands.sessions.print_markdown")
+    def test_show_history_pages_with_before_id(
+        self,
+        mock_print_markdown,
+        sessions_command,
+        sample_records,
+        mock_session_manager,
+    ):
+        """测试显示满一页时提示用最后一条记录的 ID 继续翻页"""
+        mock_session_manager.get_history.return_value = sample_records
+
+        with patch.object(sessions_command, "_format_records"):
+            result = sessions_command.show_history(2, before_id=9)
+
+        assert result == 0
+        assert mock_session_manager.get_history.call_args.kwargs["before_id"] == 9
+        mock_print_markdown.assert_called_once()
+
+    def test_show_history_follow(
+        self, sessions_command, sample_records, mock_session_manager, mock_console
+    ):
+        """测试持续显示模式按 ID 读取新记录，按 Ctrl+C 结束"""
+        new_record = dict(sample_records[0], id=3, content="新问题")
+        mock_session_manager.get_active_session_id.return_value = "active"
+        mock_session_manager.get_history.side_effect = [
+            sample_records,
+            [new_record],
+            [],
+        ]
+
+        with (
+            patch.object(sessions_command, "_format_records"),
+            patch(
+                "viby.commands.sessions.time.sleep",
+                side_effect=[None, None, KeyboardInterrupt],
+            ),
+        ):
+            result = sessions_command.show_history(5, follow=True)
+
+        assert result == 0
+        follow_calls = mock_session_manager.get_history.call_args_list[1:]
+        assert [c.kwargs["after_id"] for c in follow_calls] == [2, 3]
+        assert all(c.kwargs["session_id"] == "active" for c in follow_calls)
+        printed = [str(c.args[0]) for c in mock_console.print.call_args_list[1:]]
+        assert len(printed) == 1 and "新问题" in printed[0]
+
     @patch("viby.commands.sessions.print_markdown")
     def test_show_history_no_records(
         self, mock_print_markdown, sessions_command, mock_session_manager
@@ -137,7 +183,7 @@ class TestSessionsCommand:
 
         # 验证调用和返回值
         mock_session_manager.get_history.assert_called_once_with(
-            limit=10, session_id=None
+            limit=10, session_id=None, before_id=None, preview_chars=257
         )
         mock_print_markdown.assert_called_once()
         assert result == 0
@@ -155,7 +201,7 @@ class TestSessionsCommand:
 
         # 验证调用和返回值
         mock_session_manager.get_history.assert_called_once_with(
-            limit=5, search_query="测试", session_id=None
+            limit=5, search_query="测试", session_id=None, preview_chars=51
         )
         mock_format.assert_called_once()
         assert result == 0
@@ -173,7 +219,7 @@ class TestSessionsCommand:
 
         # 验证调用和返回值
         mock_session_manager.get_history.assert_called_once_with(
-            limit=5, search_query="找不到", session_id=None
+            limit=5, search_query="找不到", session_id=None, preview_chars=51
         )
         mock_print_markdown.assert_called_once()
         assert result == 0
@@ -217,7 +263,7 @@ class TestSessionsCommand:
 
         # 验证调用和返回值
         mock_session_manager.export_history.assert_called_once_with(
-            "output.json", "json", None
+            "output.json", "json", None, all_sessions=False, progress_callback=ANY
         )
         mock_print_markdown.assert_called_once()
         assert result == 0
@@ -251,6 +297,53 @@ class TestSessionsCommand:
         mock_makedirs.assert_called_once_with("/fake/path")
         assert result == 0
 
+    @patch("viby.commands.sessions.os.path.isfile", return_value=True)
+    @patch("viby.commands.sessions.print_markdown")
+    def test_import_history(
+        self, mock_print_markdown, mock_isfile, sessions_command, mock_session_manager
+    ):
+        """测试import_history方法"""
+        mock_session_manager.import_history.return_value = {
+            "imported": 2,
+            "skipped": 1,
+            "sessions": 1,
+        }
+
+        with patch("viby.commands.sessions.Progress"):
+            result = sessions_command.import_history("dump.jsonl")
+
+        assert result == 0
+        mock_session_manager.import_history.assert_called_once_with(
+            "dump.jsonl", None, None, progress_callback=ANY
+        )
+        mock_print_markdown.assert_called_once()
+
+        mock_session_manager.import_history.return_value = None
+        with patch("viby.commands.sessions.Progress"):
+            assert sessions_command.import_history("dump.jsonl") == 1
+
+    @patch("viby.commands.sessions.print_markdown")
+    def test_gc(self, mock_print_markdown, sessions_command, mock_session_manager):
+        """测试gc方法报告删除的记录数和回收的空间"""
+        mock_session_manager.apply_retention.return_value = {
+            "deleted": 5,
+            "archive": "/tmp/archive.jsonl.gz",
+        }
+        mock_session_manager.compact_database.return_value = True
+        mock_session_manager.get_storage_size.side_effect = [4 * 1024 * 1024, 1024]
+
+        with patch("viby.commands.sessions.Progress"):
+            result = sessions_command.gc(max_age_days=30)
+
+        assert result == 0
+        mock_session_manager.apply_retention.assert_called_once_with(
+            30, None, None, None, progress_callback=ANY
+        )
+        assert mock_print_markdown.call_args_list[0][0][1] == "success"
+        assert mock_print_markdown.call_count == 2
+        assert sessions_command._format_size(4 * 1024 * 1024 - 1024) == "4.0 MB"
+        assert sessions_command._format_size(512) == "512 B"
+
     @patch("viby.commands.sessions.Confirm.ask")
     @patch("viby.commands.sessions.print_markdown")
     def test_clear_history_confirmed(
@@ -443,3 +536,15 @@ def test_cli_clear(mock_typer, mock_sessions_command):
     # 不能直接检查参数值，因为参数是typer.Option
     mock_command_instance.clear_history.assert_called_once()
     mock_exit.assert_called_once_with(code=0)
+
+
+def test_highlight_snippet(sessions_command):
+    """测试搜索摘要中的匹配词被高亮"""
+    from viby.utils.history import SNIPPET_END, SNIPPET_START
+
+    text = sessions_command._highlight(
+        f"…restart {SNIPPET_START}nginx{SNIPPET_END} now"
+    )
+
+    assert text.plain == "…restart nginx now"
+    assert [text.plain[span.start : span.end] for span in text.spans] == ["nginx"]
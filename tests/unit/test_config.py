@@ -0,0 +1,72 @@
+"""
+测试配置文件加载
+"""
+
+from unittest.mock import patch
+
+import pytest
+
+from viby.config.app_config import Config
+
+
+@pytest.fixture
+def load_config(tmp_path):
+    """把给定内容写入临时配置文件并加载"""
+
+    def _load(text):
+        config_path = tmp_path / ".config" / "viby" / "config.yaml"
+        config_path.parent.mkdir(parents=True, exist_ok=True)
+        config_path.write_text(text, encoding="utf-8")
+        Config._instance = None
+        with (
+            patch("pathlib.Path.home", return_value=tmp_path),
+            patch("platform.system", return_value="Linux"),
+        ):
+            return Config()
+
+    yield _load
+    Config._instance = None
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [("false", False), ("'no'", False), ("'off'", False), ("0", False)]
+    + [("true", True), ("'yes'", True), ("'On'", True), ("1", True)],
+)
+def test_bool_settings_parse_strings(load_config, text, expected):
+    """测试布尔配置项按内容解析字符串，"false" 不会被当作真值"""
+    config = load_config(f"shell:\n  persistent_session: {text}\n")
+    assert config.shell.persistent_session is expected
+
+
+def test_empty_and_invalid_settings_keep_defaults(load_config, capsys):
+    """测试空值被忽略，无效值只影响对应字段，后面的配置照常加载"""
+    config = load_config("""
+embedding:
+  ann_index: "maybe"
+  ann_nprobe: 16
+shell:
+  timeout:
+  cpu_seconds: many
+  deny_rules: '^make'
+  memory_mb: "256"
+history:
+  busy_retries: {}
+  archive_on_gc: "false"
+language: zh-CN
+""")
+    assert config.embedding.ann_index is False
+    assert config.embedding.ann_nprobe == 16
+    assert config.shell.timeout == 600
+    assert config.shell.cpu_seconds == 0
+    assert config.shell.deny_rules == ["^make"]
+    assert config.shell.memory_mb == 256
+    assert config.history.busy_retries == 5
+    assert config.history.archive_on_gc is False
+    assert config.language == "zh-CN"
+
+    output = capsys.readouterr().out
+    assert "embedding.ann_index" in output
+    assert "shell.cpu_seconds" in output
+    assert "history.busy_retries" in output
+    assert "shell.timeout" not in output
@@ -0,0 +1,1107 @@
+"""
+测试会话历史数据库
+"""
+
+import csv
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import textwrap
+import threading
+import zlib
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import yaml
+
+from viby.config import config
+from viby.utils import history, history_index, history_io, history_recorder
+from viby.utils.history import SCHEMA_VERSION, SessionManager
+
+
+@pytest.fixture(autouse=True)
+def history_db(tmp_path, monkeypatch):
+    """使用临时目录中的历史数据库"""
+    history.close_connections()
+    monkeypatch.setattr(config, "config_dir", tmp_path)
+    with patch.object(history, "logger"), patch.object(history_recorder, "logger"):
+        yield tmp_path / "history.db"
+    history.close_connections()
+
+
+def test_connection_is_shared_and_tuned(history_db):
+    """测试同一进程内复用一个连接，并启用 WAL 等设置"""
+    first = SessionManager()
+    second = SessionManager()
+
+    with first._db_connection() as conn_a, second._db_connection() as conn_b:
+        assert conn_a is conn_b
+        assert conn_a.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn_a.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn_a.execute("PRAGMA busy_timeout").fetchone()[0] == (
+            config.history.busy_timeout_ms
+        )
+        assert conn_a.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+
+
+def test_schema_init_runs_once(history_db):
+    """测试数据库结构只在进程内首次使用时检查"""
+    manager = SessionManager()
+    statements = []
+    with manager._db_connection() as conn:
+        conn.set_trace_callback(statements.append)
+
+    SessionManager()
+    SessionManager()
+
+    assert statements == []
+
+
+def test_interactions_from_other_thread(history_db):
+    """测试后台线程写入的记录可以在主线程读取"""
+    manager = SessionManager()
+    thread = threading.Thread(
+        target=manager.add_interaction, args=("问题", "回答"), daemon=True
+    )
+    thread.start()
+    thread.join()
+
+    records = manager.get_history()
+    assert [(r["content"], r["response"]) for r in records] == [("问题", "回答")]
+
+
+def test_failed_operation_rolls_back(history_db):
+    """测试出错时回滚，共享连接上不会残留未提交的事务"""
+    manager = SessionManager()
+    with pytest.raises(RuntimeError):
+        with manager._db_connection() as conn:
+            conn.execute("UPDATE sessions SET name = 'x'")
+            raise RuntimeError("boom")
+
+    with manager._db_connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute("SELECT name FROM sessions").fetchone()[0] != "x"
+
+
+def _session(manager, session_id):
+    return next(s for s in manager.get_sessions() if s["id"] == session_id)
+
+
+def test_session_counters_are_maintained(history_db):
+    """测试交互数和最后交互时间随写入、删除同步更新"""
+    manager = SessionManager()
+    session_id = manager.get_active_session_id()
+    assert _session(manager, session_id)["interaction_count"] == 0
+
+    manager.add_interaction("a", "1")
+    manager.add_interaction("b", "2")
+    latest = manager.get_history(limit=1)[0]["timestamp"]
+    session = _session(manager, session_id)
+    assert session["interaction_count"] == 2
+    assert session["last_interaction"] == latest
+
+    manager.clear_history(session_id)
+    session = _session(manager, session_id)
+    assert session["interaction_count"] == 0
+    assert session["last_interaction"] is None
+
+
+def test_migration_backfills_legacy_database(history_db):
+    """测试旧版本数据库迁移时补齐索引和计数"""
+    import sqlite3
+
+    conn = sqlite3.connect(str(history_db))
+    conn.executescript("""
+        CREATE TABLE sessions (
+            id TEXT PRIMARY KEY, name TEXT NOT NULL, created_at TEXT NOT NULL,
+            last_used TEXT NOT NULL, description TEXT, is_active INTEGER DEFAULT 0
+        );
+        CREATE TABLE history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL,
+            timestamp TEXT NOT NULL, type TEXT NOT NULL, content TEXT NOT NULL,
+            response TEXT, metadata TEXT
+        );
+        INSERT INTO sessions VALUES ('s1', 'old', '2024', '2024', NULL, 1);
+        INSERT INTO history (session_id, timestamp, type, content)
+        VALUES ('s1', '2024-01-01', 'query', 'a'), ('s1', '2024-02-01', 'query', 'b');
+        """)
+    conn.close()
+
+    manager = SessionManager()
+    session = _session(manager, "s1")
+    assert session["interaction_count"] == 2
+    assert session["last_interaction"] == "2024-02-01"
+
+    with manager._db_connection() as conn:
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT * FROM history WHERE session_id = ? "
+            "ORDER BY timestamp DESC",
+            ("s1",),
+        ).fetchall()
+    assert "idx_history_session_timestamp" in " ".join(row[-1] for row in plan)
+
+
+def test_build_fts_query():
+    """测试搜索语法转换为带引号的 FTS5 查询"""
+    assert history.build_fts_query('deploy "exit code" kube*') == (
+        '"deploy" "exit code" "kube"*'
+    )
+    assert history.build_fts_query('a"b OR') == '"a""b" "OR"'
+
+
+def test_fts_search_ranks_and_highlights(history_db):
+    """测试全文搜索按相关度排序、支持前缀和短语并生成高亮摘要"""
+    manager = SessionManager()
+    manager.add_interaction("how to restart nginx", "use systemctl")
+    manager.add_interaction("nginx nginx config reload", "nginx -s reload")
+    manager.add_interaction("python packaging", "use pyproject")
+
+    records = manager.get_history(search_query="nginx")
+    assert [r["content"] for r in records] == [
+        "nginx nginx config reload",
+        "how to restart nginx",
+    ]
+    assert history.SNIPPET_START + "nginx" + history.SNIPPET_END in (
+        records[0]["snippet"]
+    )
+
+    assert len(manager.get_history(search_query="pack*")) == 1
+    assert len(manager.get_history(search_query='"config reload"')) == 1
+    assert manager.get_history(search_query='"reload config"') == []
+
+
+def test_fts_index_follows_updates_and_deletes(history_db):
+    """测试全文索引随历史记录的修改和删除同步"""
+    manager = SessionManager()
+    record_id = manager.add_interaction("question", "first answer")
+    manager.update_interaction(record_id, "second answer")
+
+    assert manager.get_history(search_query="first") == []
+    assert len(manager.get_history(search_query="second")) == 1
+
+    manager.clear_history()
+    assert manager.get_history(search_query="second") == []
+
+
+def test_trigram_tokenizer_for_cjk(history_db, monkeypatch):
+    """测试 trigram 分词器支持中文子串搜索，短词回退到逐行匹配"""
+    monkeypatch.setattr(config.history, "fts_tokenizer", "trigram")
+    manager = SessionManager()
+    manager.add_interaction("如何配置数据库连接池", "调整连接池大小")
+    assert manager.rebuild_search_index()
+
+    records = manager.get_history(search_query="数据库")
+    assert len(records) == 1
+    assert "snippet" in records[0]
+
+    # 少于三个字符的词无法使用 trigram 索引
+    records = manager.get_history(search_query="配置")
+    assert len(records) == 1
+    assert "snippet" not in records[0]
+
+
+def _fake_embed(texts):
+    """按词哈希生成的确定性向量，共享的词越多相似度越高"""
+    vectors = np.zeros((len(texts), 64), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            vectors[row, zlib.crc32(word.encode()) % 64] += 1
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-6)
+
+
+@pytest.fixture
+def fake_embed():
+    with (
+        patch.object(
+            history_index, "embed_texts", side_effect=_fake_embed
+        ) as mock_embed,
+        patch.object(history_index, "logger"),
+    ):
+        yield mock_embed
+
+
+def test_semantic_search_indexes_incrementally(history_db, fake_embed):
+    """测试语义搜索按相似度排序，且只为新记录生成向量"""
+    manager = SessionManager()
+    manager.add_interaction("restart the nginx server", "systemctl restart nginx")
+    manager.add_interaction("python packaging tools", "use pyproject")
+
+    records = manager.semantic_search("nginx server restart")
+    assert [r["content"] for r in records] == [
+        "restart the nginx server",
+        "python packaging tools",
+    ]
+    assert records[0]["score"] > records[1]["score"]
+
+    manager.add_interaction("python virtual env", "python -m venv")
+    fake_embed.reset_mock()
+    records = manager.semantic_search("python", limit=1)
+    assert [r["content"] for r in records] == ["python virtual env"]
+    # 一次为新增的一条记录生成向量，一次为查询生成向量
+    indexed = [call.args[0] for call in fake_embed.call_args_list]
+    assert indexed == [["python virtual env\npython -m venv"], ["python"]]
+
+
+def test_semantic_search_follows_deletes_and_sessions(history_db, fake_embed):
+    """测试删除的记录从向量索引中移除，并支持按会话过滤"""
+    manager = SessionManager()
+    first = manager.get_active_session_id()
+    manager.add_interaction("docker compose up", "starts services")
+    second = manager.create_session("other")
+    manager.add_interaction("docker build image", "builds", session_id=second)
+
+    assert len(manager.semantic_search("docker", session_id=first)) == 1
+    assert len(manager.semantic_search("docker", session_id=second)) == 1
+
+    manager.clear_history(first)
+    assert manager.semantic_search("docker", session_id=first) == []
+    # 清空后自增 ID 可能被复用，新记录仍要建立索引
+    manager.add_interaction("kubectl get pods", "lists pods", session_id=first)
+    records = manager.semantic_search("kubectl pods", session_id=first)
+    assert [r["content"] for r in records] == ["kubectl get pods"]
+    index = history_index.HistoryVectorIndex(manager, config.embedding.model_name)
+    ids = index._load_ids()
+    with manager._db_connection() as conn:
+        live = {row[0] for row in conn.execute("SELECT id FROM history")}
+    assert set(ids[ids >= 0].tolist()) == live
+
+
+def test_reset_index_keeps_history_deletable(history_db, fake_embed):
+    """测试重建向量索引后仍能删除历史记录，删除会在下次更新时同步到索引"""
+    manager = SessionManager()
+    manager.add_interaction("docker compose up", "starts services")
+    manager.add_interaction("kubectl get pods", "lists pods")
+    assert len(manager.semantic_search("docker")) == 2
+
+    # 更换模型会清空索引
+    history_index.HistoryVectorIndex(manager, "other-model")
+    manager.clear_history()
+    assert manager.get_history() == []
+
+    manager.add_interaction("docker build image", "builds")
+    records = manager.semantic_search("docker")
+    assert [r["content"] for r in records] == ["docker build image"]
+
+
+def test_semantic_search_without_model(history_db):
+    """测试嵌入模型不可用时返回 None"""
+    manager = SessionManager()
+    manager.add_interaction("question", "answer")
+    with patch.object(history_index, "embed_texts", return_value=None):
+        assert manager.semantic_search("question") is None
+
+
+@pytest.mark.parametrize("file_name", ["out.json", "out.jsonl.gz", "out.yaml"])
+def test_export_history_streams_in_batches(history_db, monkeypatch, file_name):
+    """测试导出分批写出全部记录，压缩格式按扩展名处理"""
+    monkeypatch.setattr(history, "EXPORT_BATCH_SIZE", 2)
+    manager = SessionManager()
+    for i in range(5):
+        manager.add_interaction(f"q{i}", f"a{i}", metadata={"n": i})
+
+    batches = []
+    path = history_db.parent / file_name
+    assert manager.export_history(str(path), progress_callback=batches.append)
+    assert batches == [2, 2, 1]
+
+    with history_io.open_text(str(path)) as f:
+        text = f.read()
+    if file_name.endswith(".yaml"):
+        records = yaml.safe_load(text)
+    elif ".jsonl" in file_name:
+        records = [json.loads(line) for line in text.splitlines()]
+    else:
+        records = json.loads(text)
+    assert sorted(r["content"] for r in records) == [f"q{i}" for i in range(5)]
+    assert {r["metadata"]["n"] for r in records} == set(range(5))
+
+
+def test_export_all_sessions_csv(history_db):
+    """测试导出所有会话为 CSV，空会话导出为只有表头的文件"""
+    manager = SessionManager()
+    first = manager.get_active_session_id()
+    manager.add_interaction("first", "one")
+    other = manager.create_session("other")
+    manager.add_interaction("second", "two", session_id=other)
+
+    path = history_db.parent / "all.csv"
+    assert manager.export_history(str(path), all_sessions=True)
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(r["content"] for r in rows) == ["first", "second"]
+    assert {r["session_id"] for r in rows} == {first, other}
+
+    empty = manager.create_session("empty")
+    path = history_db.parent / "empty.json"
+    assert manager.export_history(str(path), session_id=empty)
+    assert json.loads(path.read_text(encoding="utf-8")) == []
+
+
+@pytest.mark.parametrize("file_name", ["dump.json", "dump.jsonl.gz", "dump.csv"])
+def test_import_history_round_trip(history_db, monkeypatch, file_name):
+    """测试导入导出的文件后恢复会话和记录，重复导入时全部跳过"""
+    monkeypatch.setattr(history, "IMPORT_BATCH_SIZE", 3)
+    monkeypatch.setattr(history, "IMPORT_TRANSACTION_SIZE", 6)
+    monkeypatch.setattr(history_io, "READ_CHUNK_SIZE", 16)
+    manager = SessionManager()
+    source = manager.get_active_session_id()
+    for i in range(10):
+        manager.add_interaction(f"question {i}", f"answer {i}", metadata={"n": i})
+    path = history_db.parent / file_name
+    assert manager.export_history(str(path))
+
+    # 导入到另一个数据库
+    history.close_connections()
+    target_dir = history_db.parent / "target"
+    target_dir.mkdir()
+    monkeypatch.setattr(config, "config_dir", target_dir)
+    target = SessionManager()
+    batches = []
+    stats = target.import_history(str(path), progress_callback=batches.append)
+    assert stats == {"imported": 10, "skipped": 0, "sessions": 1}
+    assert batches == [3, 3, 3, 1]
+
+    records = target.get_history(limit=20, session_id=source)
+    assert sorted(r["content"] for r in records) == [f"question {i}" for i in range(10)]
+    assert {r["metadata"]["n"] for r in records} == set(range(10))
+    # 导入的记录进入全文索引，触发器已恢复
+    assert len(target.get_history(search_query="answer", session_id=source)) == 10
+    target.add_interaction("after import", "ok", session_id=source)
+    assert len(target.get_history(search_query="after", session_id=source)) == 1
+
+    assert target.import_history(str(path)) == {
+        "imported": 0,
+        "skipped": 10,
+        "sessions": 0,
+    }
+
+
+def test_import_history_into_session_dedupes_file(history_db):
+    """测试导入到指定会话，并去掉文件中重复的记录"""
+    manager = SessionManager()
+    session_id = manager.create_session("target")
+    record = {
+        "session_id": "other",
+        "timestamp": "2024-01-01T00:00:00",
+        "content": "hello",
+        "response": "world",
+    }
+    path = history_db.parent / "dup.jsonl"
+    path.write_text(
+        "\n".join(json.dumps(r) for r in [record, record, {"content": ""}]) + "\n",
+        encoding="utf-8",
+    )
+
+    stats = manager.import_history(str(path), session_id=session_id)
+    assert stats == {"imported": 1, "skipped": 2, "sessions": 0}
+    assert [r["content"] for r in manager.get_history(session_id=session_id)] == [
+        "hello"
+    ]
+    assert manager.import_history(str(path), session_id="missing") is None
+
+
+def _add_at(manager, content, timestamp, session_id=None, response="r"):
+    record_id = manager.add_interaction(content, response, session_id=session_id)
+    with manager._db_connection() as conn:
+        conn.execute(
+            "UPDATE history SET timestamp = ? WHERE id = ?", (timestamp, record_id)
+        )
+        conn.commit()
+
+
+def test_retention_policies_archive_in_batches(history_db, monkeypatch):
+    """测试按时间、记录数和字节数清理，记录分批删除并归档"""
+    monkeypatch.setattr(history, "DELETE_BATCH_SIZE", 2)
+    manager = SessionManager()
+    first = manager.get_active_session_id()
+    _add_at(manager, "ancient", "2000-01-01T00:00:00")
+    for i in range(4):
+        _add_at(manager, f"recent {i}", f"2999-01-01T00:00:0{i}")
+    other = manager.create_session("other")
+    _add_at(manager, "small", "2999-01-01T00:00:00", other)
+    _add_at(manager, "x" * 100, "2999-01-01T00:00:01", other, response=None)
+
+    batches = []
+    result = manager.apply_retention(
+        max_age_days=30,
+        max_rows=3,
+        max_bytes=50,
+        archive=True,
+        progress_callback=batches.append,
+    )
+    assert result["deleted"] == 4
+    assert batches == [2, 2]
+
+    remaining = manager.get_history(limit=10, session_id=first)
+    assert sorted(r["content"] for r in remaining) == [f"recent {i}" for i in (1, 2, 3)]
+    # 最新的记录已超出字节上限，更早的记录也一并删除
+    assert manager.get_history(limit=10, session_id=other) == []
+    counts = {s["id"]: s["interaction_count"] for s in manager.get_sessions()}
+    assert counts[first] == 3 and counts[other] == 0
+
+    archived = list(history_io.iter_records(result["archive"]))
+    assert sorted(r["content"] for r in archived) == [
+        "ancient",
+        "recent 0",
+        "small",
+        "x" * 100,
+    ]
+    # 归档文件可以重新导入
+    assert manager.import_history(result["archive"])["imported"] == 4
+
+
+def test_gc_without_policies_and_compaction(history_db, monkeypatch):
+    """测试未配置保留策略时不删除记录，压缩后数据库改为增量回收模式"""
+    monkeypatch.setattr(history, "DELETE_BATCH_SIZE", 3)
+    manager = SessionManager()
+    for i in range(10):
+        manager.add_interaction(f"q{i}", "a" * 1000)
+
+    assert manager.apply_retention() == {"deleted": 0, "archive": None}
+    assert manager.compact_database()
+    with manager._db_connection() as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+    # 删除会话历史时分批删除
+    assert manager.clear_history()
+    assert manager.get_history(limit=20) == []
+    assert manager.get_sessions()[0]["interaction_count"] == 0
+
+
+def _blob_rows(manager):
+    with manager._db_connection() as conn:
+        return conn.execute(
+            "SELECT codec, size, length(data) AS stored FROM history_blobs"
+        ).fetchall()
+
+
+def test_large_responses_stored_once_compressed(history_db, monkeypatch):
+    """测试大段回复按内容哈希压缩保存一份，读取和全文搜索不受影响"""
+    monkeypatch.setattr(config.history, "blob_threshold", 100)
+    manager = SessionManager()
+    big = "tool output line\n" * 200
+    first = manager.add_interaction("first", big)
+    second = manager.add_interaction("second", big)
+    manager.add_interaction("small", "short")
+
+    blobs = _blob_rows(manager)
+    assert len(blobs) == 1
+    assert blobs[0]["codec"] == "zlib" and blobs[0]["stored"] < blobs[0]["size"]
+    with manager._db_connection() as conn:
+        row = conn.execute(
+            "SELECT response, response_ref FROM history WHERE id = ?", (first,)
+        ).fetchone()
+    assert row["response"] is None and row["response_ref"]
+
+    records = manager.get_history(limit=5)
+    assert {r["content"]: r["response"] for r in records} == {
+        "first": big,
+        "second": big,
+        "small": "short",
+    }
+    assert "response_ref" not in records[0]
+    results = manager.get_history(search_query="tool")
+    assert sorted(r["content"] for r in results) == ["first", "second"]
+
+    # 修改和删除后全文索引仍与内容一致
+    assert manager.update_interaction(second, "changed")
+    assert [r["content"] for r in manager.get_history(search_query="tool")] == ["first"]
+    manager.clear_history()
+    assert manager.get_history(search_query="tool") == []
+    # 不再被引用的内容在压缩数据库时删除
+    assert len(_blob_rows(manager)) == 1
+    assert manager.compact_database()
+    assert _blob_rows(manager) == []
+
+
+def test_compact_moves_existing_inline_responses(history_db, monkeypatch):
+    """测试压缩数据库时把启用前保存的大段内联回复转存"""
+    monkeypatch.setattr(config.history, "blob_threshold", 0)
+    manager = SessionManager()
+    big = "line of build log\n" * 300
+    manager.add_interaction("build", big)
+    assert _blob_rows(manager) == []
+
+    monkeypatch.setattr(config.history, "blob_threshold", 1000)
+    assert manager.compact_database()
+    assert len(_blob_rows(manager)) == 1
+    assert manager.get_history()[0]["response"] == big
+    assert len(manager.get_history(search_query="build log")) == 1
+
+
+def test_import_skipped_records_leave_no_blobs(history_db, monkeypatch):
+    """测试重复导入时跳过的记录不保存大段回复，新记录的回复照常转存"""
+    monkeypatch.setattr(config.history, "blob_threshold", 0)
+    manager = SessionManager()
+    big = "line of build log\n" * 300
+    manager.add_interaction("build", big)
+    path = history_db.parent / "dump.jsonl"
+    assert manager.export_history(str(path))
+
+    monkeypatch.setattr(config.history, "blob_threshold", 1000)
+    stats = manager.import_history(str(path))
+    assert stats == {"imported": 0, "skipped": 1, "sessions": 0}
+    assert _blob_rows(manager) == []
+
+    manager.clear_history()
+    stats = manager.import_history(str(path))
+    assert stats == {"imported": 1, "skipped": 0, "sessions": 0}
+    assert len(_blob_rows(manager)) == 1
+    assert manager.get_history()[0]["response"] == big
+    assert len(manager.get_history(search_query="build log")) == 1
+
+
+def _schema_using_functions(db_path):
+    conn = sqlite3.connect(str(db_path))
+    try:
+        return conn.execute(
+            "SELECT name FROM sqlite_master WHERE sql LIKE '%blob_decode%'"
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+def test_database_usable_without_viby_functions(history_db, monkeypatch):
+    """测试其他程序的连接没有 blob_decode 函数时也能读写和删除历史记录"""
+    monkeypatch.setattr(config.history, "blob_threshold", 100)
+    manager = SessionManager()
+    big = "compiler warning\n" * 100
+    record_id = manager.add_interaction("build", big)
+    manager.append_segment(record_id, "linker error\n" * 100)
+    session_id = manager.get_active_session_id()
+    assert _schema_using_functions(history_db) == []
+
+    conn = sqlite3.connect(str(history_db))
+    conn.execute(
+        "INSERT INTO history (session_id, timestamp, type, content, response) "
+        "VALUES (?, '2024-01-01', 'query', 'from cli', 'plain')",
+        (session_id,),
+    )
+    assert conn.execute("SELECT COUNT(*) FROM history").fetchone()[0] == 2
+    conn.execute("DELETE FROM history WHERE id = ?", (record_id,))
+    conn.commit()
+    conn.close()
+
+    assert manager.get_history(search_query="compiler") == []
+    assert manager.get_history(search_query="linker") == []
+    assert [r["content"] for r in manager.get_history()] == ["from cli"]
+
+
+def test_migration_removes_function_dependent_schema(history_db, monkeypatch):
+    """测试旧版本中调用 blob_decode 的视图和触发器在迁移时删除，全文索引重新回填"""
+    monkeypatch.setattr(config.history, "blob_threshold", 100)
+    manager = SessionManager()
+    manager.add_interaction("deploy", "rollout status\n" * 50)
+    history.close_connections()
+
+    conn = sqlite3.connect(str(history_db))
+    conn.executescript("""
+        DROP TABLE history_fts;
+        DROP TABLE history_segments_fts;
+        CREATE VIEW history_full AS
+        SELECT id, blob_decode('raw', response) AS response FROM history;
+        CREATE TRIGGER history_fts_insert AFTER INSERT ON history
+        BEGIN SELECT blob_decode('raw', NEW.response); END;
+        PRAGMA user_version = 6;
+        """)
+    conn.close()
+
+    manager = SessionManager()
+    assert _schema_using_functions(history_db) == []
+    assert [r["content"] for r in manager.get_history(search_query="rollout")] == [
+        "deploy"
+    ]
+    assert manager.get_history()[0]["response"] == "rollout status\n" * 50
+
+
+def _segment_count(manager):
+    with manager._db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM interaction_segments").fetchone()[0]
+
+
+def test_segments_append_without_rewriting(history_db, monkeypatch):
+    """测试追加的段落在读取、搜索和导出时与回复拼接，原回复不被重写"""
+    monkeypatch.setattr(config.history, "blob_threshold", 100)
+    manager = SessionManager()
+    record_id = manager.add_interaction("run tests", "running pytest")
+    log = "collected 12 items\n" * 50
+    assert manager.append_segment(record_id, log)
+    assert manager.append_segment(record_id, "all green")
+    assert not manager.append_segment(record_id + 1, "missing")
+
+    expected = "running pytest\n\n" + log + "\n\nall green"
+    assert manager.get_history()[0]["response"] == expected
+    with manager._db_connection() as conn:
+        row = conn.execute(
+            "SELECT response FROM history WHERE id = ?", (record_id,)
+        ).fetchone()
+    assert row["response"] == "running pytest"
+    assert len(_blob_rows(manager)) == 1
+
+    # 段落中的词可以搜索到，并带有高亮摘要
+    records = manager.get_history(search_query="green")
+    assert [r["id"] for r in records] == [record_id]
+    assert history.SNIPPET_START + "green" + history.SNIPPET_END in (
+        records[0]["snippet"]
+    )
+    assert len(manager.get_history(search_query="pytest")) == 1
+
+    out = history_db.parent / "out.jsonl"
+    assert manager.export_history(str(out))
+    exported = [json.loads(line) for line in out.read_text().splitlines()]
+    assert exported[0]["response"] == expected
+
+    # 再次导入时按完整回复识别重复记录
+    result = manager.import_history(str(out))
+    assert result["imported"] == 0 and result["skipped"] == 1
+
+
+def test_segments_replaced_and_deleted_with_record(history_db):
+    """测试修改回复时清除已追加的段落，删除记录时段落和索引一并删除"""
+    manager = SessionManager()
+    record_id = manager.add_interaction("question", "draft")
+    manager.append_segment(record_id, "segment text")
+
+    assert manager.update_interaction(record_id, "final")
+    assert manager.get_history()[0]["response"] == "final"
+    assert manager.get_history(search_query="segment") == []
+    assert _segment_count(manager) == 0
+
+    manager.append_segment(record_id, "another segment")
+    assert len(manager.get_history(search_query="another")) == 1
+    manager.clear_history()
+    assert _segment_count(manager) == 0
+    assert manager.get_history(search_query="another") == []
+    assert manager.rebuild_search_index()
+
+
+def _recorded_batches(recorder, monkeypatch):
+    """记录每次写入的批大小和执行写入的线程"""
+    batches = []
+    original = recorder._apply
+
+    def _apply(batch):
+        batches.append((len(batch), threading.current_thread().name))
+        return original(batch)
+
+    monkeypatch.setattr(recorder, "_apply", _apply)
+    return batches
+
+
+def test_recorder_batches_writes_in_background(history_db, monkeypatch):
+    """测试后台线程把排队的交互记录和段落合并到少数事务中写入"""
+    manager = SessionManager()
+    recorder = history_recorder.HistoryRecorder(manager, queue_size=100)
+    batches = _recorded_batches(recorder, monkeypatch)
+
+    # 占用数据库连接，让写入在队列中积压
+    with manager._db_connection():
+        records = []
+        for i in range(10):
+            record = recorder.record_interaction(f"question {i}", f"answer {i}")
+            recorder.append_segment(record, f"tool output {i}")
+            records.append(record)
+        assert records[-1].wait(0) is None
+    assert recorder.flush(5)
+
+    assert sum(size for size, _ in batches) == 20
+    assert len(batches) <= 2
+    assert all(name == "viby-history-writer" for _, name in batches)
+    ids = [record.wait(0) for record in records]
+    assert ids == sorted(ids) and ids[0] > 0
+    history_by_content = {
+        r["content"]: r["response"] for r in manager.get_history(limit=20)
+    }
+    assert history_by_content["question 3"] == "answer 3\n\ntool output 3"
+
+
+def test_recorder_falls_back_to_sync_when_full(history_db, monkeypatch):
+    """测试队列已满时先写完队列再同步写入，写入顺序不变"""
+    manager = SessionManager()
+    recorder = history_recorder.HistoryRecorder(manager, queue_size=1)
+    batches = _recorded_batches(recorder, monkeypatch)
+
+    started = threading.Event()
+    release = threading.Event()
+    original = recorder._apply
+
+    def _slow_apply(batch):
+        started.set()
+        release.wait(5)
+        return original(batch)
+
+    monkeypatch.setattr(recorder, "_apply", _slow_apply)
+    record = recorder.record_interaction("question", "answer")
+    assert started.wait(5)
+    # 写入线程阻塞在第一条记录上，第二条填满队列，第三条同步写入
+    recorder.append_segment(record, "first")
+    threading.Timer(0.1, release.set).start()
+    assert recorder.append_segment(record, "second")
+
+    assert batches[-1][1] == threading.current_thread().name
+    assert manager.get_history()[0]["response"] == "answer\n\nfirst\n\nsecond"
+
+
+def test_recorder_sync_mode_and_exit_flush(history_db, monkeypatch):
+    """测试队列容量为 0 时同步写入，退出时写完共享记录器的队列"""
+    manager = SessionManager()
+    sync = history_recorder.HistoryRecorder(manager, queue_size=0)
+    record = sync.record_interaction("sync", "now")
+    assert record.wait(0) > 0
+    assert not sync.append_segment(record.id + 1, "missing")
+
+    monkeypatch.setattr(history_recorder, "_recorders", {})
+    shared = history_recorder.get_recorder(manager)
+    assert history_recorder.get_recorder(SessionManager()) is shared
+    shared.record_interaction("queued", "later")
+    history_recorder._flush_at_exit()
+    assert {r["content"] for r in manager.get_history()} == {"sync", "queued"}
+
+
+def test_begin_immediate_retries_when_busy(monkeypatch):
+    """测试获取写锁超时后按退避间隔重试，其他错误直接抛出"""
+    monkeypatch.setattr(history.time, "sleep", lambda _: None)
+
+    class _Cursor:
+        def __init__(self, failures, message="database is locked"):
+            self.failures = failures
+            self.message = message
+            self.calls = 0
+
+        def execute(self, sql):
+            self.calls += 1
+            if self.calls <= self.failures:
+                raise sqlite3.OperationalError(self.message)
+
+    cursor = _Cursor(failures=2)
+    history.begin_immediate(cursor, retries=3)
+    assert cursor.calls == 3
+
+    with pytest.raises(sqlite3.OperationalError):
+        history.begin_immediate(_Cursor(failures=5), retries=2)
+    cursor = _Cursor(failures=1, message="no such table: x")
+    with pytest.raises(sqlite3.OperationalError):
+        history.begin_immediate(cursor, retries=3)
+    assert cursor.calls == 1
+
+
+def test_single_active_session_is_enforced(history_db):
+    """测试唯一索引保证只有一个活跃会话"""
+    manager = SessionManager()
+    first = manager.create_session("first")
+    second = manager.create_session("second")
+    assert manager.set_active_session(first)
+
+    with manager._db_connection() as conn:
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("UPDATE sessions SET is_active = 1 WHERE id = ?", (second,))
+        conn.rollback()
+        active = conn.execute("SELECT id FROM sessions WHERE is_active = 1").fetchall()
+    assert [row[0] for row in active] == [first]
+
+    assert manager.delete_session(first)
+    assert manager.get_active_session_id() == second
+
+
+def test_interaction_without_active_session_creates_default(history_db):
+    """测试没有活跃会话时在写入事务中创建默认会话，记录不会丢失"""
+    manager = SessionManager()
+    assert manager.delete_session(manager.get_active_session_id())
+    record_id = manager.add_interaction("hi", "there")
+    assert record_id > 0
+
+    recorder = history_recorder.HistoryRecorder(manager, queue_size=0)
+    assert manager.delete_session(manager.get_active_session_id())
+    assert recorder.record_interaction("again", "ok").wait(5) > 0
+
+    sessions = manager.get_sessions()
+    assert [s["name"] for s in sessions] == ["默认会话"]
+    assert [r["content"] for r in manager.get_history()] == ["again"]
+    with manager._db_connection() as conn:
+        orphans = conn.execute(
+            "SELECT COUNT(*) FROM history WHERE session_id NOT IN (SELECT id FROM sessions)"
+        ).fetchone()[0]
+    assert orphans == 0
+
+
+_STRESS_WORKER = textwrap.dedent("""
+    import sys
+    from viby.utils.history import SessionManager
+
+    worker, count = int(sys.argv[1]), int(sys.argv[2])
+    manager = SessionManager()
+    session_ids = []
+    for i in range(count):
+        if i % 10 == 0:
+            session_ids.append(manager.create_session(f"w{worker}-{i}"))
+        elif i % 10 == 5:
+            manager.set_active_session(session_ids[0])
+        record_id = manager.add_interaction(f"w{worker}-{i}", "done")
+        assert record_id > 0, record_id
+    """)
+
+
+def test_concurrent_writer_processes(tmp_path):
+    """测试多个进程同时写入时没有丢失的记录，且始终只有一个活跃会话"""
+    workers, count = 6, 60
+    home = tmp_path / "home"
+    env = dict(os.environ, HOME=str(home), APPDATA=str(home))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [str(history.Path(history.__file__).parents[2])]
+        + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else [])
+    )
+
+    processes = [
+        subprocess.Popen(
+            [sys.executable, "-c", _STRESS_WORKER, str(worker), str(count)],
+            env=env,
+            stderr=subprocess.PIPE,
+        )
+        for worker in range(workers)
+    ]
+    errors = [process.communicate(timeout=60)[1] for process in processes]
+    assert [process.returncode for process in processes] == [0] * workers, errors
+
+    db_path = next(home.rglob("history.db"))
+    conn = sqlite3.connect(db_path)
+    try:
+        contents = [row[0] for row in conn.execute("SELECT content FROM history")]
+        active = conn.execute(
+            "SELECT COUNT(*) FROM sessions WHERE is_active = 1"
+        ).fetchone()[0]
+        counted = conn.execute(
+            "SELECT SUM(interaction_count) FROM sessions"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+
+    assert sorted(contents) == sorted(
+        f"w{worker}-{i}" for worker in range(workers) for i in range(count)
+    )
+    assert counted == workers * count
+    assert active == 1
+
+
+def test_history_keyset_pages_and_previews(history_db):
+    """测试按 before_id 翻页、按 after_id 读取新记录，以及只读取文本开头的预览"""
+    manager = SessionManager()
+    ids = [manager.add_interaction(f"question {i}", "answer " * 100) for i in range(25)]
+
+    pages = []
+    before_id = None
+    while True:
+        page = manager.get_history(limit=10, before_id=before_id, preview_chars=12)
+        if not page:
+            break
+        pages.append([r["id"] for r in page])
+        before_id = page[-1]["id"]
+    assert [len(page) for page in pages] == [10, 10, 5]
+    assert sum(pages, []) == ids[::-1]
+
+    preview = manager.get_history(limit=1, preview_chars=12)[0]
+    assert preview["content"] == "question 24"
+    assert preview["response"] == "answer answe"
+
+    newer = manager.get_history(limit=5, after_id=ids[20])
+    assert [r["id"] for r in newer] == ids[21:]
+    assert newer[0]["response"] == "answer " * 100
+
+    # 翻页按 (session_id, timestamp) 索引定位，不扫描整个会话
+    with manager._db_connection() as conn:
+        plan = " ".join(
+            row["detail"]
+            for row in conn.execute(
+                """
+                EXPLAIN QUERY PLAN
+                SELECT id FROM history_full h
+                WHERE h.session_id = ? AND (h.timestamp, h.id) < (
+                    SELECT timestamp, id FROM history WHERE id = ?
+                )
+                ORDER BY h.timestamp DESC, h.id DESC LIMIT 10
+                """,
+                ("s", ids[5]),
+            )
+        )
+    assert "idx_history_session_timestamp" in plan
+    assert "TEMP B-TREE" not in plan
+
+
+def _message_count(manager):
+    with manager._db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def test_recent_messages_rebuild_turns_exactly(history_db, monkeypatch):
+    """测试按保存的消息重建上下文，没有消息的旧交互转换为一问一答"""
+    monkeypatch.setattr(config.history, "blob_threshold", 100)
+    manager = SessionManager()
+    manager.add_interaction("legacy question", "legacy answer")
+    record_id = manager.add_interaction("list files", "ls output")
+    tool_calls = [
+        {
+            "id": "0",
+            "type": "function",
+            "function": {"name": "execute_shell", "arguments": '{"command": "ls"}'},
+        }
+    ]
+    big_output = "file.txt\n" * 100
+    turn = [
+        {"role": "user", "content": "list files", "token_count": 5},
+        {"role": "assistant", "content": "", "tool_calls": tool_calls},
+        {"role": "tool", "tool_call_id": "0", "content": big_output},
+        {"role": "assistant", "content": "ls output"},
+    ]
+    assert manager.add_messages(record_id, turn)
+    assert not manager.add_messages(record_id + 100, turn)
+
+    messages = manager.get_recent_messages(max_turns=5)
+    assert messages == [
+        {"role": "user", "content": "legacy question"},
+        {"role": "assistant", "content": "legacy answer"},
+        {"role": "user", "content": "list files"},
+        {"role": "assistant", "content": "", "tool_calls": tool_calls},
+        {"role": "tool", "content": big_output, "tool_call_id": "0"},
+        {"role": "assistant", "content": "ls output"},
+    ]
+    assert manager.get_recent_messages(max_turns=1)[0]["content"] == "list files"
+    with manager._db_connection() as conn:
+        row = conn.execute(
+            "SELECT content, content_ref FROM messages WHERE role = 'tool'"
+        ).fetchone()
+    assert row["content"] is None and row["content_ref"]
+    assert manager.compact_database()
+    assert manager.get_recent_messages(max_turns=1)[2]["content"] == big_output
+    # 过长的工具结果在重建时从中间省略
+    truncated = manager.get_recent_messages(max_turns=1, max_tool_chars=100)[2]
+    assert truncated["content"] == (
+        big_output[:50] + "\n... [800 chars truncated] ...\n" + big_output[-50:]
+    )
+
+    # 压缩摘要之前的对话不再返回
+    recorder = history_recorder.HistoryRecorder(manager, queue_size=10)
+    pending = recorder.record_interaction("next", "done")
+    recorder.record_messages(
+        pending,
+        [
+            {"role": "assistant", "content": "summary", "compacted": True},
+            {"role": "user", "content": "next"},
+            {"role": "assistant", "content": "done"},
+        ],
+    )
+    assert recorder.flush(5)
+    assert manager.get_recent_messages(max_turns=5) == [
+        {"role": "assistant", "content": "summary"},
+        {"role": "user", "content": "next"},
+        {"role": "assistant", "content": "done"},
+    ]
+
+    manager.clear_history()
+    assert _message_count(manager) == 0
+    assert manager.get_recent_messages() == []
+
+
+def test_model_manager_records_turn_messages(history_db):
+    """测试模型管理器保存包括工具调用在内的本轮消息"""
+    from viby.llm.models import ModelManager
+
+    model = ModelManager()
+    model.history_recorder = history_recorder.HistoryRecorder(
+        model.session_manager, queue_size=0
+    )
+    messages = [
+        {"role": "system", "content": "system prompt"},
+        {"role": "user", "content": "what time is it"},
+    ]
+    model._prepare_messages(messages, {"model": "m"})
+    model._update_history("<tool_call>date</tool_call>")
+    messages.append(
+        {
+            "role": "assistant",
+            "content": "<tool_call>date</tool_call>",
+            "tool_calls": [{"id": "0", "type": "function"}],
+        }
+    )
+    messages.append({"role": "tool", "tool_call_id": "0", "content": "12:00"})
+    model._prepare_messages(messages, {"model": "m"})
+    model._update_history("It is noon.")
+    messages.append({"role": "assistant", "content": "It is noon."})
+
+    assert model.record_turn_messages(messages)
+    assert model.session_manager.get_recent_messages() == messages[1:]
+    with model.session_manager._db_connection() as conn:
+        counts = [row[0] for row in conn.execute("SELECT token_count FROM messages")]
+    assert len(counts) == 4 and all(count > 0 for count in counts)
+
+
+def test_interrupted_tool_call_is_closed(history_db):
+    """测试工具执行前被中断时，保存和重建的上下文都为工具调用补上结果"""
+    from viby.llm.models import ModelManager
+
+    model = ModelManager()
+    model.history_recorder = history_recorder.HistoryRecorder(
+        model.session_manager, queue_size=0
+    )
+    tool_calls = [{"id": "0", "type": "function"}]
+    messages = [
+        {"role": "system", "content": "system prompt"},
+        {"role": "user", "content": "delete temp files"},
+    ]
+    model._prepare_messages(messages, {"model": "m"})
+    model._update_history("<tool_call>rm</tool_call>")
+    # 在执行确认提示处按下 Ctrl+C，没有工具结果
+    messages.append(
+        {
+            "role": "assistant",
+            "content": "<tool_call>rm</tool_call>",
+            "tool_calls": tool_calls,
+        }
+    )
+
+    assert model.record_turn_messages(messages)
+    cancelled = {
+        "role": "tool",
+        "tool_call_id": "0",
+        "content": history.CANCELLED_TOOL_RESULT,
+    }
+    assert model.session_manager.get_recent_messages()[-1] == cancelled
+
+    # 修复之前保存的不完整消息在重建时补上结果
+    manager = model.session_manager
+    record_id = manager.add_interaction("list files", "")
+    assert manager.add_messages(
+        record_id,
+        [
+            {"role": "user", "content": "list files"},
+            {"role": "assistant", "content": "", "tool_calls": tool_calls},
+        ],
+    )
+    assert manager.get_recent_messages(max_turns=1) == [
+        {"role": "user", "content": "list files"},
+        {"role": "assistant", "content": "", "tool_calls": tool_calls},
+        cancelled,
+    ]
+
+
+def test_close_tool_calls_keeps_answered_calls():
+    """测试已有结果的工具调用保持不变，只补上缺少的结果"""
+    messages = [
+        {"role": "user", "content": "q"},
+        {
+            "role": "assistant",
+            "content": "",
+            "tool_calls": [{"id": "a"}, {"id": "b"}],
+        },
+        {"role": "tool", "tool_call_id": "a", "content": "done"},
+        {"role": "user", "content": "next"},
+    ]
+    assert history.close_tool_calls(messages) == messages[:3] + [
+        {"role": "tool", "tool_call_id": "b", "content": history.CANCELLED_TOOL_RESULT},
+        messages[3],
+    ]
+    assert history.close_tool_calls(messages[:3]) == messages[:3] + [
+        {"role": "tool", "tool_call_id": "b", "content": history.CANCELLED_TOOL_RESULT}
+    ]
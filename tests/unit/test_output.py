@@ -0,0 +1,117 @@
+"""
+测试非交互输出模式
+"""
+
+import io
+import json
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from viby.utils.output import (
+    OUTPUT_JSON,
+    OUTPUT_NDJSON,
+    OUTPUT_RAW,
+    OUTPUT_RICH,
+    OutputWriter,
+    resolve_output_mode,
+)
+
+
+class _Stream(io.StringIO):
+    def __init__(self, tty):
+        super().__init__()
+        self._tty = tty
+
+    def isatty(self):
+        return self._tty
+
+
+def _tracker(prompt, completion):
+    return SimpleNamespace(
+        model_name="test-model",
+        prompt_tokens=prompt,
+        completion_tokens=completion,
+        total_tokens=prompt + completion,
+    )
+
+
+def test_resolve_output_mode_auto():
+    """测试未指定时根据 stdout 是否为终端选择模式"""
+    assert resolve_output_mode(None, _Stream(True)) == OUTPUT_RICH
+    assert resolve_output_mode(None, _Stream(False)) == OUTPUT_RAW
+    assert resolve_output_mode("NDJSON", _Stream(True)) == OUTPUT_NDJSON
+
+
+def test_resolve_output_mode_invalid():
+    """测试不支持的输出模式"""
+    with pytest.raises(ValueError):
+        resolve_output_mode("xml")
+
+
+def test_raw_output():
+    """测试 raw 模式原样输出并补齐结尾换行"""
+    stream = _Stream(False)
+    writer = OutputWriter(OUTPUT_RAW, stream)
+    writer.write("hello ")
+    writer.write("world")
+    writer.end_call(_tracker(3, 2))
+    writer.finish()
+
+    assert stream.getvalue() == "hello world\n"
+
+
+def test_ndjson_output():
+    """测试 ndjson 模式逐增量输出，并以统计记录结尾"""
+    stream = _Stream(False)
+    writer = OutputWriter(OUTPUT_NDJSON, stream)
+    writer.write("a")
+    writer.write("b")
+    writer.end_call(_tracker(10, 2))
+    writer.write("c")
+    writer.end_call(_tracker(5, 1))
+    writer.finish()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [r["content"] for r in records[:-1]] == ["a", "b", "c"]
+    stats = records[-1]
+    assert stats["type"] == "stats"
+    assert stats["model"] == "test-model"
+    assert stats["llm_calls"] == 2
+    assert stats["prompt_tokens"] == 15
+    assert stats["completion_tokens"] == 3
+    assert stats["total_tokens"] == 18
+    assert stats["ttft_ms"] is not None
+    assert stats["latency_ms"] >= stats["ttft_ms"]
+
+
+def test_json_output():
+    """测试 json 模式结束时输出一个完整对象"""
+    stream = _Stream(False)
+    writer = OutputWriter(OUTPUT_JSON, stream)
+    writer.write("你好")
+    writer.write("！")
+    assert stream.getvalue() == ""
+
+    writer.end_call(_tracker(1, 1))
+    writer.finish()
+
+    result = json.loads(stream.getvalue())
+    assert result["content"] == "你好！"
+    assert result["stats"]["total_tokens"] == 2
+
+
+def test_raw_path_skips_heavy_imports():
+    """测试非交互模式的导入路径不加载 rich、prompt_toolkit 和 flatlatex"""
+    code = (
+        "import sys\n"
+        "import viby.cli.app, viby.commands.vibe, viby.llm.nodes.llm_node\n"
+        "heavy = ('rich', 'prompt_toolkit', 'flatlatex')\n"
+        "print(sorted({m.split('.')[0] for m in sys.modules} & set(heavy)))\n"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,204 @@
+"""
+测试流式shell命令执行器
+"""
+
+import os
+import sys
+import threading
+import time
+
+from unittest.mock import patch
+
+import pytest
+
+from viby.tools.shell_executor import (
+    LIMIT_CPU,
+    LIMIT_OUTPUT,
+    OutputBuffer,
+    ResourceLimits,
+    build_preexec_fn,
+    stream_command,
+)
+
+posix_only = pytest.mark.skipif(
+    sys.platform.startswith("win"), reason="需要POSIX shell"
+)
+
+
+@pytest.fixture(autouse=True)
+def mock_logger():
+    """模拟日志记录器，避免其他测试残留的日志处理器影响"""
+    with patch("viby.tools.shell_executor.logger") as logger:
+        yield logger
+
+
+def test_output_buffer_keeps_small_output():
+    """测试小输出完整保留"""
+    buffer = OutputBuffer(head_bytes=8, tail_bytes=8)
+    buffer.write(b"hello")
+    buffer.write(b" world")
+
+    assert buffer.truncated is False
+    assert buffer.getvalue() == "hello world"
+    assert buffer.total_bytes == 11
+
+
+def test_output_buffer_keeps_head_and_tail():
+    """测试大输出只保留开头和结尾"""
+    buffer = OutputBuffer(head_bytes=4, tail_bytes=4)
+    for i in range(100):
+        buffer.write(f"{i:03d}\n".encode())
+
+    value = buffer.getvalue()
+    assert buffer.truncated is True
+    assert buffer.dropped_bytes == 400 - 8
+    assert value.startswith("000\n")
+    assert value.endswith("099\n")
+    assert "392 bytes truncated" in value
+
+
+def test_output_buffer_single_large_write():
+    """测试单次写入超过缓冲容量"""
+    buffer = OutputBuffer(head_bytes=2, tail_bytes=3)
+    buffer.write(b"abcdefghij")
+
+    assert buffer.getvalue().startswith("ab")
+    assert buffer.getvalue().endswith("hij")
+    assert buffer.dropped_bytes == 5
+
+
+@posix_only
+def test_stream_command_captures_output():
+    """测试捕获stdout、stderr和返回码"""
+    result = stream_command("echo out; echo err 1>&2; exit 3", echo=False)
+
+    assert result.returncode == 3
+    assert result.stdout == "out\n"
+    assert result.stderr == "err\n"
+    assert result.timed_out is False
+    assert result.cancelled is False
+
+
+@posix_only
+def test_stream_command_bounds_memory():
+    """测试大量输出时只保留有界内容"""
+    result = stream_command(
+        "seq 1 200000", echo=False, head_bytes=1024, tail_bytes=1024
+    )
+
+    assert result.returncode == 0
+    assert result.truncated is True
+    assert result.stdout.startswith("1\n2\n")
+    assert result.stdout.endswith("199999\n200000\n")
+    assert len(result.stdout) < 4096
+    assert result.stdout_bytes > 1_000_000
+
+
+@posix_only
+def test_stream_command_timeout():
+    """测试超时后终止命令"""
+    start = time.monotonic()
+    result = stream_command("sleep 30", echo=False, timeout=0.3)
+
+    assert result.timed_out is True
+    assert result.returncode != 0
+    assert time.monotonic() - start < 10
+
+
+@posix_only
+def test_stream_command_cancel():
+    """测试通过取消事件终止命令"""
+    cancel_event = threading.Event()
+    timer = threading.Timer(0.3, cancel_event.set)
+    timer.start()
+    try:
+        result = stream_command("sleep 30", echo=False, cancel_event=cancel_event)
+    finally:
+        timer.cancel()
+
+    assert result.cancelled is True
+    assert result.timed_out is False
+
+
+def test_build_preexec_fn_without_limits():
+    """测试未配置进程级限制时不设置preexec_fn"""
+    assert build_preexec_fn(None) is None
+    assert build_preexec_fn(ResourceLimits(max_output_bytes=1024)) is None
+    assert build_preexec_fn(ResourceLimits(cpu_seconds=1)) is not None
+
+
+@posix_only
+def test_stream_command_output_limit():
+    """测试输出超过上限时终止命令"""
+    result = stream_command(
+        "yes", echo=False, limits=ResourceLimits(max_output_bytes=100_000)
+    )
+
+    assert result.limit_exceeded == LIMIT_OUTPUT
+    assert result.timed_out is False
+    assert result.truncated is True
+
+
+@posix_only
+def test_stream_command_cpu_limit():
+    """测试CPU时间超过上限时命令被内核终止"""
+    result = stream_command(
+        "while :; do :; done",
+        echo=False,
+        timeout=30,
+        limits=ResourceLimits(cpu_seconds=1),
+    )
+
+    assert result.limit_exceeded == LIMIT_CPU
+    assert result.timed_out is False
+
+
+_TERMINAL_SCRIPT = """
+import os
+from viby.tools.shell_executor import ResourceLimits, stream_command
+
+result = stream_command(
+    'read line < /dev/tty && echo "got:$line"',
+    echo=False,
+    timeout=10,
+    limits=ResourceLimits(nice=1),
+)
+print("RESULT", repr(result.stdout), result.timed_out)
+print("FOREGROUND", os.tcgetpgrp(0) == os.getpgrp())
+print("READY", flush=True)
+result = stream_command("sleep 30", echo=False, timeout=10)
+print("CANCELLED", result.cancelled, result.timed_out)
+"""
+
+
+@posix_only
+def test_stream_command_reads_terminal():
+    """测试在终端中运行时命令可以读取终端（如 sudo 密码提示），Ctrl+C 只取消命令"""
+    pty = pytest.importorskip("pty")
+
+    pid, master = pty.fork()
+    if pid == 0:
+        os.execv(sys.executable, [sys.executable, "-c", _TERMINAL_SCRIPT])
+
+    os.write(master, b"secret\n")
+    output = b""
+    while b"READY" not in output:
+        output += os.read(master, 4096)
+    # 命令在前台运行时按下 Ctrl+C
+    time.sleep(0.5)
+    os.write(master, b"\x03")
+    while True:
+        try:
+            data = os.read(master, 4096)
+        except OSError:
+            break
+        if not data:
+            break
+        output += data
+    os.close(master)
+    os.waitpid(pid, 0)
+
+    text = output.decode(errors="replace")
+    assert "RESULT 'got:secret\\n' False" in text
+    assert "FOREGROUND True" in text
+    assert "CANCELLED True False" in text
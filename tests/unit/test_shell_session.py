@@ -0,0 +1,94 @@
+"""
+测试持久化shell会话
+"""
+
+import sys
+
+from unittest.mock import patch
+
+import pytest
+
+from viby.tools.shell_session import ShellSession
+
+pytestmark = pytest.mark.skipif(
+    sys.platform.startswith("win"), reason="需要POSIX shell"
+)
+
+
+@pytest.fixture(autouse=True)
+def mock_logger():
+    """模拟日志记录器，避免其他测试残留的日志处理器影响"""
+    with patch("viby.tools.shell_session.logger") as logger:
+        yield logger
+
+
+@pytest.fixture
+def session():
+    """创建一个使用/bin/sh的持久化会话"""
+    shell_session = ShellSession("/bin/sh")
+    yield shell_session
+    shell_session.close()
+
+
+def test_is_supported():
+    """测试shell支持检测"""
+    assert ShellSession.is_supported("/bin/bash") is True
+    assert ShellSession.is_supported("/usr/bin/fish") is False
+    assert ShellSession.is_supported(None) is False
+
+
+def test_run_captures_output_and_exit_code(session):
+    """测试获取输出和返回码"""
+    result = session.run("echo out; echo err 1>&2; false", echo=False)
+
+    assert result.returncode == 1
+    assert result.stdout == "out\n"
+    assert result.stderr == "err\n"
+
+
+def test_output_without_trailing_newline(session):
+    """测试没有结尾换行的输出"""
+    result = session.run("printf abc", echo=False)
+
+    assert result.returncode == 0
+    assert result.stdout == "abc"
+
+
+def test_state_preserved_between_commands(session, tmp_path):
+    """测试工作目录和环境变量在命令之间保留"""
+    session.run(f"cd '{tmp_path}' && export VIBY_TEST_VAR=kept", echo=False)
+    result = session.run('pwd; echo "$VIBY_TEST_VAR"', echo=False)
+
+    assert result.stdout.splitlines() == [str(tmp_path), "kept"]
+    assert session.cwd == str(tmp_path)
+
+
+def test_quotes_in_command(session):
+    """测试命令中的引号"""
+    result = session.run("echo \"it's\" 'a test'", echo=False)
+
+    assert result.stdout == "it's a test\n"
+
+
+def test_restart_after_exit(session, tmp_path):
+    """测试shell退出后自动重启并恢复工作目录"""
+    session.run(f"cd '{tmp_path}'", echo=False)
+    result = session.run("exit 7", echo=False)
+
+    assert result.returncode == 7
+    assert session.is_alive is False
+
+    result = session.run("pwd", echo=False)
+    assert result.returncode == 0
+    assert result.stdout.strip() == str(tmp_path)
+
+
+def test_timeout_restarts_shell(session):
+    """测试超时后结束shell并在下次执行时重启"""
+    result = session.run("sleep 30", echo=False, timeout=0.3)
+
+    assert result.timed_out is True
+    assert session.is_alive is False
+
+    result = session.run("echo again", echo=False)
+    assert result.stdout == "again\n"
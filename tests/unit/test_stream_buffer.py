@@ -0,0 +1,67 @@
+"""
+测试流式回复的共享缓冲区
+"""
+
+import threading
+import time
+
+import pytest
+
+from viby.utils.stream import StreamBuffer
+
+
+def _source(buffer, chunks, delay=0.0):
+    """模拟把增量写入缓冲区的模型响应"""
+    for chunk in chunks:
+        buffer.append(chunk)
+        if delay:
+            time.sleep(delay)
+        yield chunk
+
+
+def test_frames_coalesce_deltas():
+    """测试同一帧内到达的增量被合并"""
+    buffer = StreamBuffer()
+    chunks = [f"{i} " for i in range(200)]
+    buffer.start(_source(buffer, chunks, delay=0.001))
+
+    frames = list(buffer.frames(interval=0.05))
+
+    assert "".join(frames) == "".join(chunks)
+    assert len(frames) < len(chunks) / 4
+    assert buffer.getvalue() == "".join(chunks)
+    assert buffer.closed is True
+
+
+def test_frames_raise_producer_error():
+    """测试生产者的异常在读取完剩余内容后抛出"""
+
+    def _failing(buffer):
+        buffer.append("partial")
+        yield
+        raise RuntimeError("boom")
+
+    buffer = StreamBuffer()
+    buffer.start(_failing(buffer))
+    frames = buffer.frames(interval=0)
+
+    assert next(frames) == "partial"
+    with pytest.raises(RuntimeError, match="boom"):
+        list(frames)
+
+
+def test_cancel_stops_frames_and_producer():
+    """测试取消后读取立即结束，生产者停止消费"""
+    cancel_event = threading.Event()
+    buffer = StreamBuffer(cancel_event=cancel_event)
+    thread = buffer.start(_source(buffer, ["x"] * 1000, delay=0.01))
+
+    threading.Timer(0.1, cancel_event.set).start()
+    start = time.monotonic()
+    list(buffer.frames())
+    thread.join(timeout=1)
+
+    assert time.monotonic() - start < 1
+    assert buffer.cancelled is True
+    assert not thread.is_alive()
+    assert len(buffer) < 1000
@@ -1,12 +1,21 @@
+import shutil
 import unittest
 import tempfile
+from pathlib import Path
 from unittest.mock import patch, MagicMock
+import numpy as np
 import requests
 
 from viby.viby_tool_search.client import search_similar_tools
 from viby.viby_tool_search.utils import get_mcp_tools_from_cache
 from viby.tools.tool_retrieval import execute_tool_retrieval
 from viby.viby_tool_search.common import DEFAULT_PORT
+from viby.viby_tool_search.ann_index import IVFIndex
+from viby.viby_tool_search.embedding_manager import (
+    benchmark,
+    normalize_rows,
+    top_k_similar,
+)
 
 
 class TestToolRetrieval(unittest.TestCase):
@@ -20,16 +29,16 @@ class TestToolRetrieval(unittest.TestCase):
         patcher = patch("viby.tools.tool_retrieval.get_text")
         self.mock_get_text = patcher.start()
         # 让get_text返回第三个参数（默认文本）或空字符串
-        self.mock_get_text.side_effect = (
-            lambda group, key, *args: args[0] if args else ""
+        self.mock_get_text.side_effect = lambda group, key, *args: (
+            args[0] if args else ""
         )
         self.addCleanup(patcher.stop)
 
         # 模拟内部函数中的get_text
         patcher2 = patch("viby.locale.get_text")
         self.mock_locale_get_text = patcher2.start()
-        self.mock_locale_get_text.side_effect = (
-            lambda group, key, *args: args[0] if args else ""
+        self.mock_locale_get_text.side_effect = lambda group, key, *args: (
+            args[0] if args else ""
         )
         self.addCleanup(patcher2.stop)
 
@@ -58,8 +67,8 @@ class TestToolRetrieval(unittest.TestCase):
             mock_logger.handlers = [mock_handler]
 
             # 让get_text返回第三个参数或空字符串
-            mock_get_text.side_effect = (
-                lambda group, key, *args: args[0] if args else ""
+            mock_get_text.side_effect = lambda group, key, *args: (
+                args[0] if args else ""
             )
 
             # 模拟config的get_embedding_config方法
@@ -288,3 +297,259 @@ class TestToolRetrieval(unittest.TestCase):
         self.assertIsInstance(result, list)
         self.assertEqual(result, mock_result)
         mock_search.assert_called_with("测试查询", 2)
+
+
+class TestEmbeddingSearch(unittest.TestCase):
+    """测试基于归一化矩阵的工具检索"""
+
+    def setUp(self):
+        from viby.viby_tool_search.embedding_manager import EmbeddingManager
+
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        # 模拟logger，避免其他测试残留的日志处理器影响
+        patcher = patch("viby.viby_tool_search.embedding_manager.logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.manager = EmbeddingManager(cache_dir=self.temp_dir)
+
+    def test_top_k_similar_matches_full_sort(self):
+        """测试 argpartition 选出的结果与完整排序一致"""
+        rng = np.random.default_rng(1)
+        vectors = rng.standard_normal((500, 32)).astype(np.float32)
+        query = rng.standard_normal(32).astype(np.float32) * 3
+
+        indices, scores = top_k_similar(normalize_rows(vectors), query, 7)
+
+        expected = (vectors @ query) / (
+            np.linalg.norm(vectors, axis=1) * np.linalg.norm(query)
+        )
+        self.assertEqual(list(indices), list(np.argsort(expected)[::-1][:7]))
+        np.testing.assert_allclose(scores, expected[indices], rtol=1e-5)
+
+    def test_top_k_similar_bounds(self):
+        """测试 top_k 超过工具数量或为 0 时的结果"""
+        matrix = normalize_rows(np.eye(3, dtype=np.float32))
+        indices, scores = top_k_similar(matrix, np.array([0, 2, 1], np.float32), 10)
+        self.assertEqual(list(indices), [1, 2, 0])
+        self.assertEqual(len(top_k_similar(matrix, np.ones(3, np.float32), 0)[0]), 0)
+
+    def test_search_groups_by_server(self):
+        """测试检索结果按服务器分组并按相似度排序"""
+        self.manager.tool_embeddings = {
+            "read_file": np.array([1.0, 0.0], np.float32),
+            "write_file": np.array([0.0, 2.0], np.float32),
+            "fetch": np.array([3.0, 3.0], np.float32),
+        }
+        self.manager.tool_info = {
+            name: {"definition": {"description": name, "server_name": server}}
+            for name, server in (
+                ("read_file", "fs"),
+                ("write_file", "fs"),
+                ("fetch", "web"),
+            )
+        }
+        self.manager._build_matrix()
+        self.manager.model = MagicMock()
+        self.manager.model.encode.return_value = np.array([0.0, 5.0], np.float32)
+
+        results = self.manager.search_similar_tools("写文件", top_k=2)
+
+        self.assertEqual(
+            {
+                server: [tool.name for tool in tools]
+                for server, tools in results.items()
+            },
+            {"fs": ["write_file"], "web": ["fetch"]},
+        )
+
+    def test_search_stays_fast_with_many_tools(self):
+        """测试上万个工具时单次检索仍在毫秒级"""
+        self.assertLess(benchmark(tool_count=10000, iterations=20), 0.002)
+
+
+def _clustered_embeddings(count, dim=32, seed=0):
+    """生成按主题聚集的工具向量"""
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((20, dim)).astype(np.float32)
+    vectors = topics[rng.integers(0, len(topics), count)]
+    vectors = vectors + 0.1 * rng.standard_normal((count, dim)).astype(np.float32)
+    return {f"tool_{i}": vector for i, vector in enumerate(vectors)}
+
+
+class TestIVFIndex(unittest.TestCase):
+    """测试工具检索的 IVF 近似最近邻索引"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        self.path = Path(self.temp_dir) / "index.npz"
+        patcher = patch("viby.viby_tool_search.ann_index.logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_search_recall(self):
+        """测试 IVF 检索结果与精确检索基本一致"""
+        embeddings = _clustered_embeddings(2000)
+        index = IVFIndex(self.path, "model", nprobe=8)
+        self.assertTrue(index.sync(embeddings))
+
+        names = list(embeddings)
+        matrix = normalize_rows(np.stack(list(embeddings.values())))
+        hits = 0
+        for query in list(embeddings.values())[:50]:
+            expected = {names[i] for i in top_k_similar(matrix, query, 5)[0]}
+            found, scores = index.search(query, 5)
+            self.assertEqual(list(scores), sorted(scores, reverse=True))
+            hits += len(expected & set(found))
+        self.assertGreaterEqual(hits / 250, 0.9)
+
+    def test_incremental_insert_and_delete(self):
+        """测试工具目录变化时增量插入和删除，不重新训练"""
+        embeddings = _clustered_embeddings(500)
+        index = IVFIndex(self.path, "model")
+        index.sync(embeddings)
+        centroids = index.centroids
+
+        del embeddings["tool_0"]
+        embeddings["new_tool"] = embeddings["tool_1"] * 2
+        self.assertTrue(index.sync(embeddings))
+        self.assertIs(index.centroids, centroids)
+        self.assertEqual(len(index), 500)
+
+        found, _ = index.search(embeddings["tool_1"], 2)
+        self.assertEqual(set(found), {"tool_1", "new_tool"})
+        self.assertNotIn("tool_0", index.search(embeddings["tool_2"], 500)[0])
+        self.assertFalse(index.sync(embeddings))
+
+    def test_persisted_build_is_reused(self):
+        """测试保存的索引在下次加载时复用，模型变化时重新训练"""
+        embeddings = _clustered_embeddings(500)
+        index = IVFIndex(self.path, "model")
+        index.sync(embeddings)
+        index.save()
+
+        loaded = IVFIndex(self.path, "model")
+        with patch("viby.viby_tool_search.ann_index.train_centroids") as train:
+            self.assertFalse(loaded.sync(embeddings))
+            train.assert_not_called()
+        np.testing.assert_array_equal(loaded.centroids, index.centroids)
+        self.assertEqual(loaded._where, index._where)
+
+        retrained = IVFIndex(self.path, "other-model")
+        self.assertTrue(retrained.sync(embeddings))
+
+    def test_manager_uses_index_above_threshold(self):
+        """测试工具数量达到阈值时才使用近似索引"""
+        from viby.viby_tool_search.embedding_manager import EmbeddingManager
+
+        with patch("viby.viby_tool_search.embedding_manager.logger"):
+            manager = EmbeddingManager(cache_dir=self.temp_dir)
+        manager.embedding_config = {"ann_index": True, "ann_min_tools": 300}
+        manager.tool_embeddings = _clustered_embeddings(200)
+        manager._build_matrix()
+        manager._sync_ann_index()
+        self.assertIsNone(manager.ann_index)
+
+        manager.tool_embeddings = _clustered_embeddings(400)
+        manager._build_matrix()
+        manager._sync_ann_index()
+        self.assertEqual(len(manager.ann_index), 400)
+        self.assertTrue(manager.ann_index_file.exists())
+
+
+class TestIncrementalEmbeddingUpdate(unittest.TestCase):
+    """测试按工具文本哈希增量更新嵌入"""
+
+    def setUp(self):
+        from viby.viby_tool_search.embedding_manager import Tool
+
+        self.Tool = Tool
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+        patcher = patch("viby.viby_tool_search.embedding_manager.logger")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("viby.viby_tool_search.embedding_manager.get_text")
+        self.mock_get_text = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_get_text.side_effect = lambda group, key, *args: (
+            args[0] if args else ""
+        )
+
+        self.encoded = []
+
+        def encode(texts, **kwargs):
+            self.encoded.extend(texts)
+            return np.array([[len(text), 1.0] for text in texts], np.float32)
+
+        self.model = MagicMock()
+        self.model.encode.side_effect = encode
+        self.manager = self._new_manager()
+
+    def _new_manager(self, model_name="model-a"):
+        from viby.viby_tool_search.embedding_manager import EmbeddingManager
+
+        manager = EmbeddingManager(cache_dir=self.temp_dir)
+        manager.embedding_config = {"model_name": model_name}
+        manager.model = self.model
+        return manager
+
+    def _tools(self, **descriptions):
+        return {
+            "server": [
+                self.Tool(name=name, description=description, inputSchema={})
+                for name, description in descriptions.items()
+            ]
+        }
+
+    def test_only_new_or_changed_tools_are_encoded(self):
+        """测试只为新增或描述变化的工具生成嵌入，已移除的工具被丢弃"""
+        self.assertTrue(
+            self.manager.update_tool_embeddings(
+                self._tools(a="读取", b="写入", c="删除")
+            )
+        )
+        self.assertEqual(len(self.encoded), 3)
+        reused = self.manager.tool_embeddings["a"]
+
+        self.encoded.clear()
+        self.manager.update_tool_embeddings(
+            self._tools(a="读取", b="写入文件", d="新工具")
+        )
+        self.assertEqual(len(self.encoded), 2)
+        self.assertTrue(any("写入文件" in text for text in self.encoded))
+        self.assertEqual(list(self.manager.tool_embeddings), ["a", "b", "d"])
+        self.assertIs(self.manager.tool_embeddings["a"], reused)
+        self.assertEqual(self.manager._names, ["a", "b", "d"])
+
+    def test_hashes_persist_and_include_model_name(self):
+        """测试哈希随缓存保存，模型变化时全部重新生成"""
+        self.manager.update_tool_embeddings(self._tools(a="读取", b="写入"))
+
+        self.encoded.clear()
+        reloaded = self._new_manager()
+        reloaded.update_tool_embeddings(self._tools(a="读取", b="写入"))
+        self.assertEqual(self.encoded, [])
+
+        other_model = self._new_manager("model-b")
+        other_model.update_tool_embeddings(self._tools(a="读取", b="写入"))
+        self.assertEqual(len(self.encoded), 2)
+
+    def test_update_with_real_locale_texts(self):
+        """测试使用真实的语言文件时更新日志能正常格式化"""
+        from types import SimpleNamespace
+
+        from viby.locale import TextManager, get_text
+
+        self.mock_get_text.side_effect = get_text
+        for language in ("en-US", "zh-CN"):
+            with (
+                patch(
+                    "viby.locale.text_manager",
+                    TextManager(SimpleNamespace(language=language)),
+                ),
+            ):
+                self.assertTrue(
+                    self._new_manager().update_tool_embeddings(self._tools(a=language))
+                )
@@ -0,0 +1,127 @@
+"""
+测试增量流式 Markdown 渲染
+"""
+
+import io
+import re
+
+from unittest.mock import patch
+
+from rich.console import Console
+from rich.markdown import Markdown
+
+from viby.utils import ui
+from viby.utils.ui import (
+    LatexStreamProcessor,
+    MarkdownBlockSplitter,
+    _prepare_markdown,
+    _process_latex_tokens,
+    render_markdown_stream,
+)
+
+SAMPLE = """# Title
+
+Para with [link](http://x.y) and $x^2$.
+
+1. first
+
+2. second
+    continued
+
+```python
+def f():
+
+    return 1
+```
+
+| a | b |
+|---|---|
+| 1 | 2 |
+
+Final para.
+"""
+
+
+def _feed_all(text, size):
+    """按固定大小分块喂给切分器，返回所有完成的块和剩余文本"""
+    splitter = MarkdownBlockSplitter()
+    blocks = []
+    for i in range(0, len(text), size):
+        block = splitter.feed(text[i : i + size])
+        if block:
+            blocks.append(block)
+    return blocks, splitter.flush()
+
+
+def _console():
+    return Console(file=io.StringIO(), width=80, height=40, force_terminal=True)
+
+
+def test_splitter_finalizes_blocks_once():
+    """测试完成的块只返回一次，拼接后与原文一致"""
+    for size in (1, 3, 7, len(SAMPLE)):
+        blocks, remaining = _feed_all(SAMPLE, size)
+        assert "".join(blocks) + remaining == SAMPLE
+        assert remaining == "Final para.\n"
+
+
+def test_splitter_keeps_fences_and_loose_lists_together():
+    """测试围栏代码块和松散列表中的空行不会切分块"""
+    blocks, _ = _feed_all(SAMPLE, 1)
+
+    assert blocks[2] == "1. first\n\n2. second\n    continued\n\n"
+    assert blocks[3].startswith("```python\ndef f():\n\n    return 1\n```")
+
+
+def test_splitter_pending_is_only_trailing_block():
+    """测试尾部块只包含最后一个未完成的块"""
+    splitter = MarkdownBlockSplitter()
+    splitter.feed("first block\n\nsecond")
+
+    # 最后一行尚未结束，不能确定是否开始了新块
+    assert splitter.pending == "first block\n\nsecond"
+    assert splitter.feed(" block\n\nthird") == "first block\n\n"
+    assert splitter.pending == "second block\n\nthird"
+
+
+def test_render_matches_full_document():
+    """测试增量渲染的最终输出与整篇渲染一致"""
+    expected_console = _console()
+    expected_console.print(Markdown(_prepare_markdown(SAMPLE, True)))
+
+    console = _console()
+    chunks = [SAMPLE[i : i + 5] for i in range(0, len(SAMPLE), 5)]
+    # 只比较打印在动态区域上方的内容
+    with patch("viby.utils.ui.Live") as mock_live:
+        result = render_markdown_stream(iter(chunks), console_instance=console)
+
+    def _strip_link_ids(output):
+        return re.sub(r"id=\d+", "", output)
+
+    assert result == _prepare_markdown(SAMPLE, True)
+    assert mock_live.return_value.__enter__.return_value.update.called
+    assert _strip_link_ids(console.file.getvalue()) == _strip_link_ids(
+        expected_console.file.getvalue()
+    )
+
+
+def test_latex_processor_matches_full_conversion():
+    """测试增量公式转换与整段转换结果一致"""
+    text = "E $E=mc^2$, $$\\frac{a}{b}$$ then $$x$ y$$ and $\\alpha"
+    processor = LatexStreamProcessor()
+    for end in range(1, len(text) + 1):
+        assert processor.process(text[:end]) == _process_latex_tokens(text[:end])
+
+
+def test_latex_conversion_is_memoized():
+    """测试相同公式只转换一次"""
+    ui._convert_math.cache_clear()
+    converter = ui._get_math_converter()
+    text = "$x^2$ " * 50
+    with patch.object(converter, "convert", wraps=converter.convert) as convert:
+        processor = LatexStreamProcessor()
+        for end in range(1, len(text) + 1):
+            processor.process(text[:end])
+        _process_latex_tokens(text)
+
+    assert convert.call_count == 1
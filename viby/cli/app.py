@@ -5,14 +5,20 @@ viby 命令行界面 - 使用 Typer 框架重构
 
 import importlib
 import sys
-from typing import Dict, List, Type, Any
+from typing import Dict, List, Optional, Type, Any
 import typer
 from viby.locale import get_text, init_text_manager
 from viby.config import config
 from viby.utils.logging import setup_logging
-from viby.utils.ui import show_info, show_success, show_error, show_warning
+from viby.utils.lazy_import import lazy_function
+from viby.utils.output import OUTPUT_MODES, resolve_output_mode
 from viby.utils.keyboard_shortcuts import install_shortcuts, detect_shell
 
+# 界面函数依赖 rich，延迟到首次调用时导入，raw/json 输出模式下不会加载
+show_info = lazy_function("viby.utils.ui", "show_info")
+show_success = lazy_function("viby.utils.ui", "show_success")
+show_error = lazy_function("viby.utils.ui", "show_error")
+show_warning = lazy_function("viby.utils.ui", "show_warning")
 
 # ---------------------------------------------------------
 # 1) 预处理 argv：把默认未指定的情况映射到 vibe ---------
@@ -246,6 +252,12 @@ def main(
     tokens: bool = typer.Option(
         False, "--tokens", "-k", help=get_text("GENERAL", "tokens_help")
     ),
+    output: Optional[str] = typer.Option(
+        None,
+        "--output",
+        "-o",
+        help=get_text("GENERAL", "output_help", "|".join(OUTPUT_MODES)),
+    ),
 ):
     """Viby - 智能命令行助手"""
     # 本地化帮助选项
@@ -264,11 +276,18 @@ def main(
         run_config_wizard(config)
         init_text_manager(config)  # 如果语言等配置更改，重新初始化
 
+    # 未指定输出模式时，stdout 不是终端则直接输出原始文本
+    try:
+        output_mode = resolve_output_mode(output)
+    except ValueError as e:
+        raise typer.BadParameter(str(e), param_hint="--output")
+
     # 保存选项到上下文，以便在命令中使用
     ctx.obj = {
         "think": think,
         "fast": fast,
         "tokens": tokens,
+        "output": output_mode,
     }
     # 如果没有指定子命令，则打印帮助并退出
     if ctx.invoked_subcommand is None:
@@ -292,7 +311,7 @@ def vibe(ctx: typer.Context, prompt_args: List[str] = typer.Argument(None)):
     model_manager = load_model_manager(ctx.obj)
 
     Vibe = get_command_class("vibe")
-    vibe = Vibe(model_manager)
+    vibe = Vibe(model_manager, output_mode=ctx.obj.get("output"))
 
     # 执行命令
     return vibe.vibe(user_input)
@@ -399,10 +418,18 @@ def sessions_show(
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    before_id: int = typer.Option(
+        None, "--before-id", help=get_text("SESSIONS", "before_id_help")
+    ),
+    follow: bool = typer.Option(
+        False, "--follow", "-f", help=get_text("SESSIONS", "follow_help")
+    ),
 ):
     """显示会话的历史记录。"""
     SessionsCommand = get_command_class("sessions")
-    code = SessionsCommand().show_history(limit, session)
+    code = SessionsCommand().show_history(
+        limit, session, before_id=before_id, follow=follow
+    )
     raise typer.Exit(code=code)
 
 
@@ -415,10 +442,13 @@ def sessions_search(
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    semantic: bool = typer.Option(
+        False, "--semantic", help=get_text("SESSIONS", "semantic_help")
+    ),
 ):
     """搜索会话中的历史记录。"""
     SessionsCommand = get_command_class("sessions")
-    code = SessionsCommand().search_history(query, limit, session)
+    code = SessionsCommand().search_history(query, limit, session, semantic=semantic)
     raise typer.Exit(code=code)
 
 
@@ -426,15 +456,36 @@ def sessions_search(
 def sessions_export(
     file: str = typer.Argument(..., help=get_text("SESSIONS", "file_help")),
     format_type: str = typer.Option(
-        "json", "--format", "-f", help=get_text("SESSIONS", "format_help")
+        None, "--format", "-f", help=get_text("SESSIONS", "format_help")
     ),
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    all_sessions: bool = typer.Option(
+        False, "--all", "-a", help=get_text("SESSIONS", "export_all_help")
+    ),
 ):
     """导出会话历史记录到文件。"""
     SessionsCommand = get_command_class("sessions")
-    code = SessionsCommand().export_history(file, format_type, session)
+    code = SessionsCommand().export_history(
+        file, format_type, session, all_sessions=all_sessions
+    )
+    raise typer.Exit(code=code)
+
+
+@sessions_app.command("import")
+def sessions_import(
+    file: str = typer.Argument(..., help=get_text("SESSIONS", "import_file_help")),
+    format_type: str = typer.Option(
+        None, "--format", "-f", help=get_text("SESSIONS", "import_format_help")
+    ),
+    session: str = typer.Option(
+        None, "--session", "-s", help=get_text("SESSIONS", "import_session_help")
+    ),
+):
+    """从导出文件导入会话历史记录。"""
+    SessionsCommand = get_command_class("sessions")
+    code = SessionsCommand().import_history(file, format_type, session)
     raise typer.Exit(code=code)
 
 
@@ -450,6 +501,35 @@ def sessions_clear(
     raise typer.Exit(code=code)
 
 
+@sessions_app.command("reindex")
+def sessions_reindex():
+    """重建全文搜索索引，用于已有数据库或修改分词器后。"""
+    SessionsCommand = get_command_class("sessions")
+    code = SessionsCommand().rebuild_search_index()
+    raise typer.Exit(code=code)
+
+
+@sessions_app.command("gc")
+def sessions_gc(
+    days: int = typer.Option(
+        None, "--days", "-d", help=get_text("SESSIONS", "gc_days_help")
+    ),
+    max_rows: int = typer.Option(
+        None, "--max-rows", help=get_text("SESSIONS", "gc_max_rows_help")
+    ),
+    max_bytes: int = typer.Option(
+        None, "--max-bytes", help=get_text("SESSIONS", "gc_max_bytes_help")
+    ),
+    archive: bool = typer.Option(
+        None, "--archive/--no-archive", help=get_text("SESSIONS", "gc_archive_help")
+    ),
+):
+    """按保留策略清理历史记录，归档删除的记录并回收数据库空间。"""
+    SessionsCommand = get_command_class("sessions")
+    code = SessionsCommand().gc(days, max_rows, max_bytes, archive)
+    raise typer.Exit(code=code)
+
+
 # Tools 命令组
 @tools_app.command("list")
 def tools_list():
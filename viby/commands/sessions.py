@@ -3,17 +3,23 @@
 """
 
 import os
+import time
 from datetime import datetime
 from rich.table import Table
 from rich.console import Console
 from rich.prompt import Confirm, Prompt
 from rich.progress import Progress
+from rich.text import Text
 
-from viby.utils.history import SessionManager
+from viby.utils.history import SNIPPET_END, SNIPPET_START, SessionManager
 from viby.utils.ui import print_markdown
 from viby.locale import get_text
 import typer
 
+# 持续显示新记录时查询数据库的间隔（秒）和每次读取的最大记录数
+FOLLOW_INTERVAL = 1.0
+FOLLOW_BATCH_SIZE = 100
+
 
 class SessionsCommand:
     """
@@ -27,7 +33,10 @@ class SessionsCommand:
     - show - 显示会话历史记录
     - search - 搜索会话历史记录
     - export - 导出会话历史记录
+    - import - 导入会话历史记录
     - clear - 清除会话历史记录
+    - reindex - 重建全文搜索索引
+    - gc - 按保留策略清理历史记录并回收空间
     """
 
     def __init__(self):
@@ -39,6 +48,16 @@ class SessionsCommand:
         """截断文本，超过长度限制的部分用省略号表示"""
         return text if len(text) <= limit else text[: limit - 3] + "..."
 
+    def _highlight(self, snippet: str) -> Text:
+        """将搜索摘要中标记的匹配词高亮显示"""
+        text = Text()
+        for i, part in enumerate(snippet.split(SNIPPET_START)):
+            match, _, rest = part.partition(SNIPPET_END) if i else ("", "", part)
+            if match:
+                text.append(match, style="bold red")
+            text.append(rest)
+        return text
+
     def _format_records(
         self, records, title: str, content_limit: int, response_limit: int = None
     ) -> None:
@@ -57,7 +76,11 @@ class SessionsCommand:
             dt = datetime.fromisoformat(record["timestamp"])
             formatted_time = dt.strftime("%Y-%m-%d %H:%M:%S")
             content = self._truncate(record["content"], content_limit)
-            response = self._truncate(record.get("response", ""), response_limit)
+            # 搜索结果显示匹配位置附近的高亮摘要
+            if record.get("snippet"):
+                response = self._highlight(record["snippet"])
+            else:
+                response = self._truncate(record.get("response") or "", response_limit)
             table.add_row(
                 str(record["id"]), formatted_time, record["type"], content, response
             )
@@ -323,21 +346,38 @@ class SessionsCommand:
             print_markdown(get_text("SESSIONS", "session_delete_failed"), "error")
             return 1
 
-    def show_history(self, limit: int = 10, session_id: str = None) -> int:
+    def show_history(
+        self,
+        limit: int = 10,
+        session_id: str = None,
+        before_id: int = None,
+        follow: bool = False,
+    ) -> int:
         """
         显示会话历史记录
 
         Args:
             limit: 显示的最大记录数量
             session_id: 指定会话ID，默认为当前活跃会话
+            before_id: 只显示早于该记录的记录，用于翻页
+            follow: 显示后继续等待并显示新增的记录
 
         Returns:
             命令退出码
         """
-        records = self.session_manager.get_history(limit=limit, session_id=session_id)
+        content_limit = 256
+        # 只读取显示所需的开头部分，多读一个字符用于判断是否需要省略号
+        records = self.session_manager.get_history(
+            limit=limit,
+            session_id=session_id,
+            before_id=before_id,
+            preview_chars=content_limit + 1,
+        )
 
         if not records:
             print_markdown(get_text("SESSIONS", "no_history"), "")
+            if follow:
+                return self._follow_history(session_id, 0, content_limit)
             return 0
 
         # 获取会话名称
@@ -351,11 +391,56 @@ class SessionsCommand:
             # 从第一条记录获取会话名称
             title = f"{get_text('SESSIONS', 'recent_history')} - {records[0].get('session_name', '默认会话')}"
 
-        self._format_records(records, title, content_limit=256)
+        self._format_records(records, title, content_limit=content_limit)
+        if follow:
+            return self._follow_history(
+                session_id, max(record["id"] for record in records), content_limit
+            )
+        if len(records) == limit:
+            print_markdown(
+                get_text("SESSIONS", "more_history").format(records[-1]["id"]), ""
+            )
         return 0
 
+    def _follow_history(self, session_id: str, last_id: int, content_limit: int) -> int:
+        """每隔 FOLLOW_INTERVAL 秒显示 ID 大于 last_id 的新记录，直到按下 Ctrl+C"""
+        # 固定会话，避免其他进程切换活跃会话后显示另一个会话的记录
+        session_id = session_id or self.session_manager.get_active_session_id()
+        self.console.print(get_text("SESSIONS", "following_history"), style="dim")
+        try:
+            while True:
+                time.sleep(FOLLOW_INTERVAL)
+                records = self.session_manager.get_history(
+                    limit=FOLLOW_BATCH_SIZE,
+                    session_id=session_id,
+                    after_id=last_id,
+                    preview_chars=content_limit + 1,
+                )
+                for record in records:
+                    self._print_record_line(record, content_limit)
+                    last_id = record["id"]
+        except KeyboardInterrupt:
+            return 0
+
+    def _print_record_line(self, record, content_limit: int) -> None:
+        """把一条记录显示为一行，用于持续显示新记录"""
+        dt = datetime.fromisoformat(record["timestamp"])
+        line = Text()
+        line.append(f"{record['id']} ", style="cyan")
+        line.append(dt.strftime("%Y-%m-%d %H:%M:%S") + " ", style="green")
+        line.append(self._truncate(record["content"], content_limit))
+        response = self._truncate(record.get("response") or "", content_limit)
+        if response:
+            line.append(" → ")
+            line.append(response, style="yellow")
+        self.console.print(line)
+
     def search_history(
-        self, query: str, limit: int = 10, session_id: str = None
+        self,
+        query: str,
+        limit: int = 10,
+        session_id: str = None,
+        semantic: bool = False,
     ) -> int:
         """
         搜索会话历史记录
@@ -364,6 +449,7 @@ class SessionsCommand:
             query: 搜索关键词
             limit: 显示的最大记录数量
             session_id: 指定会话ID，默认为当前活跃会话
+            semantic: 是否使用嵌入模型按语义搜索
 
         Returns:
             命令退出码
@@ -372,9 +458,22 @@ class SessionsCommand:
             print_markdown(get_text("SESSIONS", "search_term_required"), "error")
             return 1
 
-        records = self.session_manager.get_history(
-            limit=limit, search_query=query, session_id=session_id
-        )
+        if semantic:
+            # 首次搜索需要为已有历史记录生成向量，可能需要一些时间
+            with self.console.status(get_text("SESSIONS", "indexing_history")):
+                records = self.session_manager.semantic_search(
+                    query, limit=limit, session_id=session_id
+                )
+            if records is None:
+                print_markdown(get_text("SESSIONS", "semantic_unavailable"), "error")
+                return 1
+        else:
+            records = self.session_manager.get_history(
+                limit=limit,
+                search_query=query,
+                session_id=session_id,
+                preview_chars=51,
+            )
 
         if not records:
             print_markdown(
@@ -399,16 +498,18 @@ class SessionsCommand:
     def export_history(
         self,
         file_path: str,
-        format_type: str = "json",
+        format_type: str = None,
         session_id: str = None,
+        all_sessions: bool = False,
     ) -> int:
         """
         导出会话历史记录到文件
 
         Args:
-            file_path: 导出文件路径
-            format_type: 导出格式（json, csv, yaml）
+            file_path: 导出文件路径，以 .gz 或 .zst 结尾时压缩输出
+            format_type: 导出格式（json, jsonl, csv, yaml），默认根据扩展名推断
             session_id: 指定会话ID，默认为当前活跃会话
+            all_sessions: 导出所有会话
 
         Returns:
             命令退出码
@@ -436,25 +537,32 @@ class SessionsCommand:
                 print_markdown(get_text("SESSIONS", "export_cancelled"), "")
                 return 0
 
+        # 获取会话名称和记录总数，记录数由触发器维护，无需扫描历史表
+        sessions = self.session_manager.get_sessions()
+        if all_sessions:
+            session_name = get_text("SESSIONS", "all_sessions")
+            total = sum(s.get("interaction_count", 0) for s in sessions)
+        else:
+            target_id = session_id or self.session_manager.get_active_session_id()
+            session = next((s for s in sessions if s["id"] == target_id), None)
+            session_name = session["name"] if session else "未知会话"
+            total = session.get("interaction_count", 0) if session else 0
+
         # 显示导出进度
         with Progress() as progress:
-            task = progress.add_task(get_text("SESSIONS", "exporting_history"), total=1)
-
-            # 获取会话名称
-            session_name = "当前会话"
-            if session_id:
-                sessions = self.session_manager.get_sessions()
-                session_name = next(
-                    (s["name"] for s in sessions if s["id"] == session_id), "未知会话"
-                )
+            task = progress.add_task(
+                get_text("SESSIONS", "exporting_history"), total=total or None
+            )
 
             # 导出历史记录
             success = self.session_manager.export_history(
-                file_path, format_type, session_id
+                file_path,
+                format_type,
+                session_id,
+                all_sessions=all_sessions,
+                progress_callback=lambda count: progress.advance(task, count),
             )
 
-            progress.update(task, completed=1)
-
         if success:
             print_markdown(
                 get_text("SESSIONS", "export_successful").format(
@@ -467,6 +575,61 @@ class SessionsCommand:
             print_markdown(get_text("SESSIONS", "export_failed"), "error")
             return 1
 
+    def import_history(
+        self, file_path: str, format_type: str = None, session_id: str = None
+    ) -> int:
+        """
+        从导出文件导入会话历史记录
+
+        Args:
+            file_path: 导入文件路径（json, jsonl, csv，可以是 .gz 或 .zst 压缩文件）
+            format_type: 文件格式，默认根据扩展名推断
+            session_id: 导入到指定会话，默认保留记录原来的会话
+
+        Returns:
+            命令退出码
+        """
+        if not os.path.isfile(file_path):
+            print_markdown(
+                get_text("SESSIONS", "import_file_not_found").format(file_path),
+                "error",
+            )
+            return 1
+
+        # 显示导入进度，记录总数未知，只显示已处理的记录数
+        with Progress() as progress:
+            task = progress.add_task(
+                get_text("SESSIONS", "importing_history").format(0), total=None
+            )
+
+            processed = 0
+
+            def _advance(count: int) -> None:
+                nonlocal processed
+                processed += count
+                progress.update(
+                    task,
+                    advance=count,
+                    description=get_text("SESSIONS", "importing_history").format(
+                        processed
+                    ),
+                )
+
+            stats = self.session_manager.import_history(
+                file_path, format_type, session_id, progress_callback=_advance
+            )
+
+        if stats is None:
+            print_markdown(get_text("SESSIONS", "import_failed"), "error")
+            return 1
+        print_markdown(
+            get_text("SESSIONS", "import_successful").format(
+                stats["imported"], stats["skipped"], stats["sessions"]
+            ),
+            "success",
+        )
+        return 0
+
     def clear_history(self, session_id: str = None) -> int:
         """
         清除会话历史记录
@@ -512,6 +675,82 @@ class SessionsCommand:
             print_markdown(get_text("SESSIONS", "clear_failed"), "error")
             return 1
 
+    def rebuild_search_index(self) -> int:
+        """
+        重建全文搜索索引
+
+        Returns:
+            命令退出码
+        """
+        with Progress() as progress:
+            task = progress.add_task(get_text("SESSIONS", "reindexing"), total=1)
+            success = self.session_manager.rebuild_search_index()
+            progress.update(task, completed=1)
+
+        if success:
+            print_markdown(get_text("SESSIONS", "reindex_successful"), "success")
+            return 0
+        print_markdown(get_text("SESSIONS", "reindex_failed"), "error")
+        return 1
+
+    @staticmethod
+    def _format_size(size: int) -> str:
+        """把字节数格式化为便于阅读的大小"""
+        for unit in ("B", "KB", "MB", "GB"):
+            if size < 1024 or unit == "GB":
+                return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+            size /= 1024
+
+    def gc(
+        self,
+        max_age_days: int = None,
+        max_rows: int = None,
+        max_bytes: int = None,
+        archive: bool = None,
+    ) -> int:
+        """
+        按保留策略清理历史记录并回收数据库空间，未指定的参数使用配置中的保留策略
+
+        Args:
+            max_age_days: 删除早于该天数的记录
+            max_rows: 每个会话最多保留的记录数
+            max_bytes: 每个会话的记录最多占用的字节数
+            archive: 删除前是否归档
+
+        Returns:
+            命令退出码
+        """
+        size_before = self.session_manager.get_storage_size()
+        with Progress() as progress:
+            task = progress.add_task(get_text("SESSIONS", "gc_running"), total=None)
+            result = self.session_manager.apply_retention(
+                max_age_days,
+                max_rows,
+                max_bytes,
+                archive,
+                progress_callback=lambda count: progress.advance(task, count),
+            )
+            compacted = result is not None and self.session_manager.compact_database()
+
+        if not compacted:
+            print_markdown(get_text("SESSIONS", "gc_failed"), "error")
+            return 1
+
+        size_after = self.session_manager.get_storage_size()
+        print_markdown(
+            get_text("SESSIONS", "gc_successful").format(
+                result["deleted"],
+                self._format_size(max(size_before - size_after, 0)),
+                self._format_size(size_after),
+            ),
+            "success",
+        )
+        if result["archive"]:
+            print_markdown(
+                get_text("SESSIONS", "gc_archived").format(result["archive"]), ""
+            )
+        return 0
+
 
 app = typer.Typer(
     help=get_text("SESSIONS", "sessions_help"),
@@ -583,9 +822,17 @@ def cli_show(
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    before_id: int = typer.Option(
+        None, "--before-id", help=get_text("SESSIONS", "before_id_help")
+    ),
+    follow: bool = typer.Option(
+        False, "--follow", "-f", help=get_text("SESSIONS", "follow_help")
+    ),
 ):
     """显示会话的历史记录。"""
-    code = SessionsCommand().show_history(limit, session)
+    code = SessionsCommand().show_history(
+        limit, session, before_id=before_id, follow=follow
+    )
     raise typer.Exit(code=code)
 
 
@@ -598,9 +845,12 @@ def cli_search(
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    semantic: bool = typer.Option(
+        False, "--semantic", help=get_text("SESSIONS", "semantic_help")
+    ),
 ):
     """搜索会话中的历史记录。"""
-    code = SessionsCommand().search_history(query, limit, session)
+    code = SessionsCommand().search_history(query, limit, session, semantic=semantic)
     raise typer.Exit(code=code)
 
 
@@ -608,14 +858,34 @@ def cli_search(
 def cli_export(
     file: str = typer.Argument(..., help=get_text("SESSIONS", "file_help")),
     format_type: str = typer.Option(
-        "json", "--format", "-f", help=get_text("SESSIONS", "format_help")
+        None, "--format", "-f", help=get_text("SESSIONS", "format_help")
     ),
     session: str = typer.Option(
         None, "--session", "-s", help=get_text("SESSIONS", "session_id_help")
     ),
+    all_sessions: bool = typer.Option(
+        False, "--all", "-a", help=get_text("SESSIONS", "export_all_help")
+    ),
 ):
     """导出会话历史记录到文件。"""
-    code = SessionsCommand().export_history(file, format_type, session)
+    code = SessionsCommand().export_history(
+        file, format_type, session, all_sessions=all_sessions
+    )
+    raise typer.Exit(code=code)
+
+
+@app.command("import")
+def cli_import(
+    file: str = typer.Argument(..., help=get_text("SESSIONS", "import_file_help")),
+    format_type: str = typer.Option(
+        None, "--format", "-f", help=get_text("SESSIONS", "import_format_help")
+    ),
+    session: str = typer.Option(
+        None, "--session", "-s", help=get_text("SESSIONS", "import_session_help")
+    ),
+):
+    """从导出文件导入会话历史记录。"""
+    code = SessionsCommand().import_history(file, format_type, session)
     raise typer.Exit(code=code)
 
 
@@ -628,3 +898,30 @@ def cli_clear(
     """清除会话历史记录。"""
     code = SessionsCommand().clear_history(session)
     raise typer.Exit(code=code)
+
+
+@app.command("reindex")
+def cli_reindex():
+    """重建全文搜索索引。"""
+    code = SessionsCommand().rebuild_search_index()
+    raise typer.Exit(code=code)
+
+
+@app.command("gc")
+def cli_gc(
+    days: int = typer.Option(
+        None, "--days", "-d", help=get_text("SESSIONS", "gc_days_help")
+    ),
+    max_rows: int = typer.Option(
+        None, "--max-rows", help=get_text("SESSIONS", "gc_max_rows_help")
+    ),
+    max_bytes: int = typer.Option(
+        None, "--max-bytes", help=get_text("SESSIONS", "gc_max_bytes_help")
+    ),
+    archive: bool = typer.Option(
+        None, "--archive/--no-archive", help=get_text("SESSIONS", "gc_archive_help")
+    ),
+):
+    """按保留策略清理历史记录并回收数据库空间。"""
+    code = SessionsCommand().gc(days, max_rows, max_bytes, archive)
+    raise typer.Exit(code=code)
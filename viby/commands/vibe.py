@@ -3,15 +3,20 @@ from viby.llm.nodes.prompt_node import PromptNode
 from viby.llm.nodes.execute_tool_node import ExecuteToolNode
 from viby.llm.nodes.llm_node import LLMNode
 from viby.llm.nodes.dummy_node import DummyNode
+from viby.tools.shell_session import close_shell_session
+from viby.utils.output import OUTPUT_RICH, OutputWriter
 from pocketflow import Flow
+from contextlib import redirect_stdout
+import sys
 
 
 class Vibe:
     """单次提问命令，用于向 AI 发送单个问题并获取回答"""
 
-    def __init__(self, model_manager: ModelManager):
+    def __init__(self, model_manager: ModelManager, output_mode: str = OUTPUT_RICH):
         """初始化单次提问命令流程"""
         self.model_manager = model_manager
+        self.output_mode = output_mode or OUTPUT_RICH
         self.llm_node = LLMNode()
         self.prompt_node = PromptNode()
         self.execute_tool_node = ExecuteToolNode()
@@ -32,6 +37,24 @@ class Vibe:
             "messages": [],
         }
 
-        self.flow.run(shared)
+        if self.output_mode == OUTPUT_RICH:
+            try:
+                self.flow.run(shared)
+            finally:
+                # 保存本轮的完整消息，结束本次运行使用的持久化shell会话
+                self.model_manager.record_turn_messages(shared["messages"])
+                close_shell_session()
+            return 0
+
+        # 非交互输出模式：stdout 只输出模型回复，工具调用等其他信息写到 stderr
+        output_writer = OutputWriter(self.output_mode, sys.stdout)
+        shared["output_writer"] = output_writer
+        try:
+            with redirect_stdout(sys.stderr):
+                self.flow.run(shared)
+        finally:
+            self.model_manager.record_turn_messages(shared["messages"])
+            close_shell_session()
+        output_writer.finish()
 
         return 0
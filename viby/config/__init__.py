@@ -3,7 +3,10 @@ viby 配置包
 """
 
 from viby.config.app_config import Config
-from viby.config.wizard import run_config_wizard
+from viby.utils.lazy_import import lazy_function
+
+# 配置向导依赖 rich 和 prompt_toolkit，只在真正运行时才导入
+run_config_wizard = lazy_function("viby.config.wizard", "run_config_wizard")
 
 config = Config.get_instance()
 
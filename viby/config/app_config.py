@@ -6,8 +6,41 @@ import os
 import yaml
 import platform
 from pathlib import Path
-from typing import Dict, Any, Optional, ClassVar
-from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, ClassVar
+from dataclasses import dataclass, field
+
+_TRUE_STRINGS = {"true", "yes", "on", "1"}
+_FALSE_STRINGS = {"false", "no", "off", "0"}
+
+
+def _coerce_value(value: Any, default: Any) -> Any:
+    """
+    把配置文件中的值转换为默认值的类型
+
+    Raises:
+        ValueError: 值无法转换
+        TypeError: 值的类型不匹配
+    """
+    if isinstance(default, bool):
+        # bool("false") 为 True，字符串需要按内容解析
+        if isinstance(value, str):
+            text = value.strip().lower()
+            if text in _TRUE_STRINGS:
+                return True
+            if text in _FALSE_STRINGS:
+                return False
+            raise ValueError("应为布尔值")
+        if isinstance(value, (int, float)):
+            return bool(value)
+        raise TypeError("应为布尔值")
+    if isinstance(default, list):
+        # 只有一条规则时允许直接写字符串
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, list):
+            return list(value)
+        raise TypeError("应为列表")
+    return type(default)(value)
 
 
 @dataclass
@@ -25,6 +58,11 @@ class EmbeddingModelConfig:
     """嵌入模型配置类"""
 
     model_name: str = "paraphrase-multilingual-MiniLM-L12-v2"  # 默认嵌入模型
+    # 工具数量不少于 ann_min_tools 时使用 IVF 近似最近邻索引检索，更少时精确检索
+    ann_index: bool = False
+    ann_min_tools: int = 5000
+    ann_nlist: int = 0  # 聚类数，0 表示按工具数量的平方根选择，修改后重新训练索引
+    ann_nprobe: int = 8  # 每次查询扫描的聚类数，越大召回率越高、延迟越高
 
 
 @dataclass
@@ -36,6 +74,47 @@ class AutoCompactConfig:
     keep_last_exchanges: int = 1  # 保留的最近对话轮数
 
 
+@dataclass
+class ShellConfig:
+    """Shell命令执行配置类"""
+
+    timeout: int = 600  # 命令最长运行时间（秒），0表示不限制
+    output_head_bytes: int = 16384  # 返回给LLM的输出保留开头字节数
+    output_tail_bytes: int = 16384  # 返回给LLM的输出保留结尾字节数
+    persistent_session: bool = False  # 在一次运行中复用同一个shell进程
+    cpu_seconds: int = 0  # 单个进程最多使用的CPU时间（秒），0表示不限制
+    memory_mb: int = 0  # 单个进程最大地址空间（MB），0表示不限制
+    max_output_bytes: int = 0  # 命令最多输出的字节数，超过后终止，0表示不限制
+    nice: int = 0  # 命令的nice增量
+    ionice_class: int = 0  # I/O调度类别（仅Linux）：0不修改，1实时，2尽力而为，3空闲
+    ionice_level: int = 4  # I/O优先级（0-7，仅对类别1和2有效）
+    # yolo模式命令策略的用户规则（正则表达式，匹配管道中的每一段命令），拒绝规则优先
+    allow_rules: List[str] = field(default_factory=list)
+    deny_rules: List[str] = field(default_factory=list)
+
+
+@dataclass
+class HistoryConfig:
+    """历史记录数据库配置类"""
+
+    busy_timeout_ms: int = 5000  # 数据库被其他进程锁定时的最长等待时间（毫秒）
+    busy_retries: int = 5  # 等待超时后重试开始写事务的次数，间隔按指数增长
+    # 全文索引分词器：unicode61 按空白和标点分词；trigram 按三字切分，适合中文等不以空格分词的语言
+    # 修改后需要运行 yb sessions reindex 重建索引
+    fts_tokenizer: str = "unicode61"
+    # 保留策略，由 yb sessions gc 执行，0 表示不限制
+    retention_days: int = 0  # 删除早于该天数的交互记录
+    max_rows_per_session: int = 0  # 每个会话最多保留的交互记录数
+    max_bytes_per_session: int = 0  # 每个会话的交互记录最多占用的字节数
+    # 删除前把记录归档为压缩的 JSONL 文件，可以用 yb sessions import 恢复
+    archive_on_gc: bool = True
+    # 不小于该字节数的回复按内容哈希单独压缩保存，相同内容只保存一份，0 表示不启用
+    blob_threshold: int = 4096
+    blob_codec: str = "zlib"  # 压缩编码：zlib 或 zstd（需要 zstandard 包）
+    # 交互记录由后台线程批量写入，队列已满时同步写入，0 表示总是同步写入
+    write_queue_size: int = 1024
+
+
 class Config:
     """viby 应用的配置管理器 (单例模式)"""
 
@@ -74,6 +153,12 @@ class Config:
         # 嵌入模型配置
         self.embedding: EmbeddingModelConfig = EmbeddingModelConfig()
 
+        # Shell命令执行配置
+        self.shell: ShellConfig = ShellConfig()
+
+        # 历史记录数据库配置
+        self.history: HistoryConfig = HistoryConfig()
+
         # 模型配置
         self.default_model: ModelProfileConfig = ModelProfileConfig(name="qwen3:30b")
         self.think_model: Optional[ModelProfileConfig] = ModelProfileConfig(
@@ -112,7 +197,14 @@ class Config:
         if hasattr(obj, "__dict__"):
             # 对ModelProfileConfig和AutoCompactConfig，保留所有字段，即使是None
             if isinstance(
-                obj, (ModelProfileConfig, AutoCompactConfig, EmbeddingModelConfig)
+                obj,
+                (
+                    ModelProfileConfig,
+                    AutoCompactConfig,
+                    EmbeddingModelConfig,
+                    ShellConfig,
+                    HistoryConfig,
+                ),
             ):
                 return {k: self._to_dict(v) for k, v in obj.__dict__.items()}
             else:
@@ -125,6 +217,21 @@ class Config:
             return [self._to_dict(i) for i in obj]
         return obj
 
+    def _load_section(self, section: str, data: Dict[str, Any]) -> None:
+        """按字段默认值的类型加载一节配置，未设置或无效的字段保留原值"""
+        section_config = getattr(self, section)
+        for field_name, default in vars(section_config).items():
+            value = data.get(field_name)
+            if value is None:
+                continue
+            try:
+                setattr(section_config, field_name, _coerce_value(value, default))
+            except (TypeError, ValueError) as e:
+                print(
+                    f"警告: 配置项 {section}.{field_name} 的值 {value!r} 无效: {e}。"
+                    f"使用默认值 {default!r}。"
+                )
+
     def load_config(self) -> None:
         """从YAML文件加载配置"""
         try:
@@ -183,12 +290,11 @@ class Config:
                         "keep_last_exchanges", self.autocompact.keep_last_exchanges
                     )
 
-                # 加载嵌入模型配置
-                embedding_data = config_data.get("embedding")
-                if embedding_data and isinstance(embedding_data, dict):
-                    self.embedding.model_name = embedding_data.get(
-                        "model_name", self.embedding.model_name
-                    )
+                # 加载嵌入模型、Shell执行和历史记录数据库配置
+                for section in ("embedding", "shell", "history"):
+                    section_data = config_data.get(section)
+                    if section_data and isinstance(section_data, dict):
+                        self._load_section(section, section_data)
 
                 # 加载全局设置
                 self.api_timeout = int(config_data.get("api_timeout", self.api_timeout))
@@ -233,6 +339,8 @@ class Config:
             else None,
             "autocompact": self._to_dict(self.autocompact),
             "embedding": self._to_dict(self.embedding),
+            "shell": self._to_dict(self.shell),
+            "history": self._to_dict(self.history),
             "api_timeout": self.api_timeout,
             "language": self.language,
             "enable_mcp": self.enable_mcp,
@@ -293,6 +401,4 @@ class Config:
 
     def get_embedding_config(self) -> Dict[str, Any]:
         """获取嵌入模型配置"""
-        return {
-            "model_name": self.embedding.model_name,
-        }
+        return dict(vars(self.embedding))
@@ -3,6 +3,7 @@
 """
 
 from typing import Dict, Any, List, Tuple
+import json
 import re
 
 # 导入配置单例
@@ -59,6 +60,21 @@ class CompactionManager:
         )
         return int(tokens) + self.PADDING
 
+    def estimate_message_tokens(self, message: Dict[str, Any]) -> int:
+        """
+        估算单条消息的token数，包括工具调用参数和每条消息的格式开销
+
+        Args:
+            message: 消息
+
+        Returns:
+            估算的token数量
+        """
+        tokens = self._estimate_token_count(message.get("content") or "")
+        if message.get("tool_calls"):
+            tokens += self._estimate_token_count(json.dumps(message["tool_calls"]))
+        return tokens + self.MESSAGE_OVERHEAD
+
     def _count_tokens_in_messages(self, messages: List[Dict[str, Any]]) -> int:
         """
         计算消息列表中的总token数
@@ -5,8 +5,12 @@ Model management for viby - handles interactions with LLM providers
 from typing import Dict, Any, List, Optional, Tuple
 from viby.config import config
 from viby.locale import get_text
-from viby.utils.history import SessionManager
+from viby.utils.history import SessionManager, close_tool_calls
+from viby.utils.history_recorder import PendingRecord, get_recorder
 from viby.utils.logging import get_logger
+from viby.utils.output import STRUCTURED_OUTPUT_MODES
+from viby.utils.stream import StreamBuffer
+from viby.utils.cancel import CancellationToken
 from viby.llm.compaction import CompactionManager
 from viby.llm.client import create_openai_client
 import time
@@ -90,11 +94,15 @@ class ModelManager:
         args = args or {}
         self.use_think_model = args.get("think", False)
         self.use_fast_model = args.get("fast", False)
-        self.track_tokens = args.get("tokens", False)
+        # json/ndjson 输出模式需要 token 用量，但以结构化记录输出而不是追加到回复文本
+        self.structured_output = args.get("output") in STRUCTURED_OUTPUT_MODES
+        self.track_tokens = args.get("tokens", False) or self.structured_output
         self.token_tracker = TokenTracker() if self.track_tokens else None
 
         # 历史记录和会话管理
         self.session_manager = SessionManager()
+        # 交互记录由后台线程写入，不阻塞回复和工具调用
+        self.history_recorder = get_recorder(self.session_manager)
         self.compaction_manager = CompactionManager()
 
         # 当前交互状态
@@ -102,14 +110,23 @@ class ModelManager:
         self.interaction_id = None
         self.interaction_recorded = False
         self.last_user_message_ref = None
-        self.last_interaction_id = None
-
-    def get_response(self, messages):
+        self.last_interaction: Optional[PendingRecord] = None
+        # 本轮对话开始时压缩历史得到的摘要消息
+        self.compaction_summary: Optional[Dict[str, Any]] = None
+
+    def get_response(
+        self,
+        messages,
+        buffer: Optional[StreamBuffer] = None,
+        cancel_token: Optional[CancellationToken] = None,
+    ):
         """
         获取模型回复
 
         Args:
             messages: 消息历史
+            buffer: 可选的共享缓冲区，回复文本会追加到其中
+            cancel_token: 可选的取消令牌，取消时立即关闭与模型服务的 HTTP 连接
 
         Returns:
             生成器，返回文本块
@@ -122,10 +139,12 @@ class ModelManager:
         prepared_messages, user_input = self._prepare_messages(messages, model_config)
 
         # 调用LLM并返回生成器
-        response_generator = self._call_llm(prepared_messages, model_config)
+        response_generator = self._call_llm(
+            prepared_messages, model_config, cancel_token
+        )
 
         # 创建包装生成器来记录历史
-        return self._wrap_response_with_history(response_generator, user_input)
+        return self._wrap_response_with_history(response_generator, user_input, buffer)
 
     def _determine_model_type(self) -> str:
         """确定要使用的模型类型"""
@@ -160,25 +179,34 @@ class ModelManager:
                     self.current_user_input = user_input
                     self.interaction_id = int(time.time() * 1000)
                     self.interaction_recorded = False
+                    self.compaction_summary = None
 
                     # 应用消息压缩
-                    messages, _ = self.compaction_manager.compact_messages(
+                    compacted, stats = self.compaction_manager.compact_messages(
                         messages, model_config
                     )
+                    if stats.get("compressed"):
+                        # 压缩结果中新生成的消息即为摘要，与本轮消息一起保存
+                        self.compaction_summary = next(
+                            (m for m in compacted if all(m is not o for o in messages)),
+                            None,
+                        )
+                    messages = compacted
 
         return messages, user_input
 
-    def _wrap_response_with_history(self, generator, user_input):
+    def _wrap_response_with_history(self, generator, user_input, buffer=None):
         """包装响应生成器以记录历史记录"""
-        full_response = ""
+        # 回复只保存在一个追加缓冲区中，调用方传入时与其共享
+        buffer = buffer if buffer is not None else StreamBuffer()
 
         # 遍历并收集响应
         for chunk in generator:
-            full_response += chunk
+            buffer.append(chunk)
             yield chunk
 
         # 处理历史记录
-        self._update_history(full_response, user_input)
+        self._update_history(buffer.getvalue(), user_input)
 
     def _update_history(self, full_response, user_input=None):
         """更新交互历史记录"""
@@ -189,54 +217,77 @@ class ModelManager:
             and self.interaction_id
         ):
             # 记录新交互
-            self.last_interaction_id = self.session_manager.add_interaction(
+            self.last_interaction = self.history_recorder.record_interaction(
                 self.current_user_input,
                 full_response,
                 metadata={"interaction_id": self.interaction_id},
             )
             self.interaction_recorded = True
         # 如果是同一交互的后续调用，追加到已有记录
-        elif (
-            self.interaction_recorded
-            and self.last_interaction_id
-            and self.last_interaction_id > 0
-        ):
-            # 获取上一条交互记录
-            history = self.session_manager.get_history(limit=1)
-            if history and len(history) > 0:
-                # 追加新内容
-                previous_response = history[0].get("response", "")
-                updated_response = previous_response + "\n\n" + full_response
-                # 更新记录
-                self.session_manager.update_interaction(
-                    self.last_interaction_id, updated_response
-                )
+        elif self.interaction_recorded and self.last_interaction:
+            # 作为新段落追加，不重写已有回复
+            self.history_recorder.append_segment(self.last_interaction, full_response)
 
     def update_last_interaction(self, additional_content):
-        """更新最后一次交互的响应内容"""
-        if not self.last_interaction_id or self.last_interaction_id <= 0:
+        """向最后一次交互追加响应内容"""
+        if not self.last_interaction:
             return False
 
-        # 获取上一次交互的回复内容
-        history = self.session_manager.get_history(limit=1)
-        if not history or len(history) == 0:
-            return False
+        return self.history_recorder.append_segment(
+            self.last_interaction, additional_content
+        )
+
+    def record_turn_messages(self, messages: List[Dict[str, Any]]) -> bool:
+        """
+        保存本轮对话中从用户输入开始的完整消息，包括工具调用和工具结果
 
-        # 准备更新内容
-        previous_response = history[0].get("response", "")
-        updated_response = previous_response
-        if updated_response and not updated_response.endswith("\n\n"):
-            updated_response += "\n\n"
-        updated_response += additional_content
+        下一轮对话据此按原样重建上下文，不需要从问答文本中推断。
 
-        # 更新交互记录
-        return self.session_manager.update_interaction(
-            self.last_interaction_id, updated_response
+        Args:
+            messages: 本轮对话的消息列表（与传给 get_response 的是同一个列表）
+        """
+        if not self.interaction_recorded or not self.last_interaction:
+            return False
+        start = next(
+            (i for i, m in enumerate(messages) if m is self.last_user_message_ref),
+            None,
         )
+        if start is None:
+            return False
 
-    def _call_llm(self, messages, model_config: Dict[str, Any]):
+        # 工具执行前被中断时补上工具结果，保存的消息可以直接用作下一轮的上下文
+        turn = close_tool_calls(messages[start:])
+        if self.compaction_summary is not None:
+            turn = [dict(self.compaction_summary, compacted=True)] + turn
+        records = []
+        for message in turn:
+            record = {
+                key: message[key]
+                for key in (
+                    "role",
+                    "content",
+                    "tool_calls",
+                    "tool_call_id",
+                    "compacted",
+                )
+                if message.get(key) is not None
+            }
+            record["token_count"] = self.compaction_manager.estimate_message_tokens(
+                message
+            )
+            records.append(record)
+        return self.history_recorder.record_messages(self.last_interaction, records)
+
+    def _call_llm(
+        self,
+        messages,
+        model_config: Dict[str, Any],
+        cancel_token: Optional[CancellationToken] = None,
+    ):
         """
         调用LLM并返回流式响应
+
+        取消时关闭客户端和响应流，服务端随即停止生成，不再等待下一个数据块
         """
         model = model_config["model"]
 
@@ -248,22 +299,43 @@ class ModelManager:
         # 准备API客户端和请求参数
         client = self._create_api_client(model_config)
         params = self._prepare_api_parameters(messages, model_config)
+        if cancel_token is not None and cancel_token.is_set():
+            return
+
+        # 请求尚未返回时取消，关闭客户端中止连接
+        remove_callbacks = []
+        if cancel_token is not None:
+            remove_callbacks.append(cancel_token.add_callback(client.close))
 
+        stream = None
         try:
             # 创建流式处理
             stream = client.chat.completions.create(**params)
+            if cancel_token is not None:
+                remove_callbacks.append(cancel_token.add_callback(stream.close))
 
             # 处理响应
             yield from self._process_stream_response(stream)
 
         except Exception as e:
+            # 主动取消导致的连接错误不是真正的错误
+            if cancel_token is not None and cancel_token.is_set():
+                logger.debug(f"模型请求已取消: {e}")
+                return
+
             # 处理错误
             yield f"Error: {str(e)}"
 
             # 显示token跟踪信息（如果启用）
-            if self.track_tokens:
+            if self.track_tokens and not self.structured_output:
                 yield "\n\n"
                 yield get_text("GENERAL", "token_usage_not_available")
+        finally:
+            for remove in remove_callbacks:
+                remove()
+            # 提前结束（例如生成器被关闭）时也释放连接，避免服务端继续生成
+            if stream is not None:
+                stream.close()
 
     def _create_api_client(self, model_config):
         """创建API客户端"""
@@ -338,7 +410,7 @@ class ModelManager:
             yield get_text("GENERAL", "llm_empty_response")
 
         # 添加token统计信息
-        if self.track_tokens:
+        if self.track_tokens and not self.structured_output:
             yield "\n\n"
             for stat_line in self.token_tracker.get_formatted_stats():
                 yield stat_line + "\n"
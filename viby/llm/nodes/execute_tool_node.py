@@ -1,8 +1,11 @@
 from pocketflow import Node
-from viby.mcp import call_tool
 from viby.locale import get_text
-from viby.utils.ui import print_markdown
+from viby.utils.lazy_import import lazy_function
 from viby.tools import AVAILABLE_TOOLS, TOOL_EXECUTORS
+from viby.utils.cancel import cancel_on_interrupt
+
+print_markdown = lazy_function("viby.utils.ui", "print_markdown")
+call_tool = lazy_function("viby.mcp", "call_tool")
 
 
 class ExecuteToolNode(Node):
@@ -46,8 +49,14 @@ class ExecuteToolNode(Node):
             if selected_server == "viby":
                 return self._execute_viby_tool(tool_name, parameters)
             else:
-                # 使用MCP工具调用
-                return call_tool(tool_name, selected_server, parameters)
+                # 使用MCP工具调用，Ctrl+C 取消正在进行的调用
+                with cancel_on_interrupt() as cancel_token:
+                    return call_tool(
+                        tool_name,
+                        selected_server,
+                        parameters,
+                        cancel_token=cancel_token,
+                    )
         except Exception as e:
             return self._handle_execution_error(e)
 
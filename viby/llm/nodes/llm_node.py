@@ -1,7 +1,9 @@
 from pocketflow import Node
-from viby.utils.ui import render_markdown_stream
+from viby.utils.cancel import CancellationToken
+from viby.utils.stream import StreamBuffer
 from viby.locale import get_text
 import threading
+import os
 import sys
 import select
 import platform
@@ -14,8 +16,8 @@ class LLMNode(Node):
 
     def prep(self, shared):
         """准备模型调用所需的参数"""
-        # 创建中断事件和监听线程
-        interrupt_event = threading.Event()
+        # 创建取消令牌和监听线程
+        interrupt_event = CancellationToken()
         listener_thread = self._create_interrupt_listener(interrupt_event)
 
         # 运行监听线程
@@ -29,54 +31,60 @@ class LLMNode(Node):
             "tools": shared.get("tools", []),
             "interrupt_event": interrupt_event,
             "listener_thread": listener_thread,
+            "output_writer": shared.get("output_writer"),
         }
 
-    def _create_interrupt_listener(self, event):
-        """创建监听中断的线程"""
+    def _create_interrupt_listener(self, token):
+        """创建监听中断的线程，用户按下回车时取消当前模型调用"""
 
-        def _listen_for_interrupt(event):
+        def _wait_for_enter(stream):
+            # 通过自管道唤醒 select：令牌被取消（包括清理监听线程）时立即返回，无需轮询
+            wake_read, wake_write = os.pipe()
+            remove_callback = token.add_callback(lambda: os.write(wake_write, b"x"))
+            try:
+                ready = select.select([stream, wake_read], [], [])[0]
+                if stream in ready:
+                    stream.readline()
+                    token.cancel()
+            finally:
+                remove_callback()
+                os.close(wake_read)
+                os.close(wake_write)
+
+        def _listen_for_interrupt(token):
             try:
                 # 根据平台和环境选择合适的监听方式
-                if sys.stdin.isatty():
-                    # 标准输入是终端，直接监听标准输入
-                    while not event.is_set():
-                        if select.select([sys.stdin], [], [], 0.1)[0]:
-                            sys.stdin.readline()
-                            event.set()
-                            break
-                elif platform.system() != "Windows":
-                    # 非 Windows 系统，尝试打开 TTY 设备
-                    try:
-                        with open("/dev/tty", "r") as tty:
-                            while not event.is_set():
-                                if select.select([tty], [], [], 0.1)[0]:
-                                    tty.readline()
-                                    event.set()
-                                    break
-                    except (OSError, IOError):
-                        # 无法打开 TTY 设备，不进行监听
-                        pass
-                else:
-                    # Windows 系统，尝试使用 msvcrt
+                if platform.system() == "Windows":
+                    # Windows 控制台不支持 select，使用 msvcrt 检查按键
                     try:
                         import msvcrt
-                        import time
 
-                        while not event.is_set():
+                        while not token.is_set():
                             if msvcrt.kbhit():
                                 char = msvcrt.getch()
                                 if char in (b"\r", b"\n", b" "):
-                                    event.set()
+                                    token.cancel()
                                     break
-                            time.sleep(0.1)
+                            token.wait(0.1)
                     except ImportError:
                         pass
+                elif sys.stdin.isatty():
+                    # 标准输入是终端，直接监听标准输入
+                    _wait_for_enter(sys.stdin)
+                else:
+                    # 标准输入被重定向，尝试打开 TTY 设备
+                    try:
+                        with open("/dev/tty", "r") as tty:
+                            _wait_for_enter(tty)
+                    except (OSError, IOError):
+                        # 无法打开 TTY 设备，不进行监听
+                        pass
             except Exception:
                 # 捕获所有异常，确保线程不会崩溃
                 pass
 
         return threading.Thread(
-            target=_listen_for_interrupt, args=(event,), daemon=True
+            target=_listen_for_interrupt, args=(token,), daemon=True
         )
 
     def exec(self, prep_res):
@@ -88,28 +96,47 @@ class LLMNode(Node):
         if not manager or not messages:
             return {"text_content": "", "was_interrupted": False}
 
-        # 收集文本块和中断状态
-        chunks = []
-        was_interrupted = False
+        output_writer = prep_res.get("output_writer")
+        if output_writer is not None:
+            return self._write_output(prep_res, output_writer)
 
-        def _stream_response():
-            nonlocal was_interrupted
-            for text in manager.get_response(messages):
-                if interrupt_event and interrupt_event.is_set():
-                    was_interrupted = True
-                    break
-                if text:
-                    chunks.append(text)
-                    yield text
+        # 只有终端渲染才需要 rich，raw/json 输出模式下不导入
+        from viby.utils.ui import render_markdown_stream
+
+        # 后台线程消费模型响应并写入共享缓冲区，渲染端按帧读取
+        buffer = StreamBuffer(cancel_event=interrupt_event)
+        buffer.start(
+            manager.get_response(messages, buffer=buffer, cancel_token=interrupt_event)
+        )
+        render_markdown_stream(buffer)
 
-        # 渲染流式响应
-        render_markdown_stream(_stream_response())
+        return {
+            "text_content": buffer.getvalue(),
+            "interrupt_event": interrupt_event,
+            "listener_thread": prep_res.get("listener_thread"),
+            "was_interrupted": buffer.cancelled,
+        }
+
+    def _write_output(self, prep_res, output_writer):
+        """非交互输出模式：每个增量直接写到 stdout，不做任何渲染"""
+        manager = prep_res.get("model_manager")
+        interrupt_event = prep_res.get("interrupt_event")
+
+        buffer = StreamBuffer(cancel_event=interrupt_event)
+        response = manager.get_response(
+            prep_res.get("messages"), buffer=buffer, cancel_token=interrupt_event
+        )
+        for text in response:
+            if buffer.cancelled:
+                break
+            output_writer.write(text)
+        output_writer.end_call(getattr(manager, "token_tracker", None))
 
         return {
-            "text_content": "".join(chunks),
+            "text_content": buffer.getvalue(),
             "interrupt_event": interrupt_event,
             "listener_thread": prep_res.get("listener_thread"),
-            "was_interrupted": was_interrupted,
+            "was_interrupted": buffer.cancelled,
         }
 
     def exec_fallback(self, prep_res, exc):
@@ -1,13 +1,17 @@
 from pocketflow import Node
 from viby.locale import get_text
-from viby.mcp import list_tools
 from viby.viby_tool_search.utils import get_mcp_tools_from_cache
 from viby.config import Config
 from viby.tools import AVAILABLE_TOOLS
 from viby.utils.history import SessionManager
+from viby.utils.history_recorder import flush_all
+from viby.utils.lazy_import import lazy_function
 import platform
 import os
 
+# MCP 客户端依赖较重（fastmcp 会导入 rich），只在启用 MCP 时才导入
+list_tools = lazy_function("viby.mcp", "list_tools")
+
 
 class PromptNode(Node):
     """
@@ -117,30 +121,15 @@ class PromptNode(Node):
             print(get_text("MCP", "tools_error", e))
             return {}
 
-    def _get_recent_history(self, max_rounds=5):
-        """获取最近的对话历史"""
+    def _get_recent_history(self, max_turns=3):
+        """获取最近 max_turns 次交互的完整消息，包括工具调用和（截断后的）工具结果"""
         try:
-            # 初始化会话管理器
+            # 初始化会话管理器，并等待后台写入完成以读到上一轮的记录
             session_manager = SessionManager()
+            flush_all()
 
-            # 获取当前活跃会话的历史记录
-            history = session_manager.get_history(limit=max_rounds)
-
-            # 转换为消息格式
-            messages = []
-            for item in reversed(history):  # 从最旧的开始处理
-                if item.get("content"):
-                    messages.append({"role": "user", "content": item.get("content")})
-                    if item.get("response"):
-                        messages.append(
-                            {"role": "assistant", "content": item.get("response")}
-                        )
-
-            # 限制轮次数量
-            if len(messages) > max_rounds:
-                messages = messages[-max_rounds:]
-
-            return messages
+            # 获取当前活跃会话最近几次交互的消息
+            return session_manager.get_recent_messages(max_turns=max_turns)
         except Exception as e:
             print(f"获取历史对话失败: {e}")
             return []
@@ -176,8 +165,8 @@ class PromptNode(Node):
         # 初始化消息历史，首先是系统提示
         messages = [{"role": "system", "content": system_prompt}]
 
-        # 获取前三轮对话历史并添加到消息中
-        previous_messages = self._get_recent_history(max_rounds=3)
+        # 获取最近三次交互的消息并添加到消息中
+        previous_messages = self._get_recent_history(max_turns=3)
         if previous_messages:
             messages.extend(previous_messages)
 
@@ -1,5 +1,6 @@
 # viby/mcp/client.py
 import asyncio
+import concurrent.futures
 import os
 import threading
 import atexit
@@ -10,6 +11,7 @@ from typing import Any, Dict, List, Literal, Optional, TypedDict, Union
 
 from fastmcp import Client
 from viby.mcp.config import get_server_config
+from viby.utils.cancel import CancellationToken
 
 
 # --- Global Async Event Loop Manager ---
@@ -64,7 +66,14 @@ def get_persistent_loop() -> asyncio.AbstractEventLoop:
     return _persistent_loop
 
 
-def _run_coroutine_in_persistent_loop(coro):
+def _run_coroutine_in_persistent_loop(
+    coro, cancel_token: Optional[CancellationToken] = None, timeout: float = 60
+):
+    """
+    在持久事件循环中运行协程并等待结果
+
+    超时、取消令牌被取消或等待期间按下 Ctrl+C 时，都会取消事件循环中的任务
+    """
     loop = get_persistent_loop()
     if threading.current_thread() == _async_loop_thread:
         # 不允许从事件循环自己的线程调用，这会导致死锁
@@ -73,14 +82,18 @@ def _run_coroutine_in_persistent_loop(coro):
         )
 
     future = asyncio.run_coroutine_threadsafe(coro, loop)
+    # 取消 future 会同时取消事件循环中对应的任务
+    remove_callback = (
+        cancel_token.add_callback(future.cancel) if cancel_token is not None else None
+    )
     try:
-        return future.result(timeout=60)  # Add a reasonable timeout
-    except asyncio.TimeoutError:
-        # 超时后取消任务
+        return future.result(timeout=timeout)
+    except (concurrent.futures.TimeoutError, KeyboardInterrupt):
         future.cancel()
         raise
-    except Exception:
-        raise
+    finally:
+        if remove_callback:
+            remove_callback()
 
 
 def _shutdown_persistent_loop():
@@ -367,15 +380,23 @@ def call_tool(
     tool_name: str,
     server_name: str,
     arguments: Optional[Dict[str, Any]] = None,
+    cancel_token: Optional[CancellationToken] = None,
 ) -> Dict[str, Any]:
-    """同步调用工具，必须指定服务器"""
+    """同步调用工具，必须指定服务器；取消或按下 Ctrl+C 时中止调用"""
 
     async def _coro():
         client = await _get_or_create_global_mcp_client_async()
         return await client.call_tool(server_name, tool_name, arguments or {})
 
     try:
-        return _run_coroutine_in_persistent_loop(_coro())
+        return _run_coroutine_in_persistent_loop(_coro(), cancel_token)
+    except (concurrent.futures.CancelledError, KeyboardInterrupt):
+        # 与shell命令一致，Ctrl+C 只中止当前工具调用，不中断整个对话
+        return {
+            "is_error": True,
+            "cancelled": True,
+            "content": [{"type": "text", "text": "Tool call cancelled"}],
+        }
     except Exception as e:
         print(f"Error in call_tool '{tool_name}' on '{server_name}': {e}")
         return {
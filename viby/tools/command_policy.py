@@ -0,0 +1,421 @@
+"""
+Shell命令安全策略引擎
+
+yolo模式下判断命令能否自动执行。命令先用shlex切分，再按管道、&&、||、;、子shell等拆分成
+独立的执行单元，if、for、while 等复合命令的保留字以及 timeout、xargs 等包装命令连同其选项
+和选项参数被跳过；命令替换 $(...)、反引号和 sh -c 中的脚本会被递归展开，重定向目标单独作为
+一个单元检查。所有规则（用户拒绝规则、用户允许规则、内置拒绝规则）按优先级编译成一个组合
+正则，每个单元只需匹配一次；编译结果按配置文件的修改时间缓存。
+
+运行 ``python -m viby.tools.command_policy`` 可以查看不同规则数量下的单次检查耗时。
+"""
+
+import os
+import re
+import shlex
+import time
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Pattern, Sequence, Tuple
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+VERDICT_ALLOW = "allow"
+VERDICT_DENY = "deny"
+
+# 匹配命令名，允许带路径（如 /bin/rm）
+_CMD = r"^(?:\S*/)?"
+
+# 内置拒绝规则，匹配对象为单个执行单元规范化后的文本
+BUILTIN_DENY_RULES: Tuple[str, ...] = (
+    _CMD
+    + r"(?:rm|rmdir|shred|dd|wget|curl|sudo|chown|eval|shutdown|reboot|halt|poweroff)(?:\s|$)",
+    _CMD + r"mkfs(?:\.\S+)?(?:\s|$)",
+    _CMD + r"chmod\s(?:.*\s)?-\w*R\w*\s(?:.*\s)?0?777(?:\s|$)",
+    _CMD + r"find\s.*\s-(?:delete|exec\s+(?:\S*/)?rm)(?:\s|$)",
+    _CMD + r"mv\s.*\s/dev/null$",
+    # 重定向到设备文件或系统配置目录
+    r"^[<>&|]*>[<>&|]*\s/etc/",
+    r"^[<>&|]*>[<>&|]*\s/dev/(?!(?:null|stdout|stderr|tty|zero|fd/\d+)$)",
+)
+
+# 直接作用于整条命令的规则（无法在切分后识别的结构，如fork炸弹）
+_RAW_DENY_PATTERN = re.compile(
+    r"(?P<fn>[\w:.-]+)\s*\(\s*\)\s*\{[^}]*(?P=fn)\s*\|\s*(?P=fn)"
+)
+
+# 只修饰真正要执行的命令的包装命令
+_WRAPPER_COMMANDS = frozenset(
+    {"builtin", "command", "env", "exec", "ionice", "nice", "nohup"}
+    | {"stdbuf", "time", "timeout", "xargs"}
+)
+# 包装命令中需要单独参数的选项，参数不是要执行的命令，需要一起跳过。
+# xargs 的 -i、-e、-l 只接受紧跟的参数（如 -i{}），不在此列
+_WRAPPER_OPTION_ARGS: Dict[str, frozenset] = {
+    "xargs": frozenset(
+        {"-I", "-n", "-P", "-d", "-E", "-L", "-s", "-a"}
+        | {"--max-args", "--max-procs", "--delimiter", "--max-lines"}
+        | {"--max-chars", "--arg-file"}
+    ),
+    "timeout": frozenset({"-s", "-k", "--signal", "--kill-after"}),
+    "env": frozenset({"-u", "-C", "-S", "--unset", "--chdir", "--split-string"}),
+    "stdbuf": frozenset({"-i", "-o", "-e", "--input", "--output", "--error"}),
+    "nice": frozenset({"-n", "--adjustment"}),
+    "ionice": frozenset({"-c", "-n", "-p", "--class", "--classdata", "--pid"}),
+}
+# env -S 的参数本身是要执行的命令
+_SPLIT_STRING_OPTIONS = frozenset({"-S", "--split-string"})
+_SHELL_COMMANDS = frozenset({"sh", "bash", "zsh", "dash", "ksh", "mksh", "ash"})
+# 复合命令的保留字，出现在命令开头时跳过，检查其后真正执行的命令
+_GROUP_WORDS = frozenset(
+    {"{", "}", "!", "if", "then", "elif", "else", "fi", "for", "while", "until"}
+    | {"do", "done", "case", "esac", "select"}
+)
+_ASSIGNMENT = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*=")
+_PUNCTUATION = ";&|()<>\n"
+
+# 递归展开的最大深度，防止恶意嵌套
+_MAX_DEPTH = 8
+
+
+def _is_anchored(rule: str) -> bool:
+    """判断规则是否只会在开头匹配（以^开头且顶层没有|分支）"""
+    if not rule.startswith("^"):
+        return False
+    depth, i, in_class = 0, 1, False
+    while i < len(rule):
+        char = rule[i]
+        if char == "\\":
+            i += 1
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return False
+        i += 1
+    return True
+
+
+def _leading_char(rule: str) -> Optional[str]:
+    """返回锚定规则开头的固定字符，无法确定时返回None"""
+    if (
+        _is_anchored(rule)
+        and len(rule) > 1
+        and (rule[1].isalnum() or rule[1] == "_")
+        and rule[2:3] not in ("?", "*", "{")
+    ):
+        return rule[1]
+    return None
+
+
+def _tokenize(command: str) -> List[str]:
+    """按shell规则切分命令，控制符（; | && 等）和重定向符会成为独立的token"""
+    lexer = shlex.shlex(
+        command.replace("\\\n", ""), posix=True, punctuation_chars=_PUNCTUATION
+    )
+    lexer.whitespace = " \t\r"
+    lexer.whitespace_split = True
+    # shlex会把单词中间的#也当作注释，这里保留原样，避免隐藏后面的命令
+    lexer.commenters = ""
+    return list(lexer)
+
+
+def _find_substitutions(command: str) -> List[str]:
+    """找出未被单引号包裹的命令替换 $(...) 和 `...` 中的命令"""
+    substitutions = []
+    i, length = 0, len(command)
+    in_single = False
+    while i < length:
+        char = command[i]
+        if in_single:
+            if char == "'":
+                in_single = False
+        elif char == "\\":
+            i += 1
+        elif char == "'":
+            in_single = True
+        elif char == "`":
+            end = command.find("`", i + 1)
+            if end == -1:
+                end = length
+            substitutions.append(command[i + 1 : end])
+            i = end
+        elif command.startswith("$(", i):
+            depth, j = 1, i + 2
+            while j < length and depth:
+                if command[j] == "(":
+                    depth += 1
+                elif command[j] == ")":
+                    depth -= 1
+                j += 1
+            substitutions.append(command[i + 2 : j - 1 if depth == 0 else j])
+            i = j - 1
+        i += 1
+    return substitutions
+
+
+def _strip_wrapper_options(wrapper: str, words: List[str]) -> List[str]:
+    """跳过包装命令的选项及其参数、环境变量赋值和时长等数值参数"""
+    option_args = _WRAPPER_OPTION_ARGS.get(wrapper, frozenset())
+    while words:
+        word = words[0]
+        if word == "--":
+            return words[1:]
+        if word in option_args:
+            if word in _SPLIT_STRING_OPTIONS and len(words) > 1:
+                # env -S 'rm -rf x' 把参数拆分后作为命令执行
+                return shlex.split(words[1]) + words[2:]
+            words = words[2:]
+        elif word.startswith("--") and "=" in word:
+            option, value = word.split("=", 1)
+            if option in _SPLIT_STRING_OPTIONS:
+                return shlex.split(value) + words[1:]
+            words = words[1:]
+        elif (
+            word.startswith("-")
+            or _ASSIGNMENT.match(word)
+            or re.fullmatch(r"\d+(?:\.\d+)?[smhd]?", word)
+        ):
+            words = words[1:]
+        else:
+            return words
+    return words
+
+
+def _strip_wrappers(words: List[str]) -> List[str]:
+    """去掉环境变量赋值和 nohup、env、timeout 等包装命令，得到真正执行的命令"""
+    while words:
+        if _ASSIGNMENT.match(words[0]):
+            words = words[1:]
+        elif os.path.basename(words[0]) in _WRAPPER_COMMANDS:
+            words = _strip_wrapper_options(os.path.basename(words[0]), words[1:])
+        else:
+            return words
+    return words
+
+
+def split_units(command: str, depth: int = 0) -> List[str]:
+    """
+    把命令拆分成需要逐个检查的执行单元
+
+    每个管道阶段、&&/||/; 连接的命令和子shell中的命令都是一个单元，文本为规范化后的
+    参数列表（shlex.join）；重定向以 "<操作符> <目标>" 的形式单独成为一个单元。
+
+    Raises:
+        ValueError: 命令无法解析（如引号不匹配）或嵌套过深
+    """
+    if depth > _MAX_DEPTH:
+        raise ValueError("命令嵌套过深")
+
+    units: List[str] = []
+    for substitution in _find_substitutions(command):
+        units.extend(split_units(substitution, depth + 1))
+
+    words: List[str] = []
+
+    def _flush() -> None:
+        stage = _strip_wrappers(words)
+        if stage:
+            units.append(shlex.join(stage))
+            # sh -c '<script>' 中的脚本同样需要检查
+            if os.path.basename(stage[0]) in _SHELL_COMMANDS and "-c" in stage:
+                index = stage.index("-c")
+                if index + 1 < len(stage):
+                    units.extend(split_units(stage[index + 1], depth + 1))
+        words.clear()
+
+    tokens = _tokenize(command)
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token and all(char in _PUNCTUATION for char in token):
+            if "<" in token or ">" in token:
+                target = tokens[i + 1] if i + 1 < len(tokens) else ""
+                if target and not all(char in _PUNCTUATION for char in target):
+                    i += 1
+                units.append(f"{token} {target}")
+            else:
+                _flush()
+        elif token in _GROUP_WORDS and not words:
+            pass
+        elif token == "function" and not words:
+            # function name { ...; } 中的函数名不是命令
+            i += 1
+        else:
+            words.append(token)
+        i += 1
+    _flush()
+    return units
+
+
+@dataclass
+class CommandPolicy:
+    """编译后的命令策略"""
+
+    allow_rules: Tuple[str, ...] = ()
+    deny_rules: Tuple[str, ...] = ()
+
+    def __post_init__(self):
+        # 按优先级排列：用户拒绝 > 用户允许 > 内置拒绝
+        rules: List[Tuple[str, str]] = []
+        rules += [(VERDICT_DENY, rule) for rule in self.deny_rules]
+        rules += [(VERDICT_ALLOW, rule) for rule in self.allow_rules]
+        rules += [(VERDICT_DENY, rule) for rule in BUILTIN_DENY_RULES]
+
+        self._rules: List[Tuple[str, str]] = []
+        # 每条规则是一个从开头匹配的分支，第一个成功的分支即为优先级最高的规则
+        branches: List[Tuple[Optional[str], str]] = []
+        for verdict, rule in rules:
+            try:
+                re.compile(rule)
+            except re.error as e:
+                logger.warning(f"忽略无效的命令策略规则 {rule!r}: {e}")
+                continue
+            # 锚定在开头的规则无需扫描整个单元，失败时只需比较开头几个字符
+            prefix = "" if _is_anchored(rule) else "[\\s\\S]*?"
+            branches.append(
+                (
+                    _leading_char(rule),
+                    f"(?P<r{len(self._rules)}>{prefix}(?:{rule}))",
+                )
+            )
+            self._rules.append((verdict, rule))
+
+        # 以固定字符开头的规则按首字符分组，每个单元只需匹配与其首字符相同的规则和通用规则，
+        # 规则集增大时匹配耗时基本不变
+        def _compile(char: Optional[str]) -> Optional[Pattern]:
+            selected = [branch for lead, branch in branches if lead in (None, char)]
+            return re.compile("|".join(selected)) if selected else None
+
+        self._default_matcher = _compile(None)
+        self._matchers: Dict[str, Optional[Pattern]] = {
+            char: _compile(char) for char in {lead for lead, _ in branches if lead}
+        }
+
+    def match_unit(self, unit: str) -> Optional[Tuple[str, str]]:
+        """返回命中单元的最高优先级规则 (verdict, rule)，未命中返回None"""
+        matcher = self._matchers.get(unit[:1], self._default_matcher)
+        if matcher is None:
+            return None
+        match = matcher.match(unit)
+        if match is None:
+            return None
+        return self._rules[int(match.lastgroup[1:])]
+
+    def find_violation(self, command: str) -> Optional[str]:
+        """
+        查找命令中被拒绝的部分
+
+        Returns:
+            被拒绝的执行单元文本；命令安全时返回None
+        """
+        if not command.strip():
+            return None
+        if _RAW_DENY_PATTERN.search(command):
+            return command
+        try:
+            units = split_units(command)
+        except ValueError:
+            # 无法可靠解析的命令一律视为不安全
+            return command
+
+        for unit in units:
+            matched = self.match_unit(unit)
+            if matched and matched[0] == VERDICT_DENY:
+                return unit
+        return None
+
+    def is_unsafe(self, command: str) -> bool:
+        """检查命令是否不安全"""
+        return self.find_violation(command) is not None
+
+
+_policy_cache: Optional[Tuple[tuple, CommandPolicy]] = None
+_config_mtime: Optional[int] = None
+
+
+def _load_rules_from_file(shell_config, config_path) -> None:
+    """配置文件被修改后重新读取其中的规则，同步到内存中的配置"""
+    try:
+        with open(config_path, "r", encoding="utf-8") as f:
+            shell_data = (yaml.safe_load(f) or {}).get("shell") or {}
+    except (OSError, yaml.YAMLError, AttributeError) as e:
+        logger.debug(f"读取命令策略规则失败: {e}")
+        return
+    for field_name in ("allow_rules", "deny_rules"):
+        rules = shell_data.get(field_name) or []
+        if isinstance(rules, str):
+            rules = [rules]
+        setattr(shell_config, field_name, list(rules))
+
+
+def get_command_policy(config) -> CommandPolicy:
+    """获取当前配置对应的命令策略，配置文件或规则未变化时复用已编译的策略"""
+    global _policy_cache, _config_mtime
+
+    try:
+        mtime = config.config_path.stat().st_mtime_ns
+    except (OSError, AttributeError):
+        mtime = None
+    if mtime is not None and mtime != _config_mtime:
+        _load_rules_from_file(config.shell, config.config_path)
+    _config_mtime = mtime
+
+    key = (tuple(config.shell.allow_rules), tuple(config.shell.deny_rules))
+    if _policy_cache is None or _policy_cache[0] != key:
+        _policy_cache = (key, CommandPolicy(*key))
+    return _policy_cache[1]
+
+
+# 基准测试使用的命令样例
+_BENCHMARK_COMMANDS: Sequence[str] = (
+    "ls -la",
+    "git status && git diff --stat | head -n 20",
+    "find . -name '*.py' | xargs grep -n 'TODO' 2>/dev/null",
+    'echo "$(date)" > build.log; cat build.log',
+    "rm -rf /tmp/build",
+    "cd src && (make clean; make -j8) || echo failed",
+    "sudo systemctl restart nginx",
+    "python -m pytest -q tests/unit",
+)
+
+
+def benchmark(
+    extra_rules: int = 0,
+    iterations: int = 1000,
+    commands: Iterable[str] = _BENCHMARK_COMMANDS,
+) -> float:
+    """
+    测量单条命令的平均检查耗时
+
+    Args:
+        extra_rules: 额外生成的用户规则数量（一半允许一半拒绝），用于模拟大规则集
+        iterations: 每条样例命令的检查次数
+        commands: 样例命令
+
+    Returns:
+        平均每次检查耗时（秒）
+    """
+    commands = list(commands)
+    allow = tuple(rf"^tool{i}\s" for i in range(extra_rules // 2))
+    deny = tuple(rf"^danger{i}(?:\s|$)" for i in range(extra_rules - len(allow)))
+    policy = CommandPolicy(allow, deny)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for command in commands:
+            policy.is_unsafe(command)
+    return (time.perf_counter() - start) / (iterations * len(commands))
+
+
+if __name__ == "__main__":
+    for rule_count in (0, 50, 200, 1000):
+        per_check = benchmark(rule_count)
+        print(f"{rule_count:>5} 条用户规则: {per_check * 1e6:8.1f} µs/命令")
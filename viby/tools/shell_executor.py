@@ -0,0 +1,562 @@
+"""
+流式Shell命令执行器
+
+实时将命令的stdout/stderr输出到终端，同时只在内存中保留有限的开头和结尾内容，
+支持超时和取消，避免长时间运行的命令卡住流程或占用大量内存。
+"""
+
+import os
+import sys
+import signal
+import codecs
+import platform
+import threading
+import subprocess
+import time
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional, TextIO, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# 每次从管道读取的最大字节数
+_READ_CHUNK_SIZE = 65536
+
+# 终止进程后等待其退出的宽限时间（秒）
+_TERMINATE_GRACE_SECONDS = 2.0
+
+# 等待进程时检查取消/超时的间隔（秒）
+_POLL_INTERVAL = 0.1
+
+# 各架构下 ioprio_set 的系统调用号
+_IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "amd64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "arm64": 30,
+    "riscv64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+# 内存不足时常见的错误输出
+_MEMORY_ERROR_MARKERS = (
+    "Cannot allocate memory",
+    "MemoryError",
+    "out of memory",
+    "std::bad_alloc",
+    "memory exhausted",
+)
+
+# 触发的资源限制类型
+LIMIT_CPU = "cpu"
+LIMIT_MEMORY = "memory"
+LIMIT_OUTPUT = "output"
+LIMIT_WALL_TIME = "wall_time"
+
+
+class OutputBuffer:
+    """
+    有界输出缓冲区
+
+    完整保留输出的前 head_bytes 字节，之后的内容写入一个容量为 tail_bytes 的环形缓冲区，
+    无论命令输出多少内容，内存占用都不会超过 head_bytes + tail_bytes。
+    """
+
+    def __init__(self, head_bytes: int, tail_bytes: int):
+        self.head_bytes = max(0, head_bytes)
+        self.tail_bytes = max(0, tail_bytes)
+        self._head = bytearray()
+        self._tail: deque = deque()
+        self._tail_size = 0
+        self.total_bytes = 0
+
+    def write(self, data: bytes) -> None:
+        """写入一段原始输出"""
+        if not data:
+            return
+        self.total_bytes += len(data)
+
+        # 先填满开头部分
+        if len(self._head) < self.head_bytes:
+            room = self.head_bytes - len(self._head)
+            self._head.extend(data[:room])
+            data = data[room:]
+            if not data:
+                return
+
+        if self.tail_bytes == 0:
+            return
+
+        # 剩余内容进入环形缓冲区，超出容量时丢弃最旧的数据
+        if len(data) >= self.tail_bytes:
+            self._tail.clear()
+            self._tail.append(bytes(data[-self.tail_bytes :]))
+            self._tail_size = self.tail_bytes
+            return
+
+        self._tail.append(bytes(data))
+        self._tail_size += len(data)
+        while self._tail_size > self.tail_bytes:
+            overflow = self._tail_size - self.tail_bytes
+            oldest = self._tail[0]
+            if len(oldest) <= overflow:
+                self._tail.popleft()
+                self._tail_size -= len(oldest)
+            else:
+                self._tail[0] = oldest[overflow:]
+                self._tail_size -= overflow
+
+    @property
+    def dropped_bytes(self) -> int:
+        """被丢弃（未保留）的字节数"""
+        return self.total_bytes - len(self._head) - self._tail_size
+
+    @property
+    def truncated(self) -> bool:
+        """输出是否被截断"""
+        return self.dropped_bytes > 0
+
+    def getvalue(self, encoding: str = "utf-8") -> str:
+        """获取保留的输出文本，被截断时在中间插入省略标记"""
+        head = bytes(self._head).decode(encoding, errors="replace")
+        tail = b"".join(self._tail).decode(encoding, errors="replace")
+        if not self.truncated:
+            return head + tail
+        return f"{head}\n... [{self.dropped_bytes} bytes truncated] ...\n{tail}"
+
+
+@dataclass
+class CommandResult:
+    """命令执行结果"""
+
+    returncode: int
+    stdout: str = ""
+    stderr: str = ""
+    timed_out: bool = False
+    cancelled: bool = False
+    truncated: bool = False
+    duration: float = 0.0
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    limit_exceeded: Optional[str] = None
+
+
+@dataclass
+class ResourceLimits:
+    """
+    单条命令的资源限制，0表示不限制
+
+    CPU时间、地址空间、nice和ionice通过 preexec_fn 在子进程中设置（仅POSIX，ionice仅Linux），
+    输出字节数由父进程在读取输出时统计，墙钟时间由 stream_command 的 timeout 参数控制。
+    """
+
+    cpu_seconds: int = 0
+    memory_mb: int = 0
+    max_output_bytes: int = 0
+    nice: int = 0
+    ionice_class: int = 0  # 1: realtime, 2: best-effort, 3: idle
+    ionice_level: int = 4
+
+    @property
+    def has_process_limits(self) -> bool:
+        """是否需要在子进程中设置限制"""
+        return bool(
+            self.cpu_seconds or self.memory_mb or self.nice or self.ionice_class
+        )
+
+
+def _get_ioprio_setter(limits: ResourceLimits) -> Optional[Callable[[], None]]:
+    """在父进程中准备设置I/O优先级的函数，避免在fork后的子进程中加载动态库"""
+    if not limits.ionice_class or platform.system() != "Linux":
+        return None
+
+    syscall_number = _IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+    if syscall_number is None:
+        logger.debug(f"不支持在 {platform.machine()} 上设置ionice")
+        return None
+
+    try:
+        import ctypes
+
+        libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError) as e:
+        logger.debug(f"无法加载libc，跳过ionice设置: {e}")
+        return None
+
+    ioprio = (limits.ionice_class << _IOPRIO_CLASS_SHIFT) | max(
+        0, min(7, limits.ionice_level)
+    )
+
+    def _set_ioprio() -> None:
+        libc.syscall(syscall_number, _IOPRIO_WHO_PROCESS, 0, ioprio)
+
+    return _set_ioprio
+
+
+def build_preexec_fn(
+    limits: Optional[ResourceLimits],
+) -> Optional[Callable[[], None]]:
+    """
+    根据资源限制构造 preexec_fn
+
+    Args:
+        limits: 资源限制，None表示不限制
+
+    Returns:
+        在子进程exec前调用的函数，无需限制或平台不支持时返回None
+    """
+    if limits is None or not limits.has_process_limits:
+        return None
+    if resource is None or platform.system() == "Windows":
+        return None
+
+    set_ioprio = _get_ioprio_setter(limits)
+    cpu_seconds = limits.cpu_seconds
+    memory_bytes = limits.memory_mb * 1024 * 1024
+    nice = limits.nice
+
+    def _apply_limits() -> None:
+        # 子进程中任何失败都不应阻止命令执行
+        if cpu_seconds > 0:
+            try:
+                # 超过软限制时收到SIGXCPU，再多1秒收到SIGKILL
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+            except (ValueError, OSError):
+                pass
+        if memory_bytes > 0:
+            try:
+                resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, memory_bytes))
+            except (ValueError, OSError):
+                pass
+        if nice:
+            try:
+                os.nice(nice)
+            except OSError:
+                pass
+        if set_ioprio is not None:
+            try:
+                set_ioprio()
+            except Exception:
+                pass
+
+    return _apply_limits
+
+
+def _detect_process_limit(
+    limits: Optional[ResourceLimits], returncode: Optional[int], stderr: str
+) -> Optional[str]:
+    """根据退出状态和错误输出判断命令是否因CPU或内存限制而终止"""
+    if limits is None or not returncode:
+        return None
+
+    sigxcpu = getattr(signal, "SIGXCPU", None)
+    if limits.cpu_seconds and sigxcpu and returncode in (-sigxcpu, 128 + sigxcpu):
+        return LIMIT_CPU
+
+    if limits.memory_mb and any(marker in stderr for marker in _MEMORY_ERROR_MARKERS):
+        return LIMIT_MEMORY
+
+    return None
+
+
+def _tee_stream(
+    pipe,
+    buffer: OutputBuffer,
+    sink: Optional[TextIO],
+    prefix: str = "",
+    suffix: str = "",
+) -> None:
+    """从管道读取数据，写入缓冲区并实时输出到终端"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    reader = getattr(pipe, "read1", pipe.read)
+    try:
+        while True:
+            data = reader(_READ_CHUNK_SIZE)
+            if not data:
+                break
+            buffer.write(data)
+            if sink is not None:
+                text = decoder.decode(data)
+                if text:
+                    sink.write(f"{prefix}{text}{suffix}")
+                    sink.flush()
+        if sink is not None:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                sink.write(f"{prefix}{tail}{suffix}")
+                sink.flush()
+    except (OSError, ValueError) as e:
+        # 管道在进程被终止时可能提前关闭
+        logger.debug(f"读取命令输出中断: {e}")
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def _terminate_process(process: subprocess.Popen) -> None:
+    """终止进程（及其进程组），必要时强制结束"""
+    if process.poll() is not None:
+        return
+
+    is_windows = platform.system() == "Windows"
+    try:
+        if is_windows:
+            process.terminate()
+        else:
+            os.killpg(process.pid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+    try:
+        process.wait(timeout=_TERMINATE_GRACE_SECONDS)
+        return
+    except subprocess.TimeoutExpired:
+        pass
+
+    try:
+        if is_windows:
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+    process.wait()
+
+
+def _supervise(
+    process: subprocess.Popen,
+    wait_step: Callable[[], bool],
+    deadline: Optional[float],
+    cancel_event: Optional[threading.Event],
+    max_output_bytes: int,
+    buffers: Tuple[OutputBuffer, ...],
+) -> Optional[str]:
+    """
+    等待命令结束，期间检查取消、超时和输出量限制
+
+    Args:
+        process: 被监控的进程
+        wait_step: 等待一个轮询间隔，命令结束时返回True
+        deadline: 截止时间（time.monotonic），None表示不限制
+        cancel_event: 取消事件
+        max_output_bytes: 最大输出字节数，0表示不限制
+        buffers: 用于统计输出量的缓冲区
+
+    Returns:
+        提前终止的原因："cancelled"、LIMIT_WALL_TIME、LIMIT_OUTPUT，正常结束时为None
+    """
+    try:
+        while not wait_step():
+            if cancel_event is not None and cancel_event.is_set():
+                reason = "cancelled"
+            elif deadline is not None and time.monotonic() >= deadline:
+                reason = LIMIT_WALL_TIME
+            elif max_output_bytes and (
+                sum(buffer.total_bytes for buffer in buffers) > max_output_bytes
+            ):
+                reason = LIMIT_OUTPUT
+            else:
+                continue
+            _terminate_process(process)
+            return reason
+    except KeyboardInterrupt:
+        # Ctrl+C 只终止当前命令，不中断整个对话
+        _terminate_process(process)
+        return "cancelled"
+    return None
+
+
+def _foreground_terminal() -> Optional[int]:
+    """标准输入是终端且本进程在前台运行时返回其文件描述符，否则返回None"""
+    if platform.system() == "Windows":
+        return None
+    try:
+        fd = sys.stdin.fileno()
+        if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+            return fd
+    except (AttributeError, ValueError, OSError):
+        pass
+    return None
+
+
+def _set_foreground(fd: int, pgid: int) -> None:
+    """把终端的前台进程组切换为 pgid，屏蔽 SIGTTOU 以免后台进程组调用时被暂停"""
+    old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTTOU})
+    try:
+        os.tcsetpgrp(fd, pgid)
+    except OSError as e:
+        logger.debug(f"切换终端前台进程组失败: {e}")
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+
+def _new_process_group(
+    popen_kwargs: dict, preexec_fn: Optional[Callable[[], None]]
+) -> None:
+    """让命令在当前会话中的独立进程组运行，保留控制终端"""
+    if sys.version_info >= (3, 11):
+        popen_kwargs["process_group"] = 0
+        if preexec_fn is not None:
+            popen_kwargs["preexec_fn"] = preexec_fn
+        return
+
+    def _setpgid() -> None:
+        os.setpgid(0, 0)
+        if preexec_fn is not None:
+            preexec_fn()
+
+    popen_kwargs["preexec_fn"] = _setpgid
+
+
+def stream_command(
+    command: str,
+    *,
+    shell_exec: Optional[str] = None,
+    timeout: Optional[float] = None,
+    cancel_event: Optional[threading.Event] = None,
+    limits: Optional[ResourceLimits] = None,
+    head_bytes: int = 16384,
+    tail_bytes: int = 16384,
+    echo: bool = True,
+    stderr_prefix: str = "",
+    stderr_suffix: str = "",
+    interactive: bool = True,
+) -> CommandResult:
+    """
+    以流式方式执行shell命令
+
+    命令总是在独立的进程组中运行，超时或取消时一并结束它启动的子进程。
+    交互模式下如果标准输入是前台终端，命令继承标准输入，并在运行期间成为终端的前台进程组，
+    sudo 密码提示等需要读取终端的命令可以正常工作，Ctrl+C 也直接发送给命令；
+    否则关闭标准输入并在新会话中运行，需要输入的命令会立即失败而不是卡住。
+
+    Args:
+        command: 要执行的命令
+        shell_exec: shell可执行文件路径，None表示使用系统默认shell
+        timeout: 最长运行时间（秒），None或0表示不限制
+        cancel_event: 取消事件，被设置时终止命令
+        limits: 资源限制，None表示不限制
+        head_bytes: 每个输出流保留的开头字节数
+        tail_bytes: 每个输出流保留的结尾字节数
+        echo: 是否实时输出到终端
+        stderr_prefix: 输出stderr内容时添加的前缀（如颜色代码）
+        stderr_suffix: 输出stderr内容时添加的后缀
+        interactive: 是否允许命令使用当前终端读取输入
+
+    Returns:
+        命令执行结果
+    """
+    terminal = _foreground_terminal() if interactive else None
+    popen_kwargs = {
+        "shell": True,
+        "stdin": None if terminal is not None else subprocess.DEVNULL,
+        "stdout": subprocess.PIPE,
+        "stderr": subprocess.PIPE,
+    }
+    if shell_exec:
+        popen_kwargs["executable"] = shell_exec
+    preexec_fn = build_preexec_fn(limits)
+    if terminal is not None:
+        _new_process_group(popen_kwargs, preexec_fn)
+    else:
+        if platform.system() != "Windows":
+            popen_kwargs["start_new_session"] = True
+        if preexec_fn is not None:
+            popen_kwargs["preexec_fn"] = preexec_fn
+
+    stdout_buffer = OutputBuffer(head_bytes, tail_bytes)
+    stderr_buffer = OutputBuffer(head_bytes, tail_bytes)
+
+    start_time = time.monotonic()
+    process = subprocess.Popen(command, **popen_kwargs)
+
+    readers = [
+        threading.Thread(
+            target=_tee_stream,
+            args=(process.stdout, stdout_buffer, sys.stdout if echo else None),
+            daemon=True,
+        ),
+        threading.Thread(
+            target=_tee_stream,
+            args=(
+                process.stderr,
+                stderr_buffer,
+                sys.stderr if echo else None,
+                stderr_prefix,
+                stderr_suffix,
+            ),
+            daemon=True,
+        ),
+    ]
+    for reader in readers:
+        reader.start()
+
+    if terminal is not None:
+        _set_foreground(terminal, process.pid)
+        # 命令在切换前读取终端会被 SIGTTIN 暂停，切换后让它继续运行
+        try:
+            os.killpg(process.pid, signal.SIGCONT)
+        except OSError:
+            pass
+
+    def _wait_step() -> bool:
+        try:
+            process.wait(timeout=_POLL_INTERVAL)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+
+    try:
+        stop_reason = _supervise(
+            process,
+            _wait_step,
+            start_time + timeout if timeout else None,
+            cancel_event,
+            limits.max_output_bytes if limits else 0,
+            (stdout_buffer, stderr_buffer),
+        )
+    finally:
+        if terminal is not None:
+            _set_foreground(terminal, os.getpgrp())
+    if (
+        stop_reason is None
+        and terminal is not None
+        and process.returncode in (-signal.SIGINT, 128 + signal.SIGINT)
+    ):
+        # 命令在前台时 Ctrl+C 只发送给命令
+        stop_reason = "cancelled"
+
+    for reader in readers:
+        reader.join(timeout=_TERMINATE_GRACE_SECONDS)
+
+    stderr = stderr_buffer.getvalue()
+    limit_exceeded = stop_reason if stop_reason != "cancelled" else None
+    if stop_reason is None:
+        limit_exceeded = _detect_process_limit(limits, process.returncode, stderr)
+
+    return CommandResult(
+        returncode=process.returncode if process.returncode is not None else -1,
+        stdout=stdout_buffer.getvalue(),
+        stderr=stderr,
+        timed_out=stop_reason == LIMIT_WALL_TIME,
+        cancelled=stop_reason == "cancelled",
+        truncated=stdout_buffer.truncated or stderr_buffer.truncated,
+        duration=time.monotonic() - start_time,
+        stdout_bytes=stdout_buffer.total_bytes,
+        stderr_bytes=stderr_buffer.total_bytes,
+        limit_exceeded=limit_exceeded,
+    )
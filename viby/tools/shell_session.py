@@ -0,0 +1,327 @@
+"""
+持久化Shell会话
+
+在一次vibe运行中复用同一个shell进程执行多条命令，通过哨兵标记分隔每条命令的输出并获取返回码，
+从而保留工作目录和环境变量，并省去每条命令启动shell的开销。shell意外退出时会在下一条命令前自动重启。
+"""
+
+import os
+import sys
+import uuid
+import atexit
+import codecs
+import platform
+import threading
+import subprocess
+import time
+import logging
+from typing import Optional, TextIO
+
+from viby.tools.shell_executor import (
+    LIMIT_WALL_TIME,
+    CommandResult,
+    OutputBuffer,
+    ResourceLimits,
+    build_preexec_fn,
+    _POLL_INTERVAL,
+    _READ_CHUNK_SIZE,
+    _TERMINATE_GRACE_SECONDS,
+    _detect_process_limit,
+    _supervise,
+    _terminate_process,
+)
+
+logger = logging.getLogger(__name__)
+
+# 支持哨兵协议的POSIX兼容shell
+_POSIX_SHELLS = {"sh", "bash", "zsh", "dash", "ksh", "mksh", "ash"}
+
+_session: Optional["ShellSession"] = None
+_session_lock = threading.Lock()
+
+
+def _quote(command: str) -> str:
+    """使用单引号安全地包裹命令文本"""
+    return "'" + command.replace("'", "'\\''") + "'"
+
+
+def _pump_until_marker(
+    pipe,
+    marker: bytes,
+    buffer: OutputBuffer,
+    sink: Optional[TextIO],
+    result: dict,
+    prefix: str = "",
+    suffix: str = "",
+) -> None:
+    """
+    读取管道直到遇到哨兵标记
+
+    标记之前的内容写入缓冲区并实时输出，标记所在行剩余的内容存入 result["trailer"]；
+    如果在遇到标记前管道关闭（shell已退出），result["trailer"] 为 None。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    keep = len(marker) - 1
+    pending = b""
+
+    def _emit(data: bytes, final: bool = False) -> None:
+        buffer.write(data)
+        if sink is not None:
+            text = decoder.decode(data, final=final)
+            if text:
+                sink.write(f"{prefix}{text}{suffix}")
+                sink.flush()
+
+    result["trailer"] = None
+    try:
+        while True:
+            data = os.read(pipe.fileno(), _READ_CHUNK_SIZE)
+            if not data:
+                _emit(pending, final=True)
+                return
+            pending += data
+
+            idx = pending.find(marker)
+            if idx != -1:
+                end = pending.find(b"\n", idx + len(marker))
+                if end == -1:
+                    # 标记行尚未读完整
+                    continue
+                _emit(pending[:idx], final=True)
+                result["trailer"] = pending[idx + len(marker) : end]
+                return
+
+            # 保留可能被拆分到两个数据块中的标记前缀
+            if len(pending) > keep:
+                _emit(pending[:-keep] if keep else pending)
+                pending = pending[-keep:] if keep else b""
+    except (OSError, ValueError) as e:
+        logger.debug(f"读取shell会话输出中断: {e}")
+
+
+class ShellSession:
+    """基于哨兵协议的持久化shell进程"""
+
+    def __init__(
+        self,
+        shell_exec: Optional[str] = None,
+        limits: Optional[ResourceLimits] = None,
+    ):
+        self.shell_exec = shell_exec or os.environ.get("SHELL", "/bin/sh")
+        # 进程级限制在启动shell时设置，由其执行的所有命令继承
+        self.limits = limits
+        self.cwd = os.getcwd()
+        self._process: Optional[subprocess.Popen] = None
+        self._token = uuid.uuid4().hex
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_supported(shell_exec: Optional[str]) -> bool:
+        """检查当前平台和shell是否支持持久化会话"""
+        if platform.system() == "Windows" or not shell_exec:
+            return False
+        return os.path.basename(shell_exec) in _POSIX_SHELLS
+
+    @property
+    def is_alive(self) -> bool:
+        """shell进程是否仍在运行"""
+        return self._process is not None and self._process.poll() is None
+
+    def _start(self) -> None:
+        """启动（或重启）shell进程，工作目录沿用上一次记录的目录"""
+        cwd = self.cwd if os.path.isdir(self.cwd) else os.getcwd()
+        self._process = subprocess.Popen(
+            [self.shell_exec],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            start_new_session=True,
+            preexec_fn=build_preexec_fn(self.limits),
+        )
+        logger.debug(
+            f"已启动持久化shell会话: {self.shell_exec}, PID={self._process.pid}"
+        )
+
+    def _build_script(self, command: str) -> bytes:
+        """构造发送给shell的脚本：执行命令并输出带返回码和工作目录的哨兵行"""
+        marker = f"__VIBY_{self._token}__"
+        script = (
+            f"eval {_quote(command)} < /dev/null\n"
+            "__viby_rc=$?\n"
+            f"printf '\\n%s\\n' '{marker}' >&2\n"
+            f"printf '\\n%s %d %s\\n' '{marker}' \"$__viby_rc\" \"$PWD\"\n"
+        )
+        return script.encode("utf-8")
+
+    def run(
+        self,
+        command: str,
+        *,
+        timeout: Optional[float] = None,
+        cancel_event: Optional[threading.Event] = None,
+        head_bytes: int = 16384,
+        tail_bytes: int = 16384,
+        echo: bool = True,
+        stderr_prefix: str = "",
+        stderr_suffix: str = "",
+    ) -> CommandResult:
+        """
+        在持久化shell中执行一条命令
+
+        参数含义与 stream_command 相同。超时或取消时会结束整个shell进程，
+        下一条命令会在最后的工作目录中自动重启shell（环境变量不会保留）。
+        """
+        with self._lock:
+            if not self.is_alive:
+                self._start()
+            process = self._process
+            marker = f"\n__VIBY_{self._token}__".encode("utf-8")
+
+            stdout_buffer = OutputBuffer(head_bytes, tail_bytes)
+            stderr_buffer = OutputBuffer(head_bytes, tail_bytes)
+            stdout_result: dict = {}
+            stderr_result: dict = {}
+
+            start_time = time.monotonic()
+            readers = [
+                threading.Thread(
+                    target=_pump_until_marker,
+                    args=(
+                        process.stdout,
+                        marker,
+                        stdout_buffer,
+                        sys.stdout if echo else None,
+                        stdout_result,
+                    ),
+                    daemon=True,
+                ),
+                threading.Thread(
+                    target=_pump_until_marker,
+                    args=(
+                        process.stderr,
+                        marker,
+                        stderr_buffer,
+                        sys.stderr if echo else None,
+                        stderr_result,
+                        stderr_prefix,
+                        stderr_suffix,
+                    ),
+                    daemon=True,
+                ),
+            ]
+            for reader in readers:
+                reader.start()
+
+            try:
+                process.stdin.write(self._build_script(command))
+                process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                logger.debug(f"写入shell会话失败: {e}")
+
+            def _wait_step() -> bool:
+                readers[0].join(timeout=_POLL_INTERVAL)
+                return not any(reader.is_alive() for reader in readers)
+
+            stop_reason = _supervise(
+                process,
+                _wait_step,
+                start_time + timeout if timeout else None,
+                cancel_event,
+                self.limits.max_output_bytes if self.limits else 0,
+                (stdout_buffer, stderr_buffer),
+            )
+
+            for reader in readers:
+                reader.join(timeout=_TERMINATE_GRACE_SECONDS)
+
+            trailer = stdout_result.get("trailer")
+            if trailer is not None:
+                # 哨兵行格式: "<返回码> <工作目录>"
+                rc_text, _, cwd = (
+                    trailer.decode("utf-8", errors="replace").lstrip().partition(" ")
+                )
+                returncode = int(rc_text) if rc_text.lstrip("-").isdigit() else -1
+                if cwd:
+                    self.cwd = cwd
+            else:
+                # shell已退出（命令中包含exit、超时或被取消），下次执行时自动重启
+                _terminate_process(process)
+                returncode = (
+                    process.returncode if process.returncode is not None else -1
+                )
+                self._close_pipes(process)
+                self._process = None
+
+            stderr = stderr_buffer.getvalue()
+            limit_exceeded = stop_reason if stop_reason != "cancelled" else None
+            if stop_reason is None:
+                limit_exceeded = _detect_process_limit(self.limits, returncode, stderr)
+
+            return CommandResult(
+                returncode=returncode,
+                stdout=stdout_buffer.getvalue(),
+                stderr=stderr,
+                timed_out=stop_reason == LIMIT_WALL_TIME,
+                cancelled=stop_reason == "cancelled",
+                truncated=stdout_buffer.truncated or stderr_buffer.truncated,
+                duration=time.monotonic() - start_time,
+                stdout_bytes=stdout_buffer.total_bytes,
+                stderr_bytes=stderr_buffer.total_bytes,
+                limit_exceeded=limit_exceeded,
+            )
+
+    @staticmethod
+    def _close_pipes(process: subprocess.Popen) -> None:
+        for pipe in (process.stdin, process.stdout, process.stderr):
+            try:
+                if pipe:
+                    pipe.close()
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        """结束shell进程"""
+        with self._lock:
+            process = self._process
+            self._process = None
+        if process is None:
+            return
+        try:
+            process.stdin.write(b"exit\n")
+            process.stdin.flush()
+            process.wait(timeout=_TERMINATE_GRACE_SECONDS)
+        except (OSError, ValueError, subprocess.TimeoutExpired):
+            _terminate_process(process)
+        self._close_pipes(process)
+
+
+def get_shell_session(
+    shell_exec: Optional[str], limits: Optional[ResourceLimits] = None
+) -> Optional[ShellSession]:
+    """获取当前进程共享的持久化shell会话，不支持时返回None"""
+    global _session
+    if not ShellSession.is_supported(shell_exec):
+        return None
+    with _session_lock:
+        if (
+            _session is None
+            or _session.shell_exec != shell_exec
+            or _session.limits != limits
+        ):
+            if _session is not None:
+                _session.close()
+            _session = ShellSession(shell_exec, limits)
+        return _session
+
+
+def close_shell_session() -> None:
+    """关闭共享的持久化shell会话"""
+    global _session
+    with _session_lock:
+        session, _session = _session, None
+    if session is not None:
+        session.close()
+
+
+atexit.register(close_shell_session)
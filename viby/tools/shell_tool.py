@@ -3,66 +3,39 @@ Shell命令执行工具定义
 """
 
 import os
-import subprocess
 import platform
 import pyperclip
-import re
 import logging
-from typing import Dict, Any
-from prompt_toolkit import prompt
-from prompt_toolkit.formatted_text import HTML
+from typing import Dict, Any, Optional
 
 from viby.locale import get_text
-from viby.utils.ui import Colors, print_separator
+from viby.utils.lazy_import import lazy_class, lazy_function
+from viby.tools.command_policy import get_command_policy
+from viby.tools.shell_executor import (
+    LIMIT_CPU,
+    LIMIT_MEMORY,
+    LIMIT_OUTPUT,
+    LIMIT_WALL_TIME,
+    ResourceLimits,
+    stream_command,
+)
+from viby.tools.shell_session import get_shell_session
 from viby.utils.history import SessionManager
 from viby.config.app_config import Config
 
 logger = logging.getLogger(__name__)
 
+# 交互界面依赖 rich 和 prompt_toolkit，只在需要与用户交互时才导入
+Colors = lazy_class("viby.utils.ui", "Colors")
+print_separator = lazy_function("viby.utils.ui", "print_separator")
+prompt = lazy_function("prompt_toolkit", "prompt")
+HTML = lazy_class("prompt_toolkit.formatted_text", "HTML")
+
 # 获取全局配置实例
 _config = Config()
 # 初始化会话管理器
 _session_manager = SessionManager()
 
-# 不安全命令黑名单
-UNSAFE_COMMANDS = [
-    "rm",
-    "rm -rf",
-    "rm -r",
-    "rm -f",
-    "rmdir",
-    "mkfs",
-    "dd",
-    ":(){ :|:& };:",
-    "chmod -R 777",
-    "> /dev/sda",
-    "mv /* /dev/null",
-    "wget",
-    "curl",
-    "sudo rm",
-    "> /etc/passwd",
-    "shutdown",
-    "reboot",
-    "halt",
-    "poweroff",
-    "find / -delete",
-    ":(){ :|:& };:",
-    "eval",
-    "sudo",
-    "chown",
-    "> /dev/null",
-    "shred",
-]
-
-# 高危命令模式，使用正则表达式
-UNSAFE_PATTERNS = [
-    r"^rm\s+(-[a-zA-Z]*[fr][a-zA-Z]*\s+|--recursive\s+|--force\s+)",  # rm命令带有-f或-r参数
-    r"^sudo\s+",  # 以sudo开头的命令
-    r">\s*/dev/",  # 重定向到设备文件
-    r">\s*/etc/",  # 重定向到系统配置文件
-    r"mv\s+/\S+\s+/dev/null",  # 移动文件到/dev/null
-]
-
 # Shell工具定义 - 符合FastMCP标准
 SHELL_TOOL = {
     "name": "execute_shell",
@@ -104,6 +77,9 @@ def execute_shell(params: Dict[str, Any]) -> Dict[str, Any]:
             "code": result.get("code", 1),
             "output": result.get("output", ""),
             "error": result.get("error", ""),
+            "timed_out": result.get("timed_out", False),
+            "truncated": result.get("truncated", False),
+            "limit_exceeded": result.get("limit_exceeded"),
             "command": command,
         }
     except Exception as e:
@@ -148,29 +124,8 @@ def _is_unsafe_command(command: str) -> bool:
     Returns:
         如果命令可能不安全则返回True
     """
-    # 分割命令，获取主命令
-    cmd_parts = command.strip().split()
-    if not cmd_parts:
-        return False
-
-    main_cmd = cmd_parts[0]
-
-    # 安全命令白名单检查
-    safe_commands = ["ls", "echo", "cat", "grep", "pwd", "cd", "mkdir", "touch"]
-    if main_cmd in safe_commands:
-        return False
-
-    # 检查命令是否匹配危险模式
-    if any(re.search(pattern, command) for pattern in UNSAFE_PATTERNS):
-        return True
-
-    # 检查命令是否包含黑名单中的字符串
-    # 只检查主命令和选项，避免误判文件名或echo内容
-    command_prefix = " ".join(cmd_parts[:2] if len(cmd_parts) > 1 else cmd_parts)
-    if any(unsafe_cmd in command_prefix for unsafe_cmd in UNSAFE_COMMANDS):
-        return True
-
-    return False
+    # 按管道、命令链和子shell逐段检查，规则按配置文件修改时间缓存
+    return get_command_policy(_config).is_unsafe(command)
 
 
 def handle_shell_command(command: str):
@@ -213,7 +168,7 @@ def handle_shell_command(command: str):
 
 
 def _execute_command(command: str) -> dict:
-    """执行shell命令并返回结果"""
+    """执行shell命令，实时输出结果，并返回有界的输出内容"""
     try:
         # 根据操作系统决定shell执行方式
         system = platform.system()
@@ -231,25 +186,35 @@ def _execute_command(command: str) -> dict:
         print_separator()
         print(Colors.END, end="")
 
-        # 根据操作系统决定是否传递executable参数
-        if shell_exec:
-            process = subprocess.run(
-                command,
-                shell=True,
-                executable=shell_exec,
-                capture_output=True,
-                text=True,
-            )
+        # 流式执行命令，stdout/stderr实时输出到终端
+        shell_config = _config.shell
+        limits = _get_resource_limits(shell_config)
+        run_options = {
+            "timeout": shell_config.timeout or None,
+            "head_bytes": shell_config.output_head_bytes,
+            "tail_bytes": shell_config.output_tail_bytes,
+            "stderr_prefix": Colors.RED,
+            "stderr_suffix": Colors.END,
+        }
+        session = (
+            get_shell_session(shell_exec, limits)
+            if shell_config.persistent_session
+            else None
+        )
+        if session:
+            # 复用持久化shell，保留工作目录和环境变量
+            process = session.run(command, **run_options)
         else:
-            process = subprocess.run(
-                command, shell=True, capture_output=True, text=True
+            process = stream_command(
+                command, shell_exec=shell_exec, limits=limits, **run_options
             )
 
-        # 输出命令结果
-        if process.stdout:
-            print(process.stdout)
-        if process.stderr:
-            print(f"{Colors.RED}{process.stderr}{Colors.END}")
+        error = process.stderr
+        notice = _get_stop_notice(process, shell_config)
+        if notice:
+            notice_color = Colors.YELLOW if process.cancelled else Colors.RED
+            print(f"{notice_color}{notice}{Colors.END}")
+            error = f"{error}\n{notice}" if error else notice
 
         # 根据返回码显示不同颜色
         status_color = Colors.GREEN if process.returncode == 0 else Colors.RED
@@ -264,13 +229,46 @@ def _execute_command(command: str) -> dict:
             "status": "executed",
             "code": process.returncode,
             "output": process.stdout,
-            "error": process.stderr,
+            "error": error,
+            "timed_out": process.timed_out,
+            "truncated": process.truncated,
+            "limit_exceeded": process.limit_exceeded,
         }
     except Exception as e:
         print(f"{Colors.RED}{get_text('SHELL', 'command_error', str(e))}{Colors.END}")
         return {"status": "error", "code": 1, "message": str(e)}
 
 
+def _get_resource_limits(shell_config) -> Optional[ResourceLimits]:
+    """根据配置构造命令的资源限制，未配置任何限制时返回None"""
+    limits = ResourceLimits(
+        cpu_seconds=shell_config.cpu_seconds,
+        memory_mb=shell_config.memory_mb,
+        max_output_bytes=shell_config.max_output_bytes,
+        nice=shell_config.nice,
+        ionice_class=shell_config.ionice_class,
+        ionice_level=shell_config.ionice_level,
+    )
+    if not (limits.has_process_limits or limits.max_output_bytes):
+        return None
+    return limits
+
+
+def _get_stop_notice(process, shell_config) -> Optional[str]:
+    """生成命令被取消或触发资源限制时的提示"""
+    if process.cancelled:
+        return get_text("SHELL", "command_cancelled")
+    if process.limit_exceeded == LIMIT_WALL_TIME:
+        return get_text("SHELL", "command_timeout", shell_config.timeout)
+    if process.limit_exceeded == LIMIT_CPU:
+        return get_text("SHELL", "limit_cpu", shell_config.cpu_seconds)
+    if process.limit_exceeded == LIMIT_MEMORY:
+        return get_text("SHELL", "limit_memory", shell_config.memory_mb)
+    if process.limit_exceeded == LIMIT_OUTPUT:
+        return get_text("SHELL", "limit_output", shell_config.max_output_bytes)
+    return None
+
+
 def _handle_choice(choice: str, command: str) -> dict:
     """根据用户输入分发处理器"""
     handlers = {
@@ -0,0 +1,96 @@
+"""
+协作式取消
+
+CancellationToken 是带回调的 threading.Event：取消时立即执行已注册的回调，
+用于关闭模型的 HTTP 流、取消 MCP 协程或唤醒正在等待的线程，而不必让各处轮询事件状态。
+所有接受 threading.Event 作为取消事件的地方都可以直接传入它。
+"""
+
+import contextlib
+import logging
+import signal
+import threading
+from typing import Callable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CancellationToken(threading.Event):
+    """可注册取消回调的事件"""
+
+    def __init__(self):
+        super().__init__()
+        self._callbacks: List[Callable[[], None]] = []
+        # 回调在锁内执行，移除回调返回后可以安全释放回调使用的资源
+        self._callback_lock = threading.RLock()
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已被取消"""
+        return self.is_set()
+
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        注册取消回调，已取消时立即执行
+
+        Returns:
+            移除该回调的函数
+        """
+        with self._callback_lock:
+            if not self.is_set():
+                self._callbacks.append(callback)
+                return lambda: self._remove_callback(callback)
+            self._run_callback(callback)
+            return lambda: None
+
+    def _remove_callback(self, callback: Callable[[], None]) -> None:
+        with self._callback_lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _run_callback(callback: Callable[[], None]) -> None:
+        try:
+            callback()
+        except Exception as e:
+            # 回调失败不应影响取消本身
+            logger.debug(f"取消回调执行失败: {e}")
+
+    def set(self) -> None:
+        """取消并执行所有回调"""
+        with self._callback_lock:
+            if self.is_set():
+                return
+            super().set()
+            callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                self._run_callback(callback)
+
+    cancel = set
+
+
+@contextlib.contextmanager
+def cancel_on_interrupt(
+    token: Optional[CancellationToken] = None,
+) -> Iterator[CancellationToken]:
+    """
+    代码块执行期间按下 Ctrl+C 时取消令牌，而不是抛出 KeyboardInterrupt
+
+    只有主线程能设置信号处理函数，在其他线程中使用时只返回令牌。
+
+    Yields:
+        传入的令牌，未传入时新建一个
+    """
+    if token is None:
+        token = CancellationToken()
+    if threading.current_thread() is not threading.main_thread():
+        yield token
+        return
+
+    previous = signal.signal(signal.SIGINT, lambda signum, frame: token.cancel())
+    try:
+        yield token
+    finally:
+        signal.signal(signal.SIGINT, previous)
@@ -2,23 +2,540 @@
 会话管理模块 - 处理用户交互会话的记录、存储和检索，支持会话(session)管理
 """
 
+import hashlib
 import json
+import random
+import re
 import sqlite3
-import csv
-import yaml
+import time
 import uuid
+import atexit
 import contextlib
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 from viby.config import config
+from viby.utils import history_io
 from viby.utils.logging import get_logger
 
 # 设置日志记录器
 logger = get_logger()
 
 
+def _stored_text_sql(value: str, ref: str) -> str:
+    """返回读取文本的 SQL 表达式，文本可能内联保存在 value 列，也可能按 ref 保存在 history_blobs 中"""
+    return f"""CASE WHEN {ref} IS NULL THEN {value} ELSE (
+                SELECT blob_decode(codec, data) FROM history_blobs WHERE hash = {ref}
+            ) END"""
+
+
+def _response_text_sql(row: str) -> str:
+    """history 中某行回复本身（不含追加段落）的 SQL 表达式"""
+    return _stored_text_sql(f"{row}.response", f"{row}.response_ref")
+
+
+def _segment_text_sql(row: str) -> str:
+    """interaction_segments 中某个段落文本的 SQL 表达式"""
+    return _stored_text_sql(f"{row}.content", f"{row}.content_ref")
+
+
+# 追加段落与回复之间的分隔
+SEGMENT_SEPARATOR = "\n\n"
+
+
+# 数据库结构迁移，按版本号顺序执行；已执行到的版本保存在 PRAGMA user_version 中
+SCHEMA_MIGRATIONS: List[Tuple[int, List[str]]] = [
+    (
+        1,
+        [
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                last_used TEXT NOT NULL,
+                description TEXT,
+                is_active INTEGER DEFAULT 0
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                type TEXT NOT NULL,
+                content TEXT NOT NULL,
+                response TEXT,
+                metadata TEXT,
+                FOREIGN KEY (session_id) REFERENCES sessions(id)
+            )
+            """,
+        ],
+    ),
+    (
+        2,
+        [
+            # 按会话读取历史并按时间排序
+            """
+            CREATE INDEX IF NOT EXISTS idx_history_session_timestamp
+            ON history (session_id, timestamp)
+            """,
+            "CREATE INDEX IF NOT EXISTS idx_sessions_is_active ON sessions (is_active)",
+            # 会话的交互数和最后交互时间，列出会话时无需扫描历史表
+            """
+            ALTER TABLE sessions
+            ADD COLUMN interaction_count INTEGER NOT NULL DEFAULT 0
+            """,
+            "ALTER TABLE sessions ADD COLUMN last_interaction TEXT",
+            """
+            UPDATE sessions SET
+                interaction_count = (
+                    SELECT COUNT(*) FROM history WHERE session_id = sessions.id
+                ),
+                last_interaction = (
+                    SELECT MAX(timestamp) FROM history WHERE session_id = sessions.id
+                )
+            """,
+            # 由触发器在写入历史的同一事务中维护计数，任何写入路径都不会遗漏
+            """
+            CREATE TRIGGER IF NOT EXISTS history_counters_insert
+            AFTER INSERT ON history
+            BEGIN
+                UPDATE sessions SET
+                    interaction_count = interaction_count + 1,
+                    last_interaction = CASE
+                        WHEN last_interaction IS NULL
+                            OR NEW.timestamp > last_interaction
+                        THEN NEW.timestamp
+                        ELSE last_interaction
+                    END
+                WHERE id = NEW.session_id;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS history_counters_delete
+            AFTER DELETE ON history
+            BEGIN
+                UPDATE sessions SET
+                    interaction_count = interaction_count - 1,
+                    last_interaction = CASE
+                        WHEN OLD.timestamp >= last_interaction
+                        THEN (
+                            SELECT MAX(timestamp) FROM history
+                            WHERE session_id = OLD.session_id
+                        )
+                        ELSE last_interaction
+                    END
+                WHERE id = OLD.session_id;
+            END
+            """,
+        ],
+    ),
+    (
+        3,
+        [
+            # 超过阈值的回复按内容哈希保存在单独的表中并压缩，history 只保存哈希
+            """
+            CREATE TABLE IF NOT EXISTS history_blobs (
+                hash TEXT PRIMARY KEY,
+                codec TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                data BLOB NOT NULL
+            ) WITHOUT ROWID
+            """,
+            "ALTER TABLE history ADD COLUMN response_ref TEXT",
+            """
+            CREATE INDEX IF NOT EXISTS idx_history_response_ref
+            ON history (response_ref) WHERE response_ref IS NOT NULL
+            """,
+            # 全文索引由 _ensure_search_index 按新的结构重建
+            "DROP TRIGGER IF EXISTS history_fts_insert",
+            "DROP TRIGGER IF EXISTS history_fts_delete",
+            "DROP TRIGGER IF EXISTS history_fts_update",
+            "DROP TABLE IF EXISTS history_fts",
+        ],
+    ),
+    (
+        4,
+        [
+            # 工具结果和后续回复按交互追加为段落，不再重写整条回复
+            """
+            CREATE TABLE IF NOT EXISTS interaction_segments (
+                id INTEGER PRIMARY KEY,
+                history_id INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                content TEXT,
+                content_ref TEXT,
+                FOREIGN KEY (history_id) REFERENCES history(id)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_segments_history
+            ON interaction_segments (history_id, id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_segments_content_ref
+            ON interaction_segments (content_ref) WHERE content_ref IS NOT NULL
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS history_segments_delete
+            AFTER DELETE ON history
+            BEGIN
+                DELETE FROM interaction_segments WHERE history_id = OLD.id;
+            END
+            """,
+            # 全文索引分别索引回复本身和每个段落，由 _ensure_search_index 重建
+            "DROP TRIGGER IF EXISTS history_fts_insert",
+            "DROP TRIGGER IF EXISTS history_fts_delete",
+            "DROP TRIGGER IF EXISTS history_fts_update",
+            "DROP TABLE IF EXISTS history_fts",
+        ],
+    ),
+    (
+        5,
+        [
+            # 多个进程并发切换会话后可能留下多个活跃会话，只保留最近使用的一个
+            """
+            UPDATE sessions SET is_active = 0
+            WHERE is_active = 1 AND id != (
+                SELECT id FROM sessions WHERE is_active = 1
+                ORDER BY last_used DESC LIMIT 1
+            )
+            """,
+            "DROP INDEX IF EXISTS idx_sessions_is_active",
+            """
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_sessions_single_active
+            ON sessions (is_active) WHERE is_active = 1
+            """,
+        ],
+    ),
+    (
+        6,
+        [
+            # 每次交互中按角色保存的完整消息，包括工具调用和压缩摘要，用于重建上下文
+            """
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                history_id INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT,
+                content_ref TEXT,
+                tool_calls TEXT,
+                tool_call_id TEXT,
+                token_count INTEGER NOT NULL DEFAULT 0,
+                compacted INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_messages_history
+            ON messages (history_id, id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_messages_content_ref
+            ON messages (content_ref) WHERE content_ref IS NOT NULL
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS history_messages_delete
+            AFTER DELETE ON history
+            BEGIN
+                DELETE FROM messages WHERE history_id = OLD.id;
+            END
+            """,
+        ],
+    ),
+    (
+        7,
+        [
+            # 数据库中的视图和触发器不能调用本程序注册的 SQL 函数，否则其他程序（sqlite3
+            # 命令行、旧版本的 viby）无法写入历史表。解压改为只在本程序的连接中进行，
+            # 全文索引改为保存文本并在写入时由程序同步，见 _READ_VIEWS 和 _FTS_TRIGGERS
+            "DROP VIEW IF EXISTS main.history_full",
+            "DROP VIEW IF EXISTS main.history_fts_source",
+            "DROP VIEW IF EXISTS main.interaction_segments_text",
+            "DROP TRIGGER IF EXISTS history_fts_insert",
+            "DROP TRIGGER IF EXISTS history_fts_delete",
+            "DROP TRIGGER IF EXISTS history_fts_update",
+            "DROP TRIGGER IF EXISTS history_segments_fts_insert",
+            "DROP TRIGGER IF EXISTS history_segments_fts_delete",
+            "DROP TABLE IF EXISTS history_fts",
+            "DROP TABLE IF EXISTS history_segments_fts",
+        ],
+    ),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+# 数据库被其他进程锁定、等待超时后重试开始写事务的间隔（秒），每次翻倍
+BUSY_RETRY_DELAY = 0.05
+BUSY_RETRY_MAX_DELAY = 1.0
+# 流式导出时每批从游标读取的记录数
+EXPORT_BATCH_SIZE = 1000
+# 删除和清理历史记录时每个事务删除的记录数，避免长时间持有写锁
+DELETE_BATCH_SIZE = 1000
+# PRAGMA auto_vacuum 的 INCREMENTAL 模式
+_AUTO_VACUUM_INCREMENTAL = 2
+# 导入时每批写入的记录数，以及每个事务最多包含的记录数
+IMPORT_BATCH_SIZE = 5000
+IMPORT_TRANSACTION_SIZE = 100000
+
+# 导入时的暂存表，同一批中相同会话、时间和内容哈希的记录只保留一条
+_IMPORT_STAGING_TABLE = """
+CREATE TEMP TABLE IF NOT EXISTS import_staging (
+    session_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    type TEXT NOT NULL,
+    content TEXT NOT NULL,
+    response TEXT,
+    metadata TEXT,
+    content_hash TEXT NOT NULL,
+    UNIQUE (session_id, timestamp, content_hash)
+)
+"""
+
+# 每个进程对每个数据库文件只保持一个连接，由锁保证同一时间只有一个线程使用
+_connections: Dict[str, Tuple[sqlite3.Connection, threading.RLock]] = {}
+_connections_lock = threading.Lock()
+# 本进程中已确认结构为最新版本的数据库
+_initialized_dbs: set = set()
+# 本进程中已确认可以使用全文索引的数据库
+_fts_dbs: set = set()
+
+# 只在本程序的连接中创建的临时视图，读取时解压 history_blobs 中保存的文本并拼接追加的段落。
+# 临时视图不写入数据库文件，其他程序打开数据库时不会遇到未注册的 blob_decode 函数
+_READ_VIEWS = [
+    # 完整回复：回复本身和按顺序追加的段落
+    f"""
+    CREATE TEMP VIEW IF NOT EXISTS history_full AS
+    SELECT h.id, h.session_id, h.timestamp, h.type, h.content,
+        CASE WHEN NOT EXISTS (
+            SELECT 1 FROM interaction_segments WHERE history_id = h.id
+        ) THEN {_response_text_sql("h")}
+        ELSE COALESCE(
+            NULLIF({_response_text_sql("h")}, '') || char(10, 10), ''
+        ) || (
+            SELECT group_concat(text, char(10, 10)) FROM (
+                SELECT {_segment_text_sql("g")} AS text
+                FROM interaction_segments g
+                WHERE g.history_id = h.id ORDER BY g.id
+            )
+        ) END AS response,
+        h.metadata
+    FROM main.history h
+    """,
+    # 回复本身（不含追加的段落），用于回填全文索引
+    f"""
+    CREATE TEMP VIEW IF NOT EXISTS history_fts_source AS
+    SELECT id, content, {_response_text_sql("history")} AS response
+    FROM main.history
+    """,
+    f"""
+    CREATE TEMP VIEW IF NOT EXISTS interaction_segments_text AS
+    SELECT id, history_id, {_segment_text_sql("interaction_segments")} AS content
+    FROM main.interaction_segments
+    """,
+]
+
+# 全文索引：回复本身和每个追加的段落分别索引，索引表保存纯文本。
+# 写入时由 _index_interaction 和 _index_segment 同步；删除由触发器同步，
+# 触发器不调用自定义函数，其他程序删除历史记录时索引也保持一致
+FTS_TABLE = "history_fts"
+SEGMENTS_FTS_TABLE = "history_segments_fts"
+FTS_TOKENIZERS = ("unicode61", "trigram")
+_FTS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history
+    BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = OLD.id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS history_segments_fts_delete
+    AFTER DELETE ON interaction_segments
+    BEGIN
+        DELETE FROM {SEGMENTS_FTS_TABLE} WHERE rowid = OLD.id;
+    END
+    """,
+]
+# 搜索结果摘要中高亮匹配词的标记
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+# 搜索语法：双引号包裹的短语，或以空白分隔的词，词尾的 * 表示前缀匹配
+_SEARCH_TOKEN_PATTERN = re.compile(r'"([^"]*)"|(\S+)')
+
+# 重建上下文时每条工具结果最多保留的字符数，超出部分从中间省略，0 表示不限制
+REPLAY_TOOL_RESULT_CHARS = 4000
+
+# 补给没有结果的工具调用的结果，与 MCP 工具调用被取消时的结果一致
+CANCELLED_TOOL_RESULT = "Tool call cancelled"
+
+
+def _decode_blob(codec: str, data: bytes) -> str:
+    """SQL 函数 blob_decode：解压 history_blobs 中保存的文本，只供 _READ_VIEWS 和查询使用"""
+    return history_io.decompress_bytes(data, codec).decode("utf-8")
+
+
+def _open_connection(db_path: Path, busy_timeout_ms: int) -> sqlite3.Connection:
+    """打开数据库连接并设置 WAL 日志模式和相关参数"""
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        str(db_path),
+        timeout=busy_timeout_ms / 1000,
+        # 历史记录可能在后台线程中写入，访问由连接锁串行化
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    conn.row_factory = sqlite3.Row
+    # 读取 history_blobs 中压缩保存的回复，只在本连接的临时视图和查询中使用
+    conn.create_function("blob_decode", 2, _decode_blob, deterministic=True)
+    for statement in _READ_VIEWS:
+        conn.execute(statement)
+    # 只对新建的数据库生效，已有数据库在 yb sessions gc 时通过 VACUUM 转换
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    return conn
+
+
+def _is_busy(error: sqlite3.Error) -> bool:
+    """是否为数据库被其他连接锁定的错误（SQLITE_BUSY 或 SQLITE_LOCKED）"""
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error) or "busy" in str(error)
+
+
+def begin_immediate(cursor, retries: int) -> None:
+    """
+    开始写事务并立即获取写锁
+
+    延迟事务在第一次写入时才加写锁，如果此时其他进程已经提交过写入，
+    SQLite 会直接返回 SQLITE_BUSY 而不等待。事务开始时就加写锁可以让 busy_timeout 生效；
+    等待超时后按指数退避加随机抖动重试。
+
+    Raises:
+        sqlite3.OperationalError: 重试 retries 次后仍无法获取写锁
+    """
+    delay = BUSY_RETRY_DELAY
+    for attempt in range(retries + 1):
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e) or attempt == retries:
+                raise
+            logger.debug(f"历史数据库被锁定，{delay:.2f} 秒后重试: {e}")
+            time.sleep(delay * (1 + random.random()))
+            delay = min(delay * 2, BUSY_RETRY_MAX_DELAY)
+
+
+def _get_connection(
+    db_path: Path, busy_timeout_ms: int
+) -> Tuple[sqlite3.Connection, threading.RLock]:
+    """获取数据库文件在本进程中共享的连接及其锁"""
+    key = str(db_path)
+    with _connections_lock:
+        entry = _connections.get(key)
+        if entry is None:
+            entry = (_open_connection(db_path, busy_timeout_ms), threading.RLock())
+            _connections[key] = entry
+        return entry
+
+
+def _parse_search_query(query: str) -> List[Tuple[str, bool]]:
+    """把搜索词拆分为 (词或短语, 是否前缀匹配) 列表"""
+    terms = []
+    for match in _SEARCH_TOKEN_PATTERN.finditer(query):
+        phrase, word = match.groups()
+        if phrase is not None:
+            if phrase.strip():
+                terms.append((phrase.strip(), False))
+        elif word.endswith("*") and len(word) > 1:
+            terms.append((word.rstrip("*"), True))
+        elif word != "*":
+            terms.append((word, False))
+    return terms
+
+
+def build_fts_query(query: str) -> str:
+    """
+    把用户输入的搜索词转换为 FTS5 查询
+
+    每个词或短语都加引号，避免其中的特殊字符被当作 FTS5 语法；多个词之间为“与”关系。
+    """
+    parts = []
+    for term, prefix in _parse_search_query(query):
+        quoted = '"' + term.replace('"', '""') + '"'
+        parts.append(quoted + "*" if prefix else quoted)
+    return " ".join(parts)
+
+
+def close_connections() -> None:
+    """关闭本进程打开的所有数据库连接"""
+    with _connections_lock:
+        entries = list(_connections.values())
+        _connections.clear()
+        _initialized_dbs.clear()
+    for conn, lock in entries:
+        with lock:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+    _fts_dbs.clear()
+
+
+atexit.register(close_connections)
+
+
+def _truncate_middle(text: str, limit: int) -> str:
+    """保留开头和结尾各一半，中间插入省略标记"""
+    if limit <= 0 or len(text) <= limit:
+        return text
+    half = limit // 2
+    omitted = len(text) - half * 2
+    return f"{text[:half]}\n... [{omitted} chars truncated] ...\n{text[-half:]}"
+
+
+def close_tool_calls(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    为没有对应结果的工具调用补上已取消的结果
+
+    工具执行前被中断（如在确认提示处按下 Ctrl+C）时，消息以带 tool_calls 的 assistant
+    消息结尾而没有对应的 tool 消息，OpenAI 兼容接口会拒绝这样的上下文。
+
+    Returns:
+        新的消息列表，原列表不变
+    """
+    closed: List[Dict[str, Any]] = []
+    pending: List[str] = []
+
+    def _close_pending() -> None:
+        closed.extend(
+            {"role": "tool", "tool_call_id": call_id, "content": CANCELLED_TOOL_RESULT}
+            for call_id in pending
+        )
+        pending.clear()
+
+    for message in messages:
+        if message.get("role") == "tool":
+            if message.get("tool_call_id") in pending:
+                pending.remove(message["tool_call_id"])
+        else:
+            _close_pending()
+            if message.get("role") == "assistant":
+                pending.extend(
+                    call["id"]
+                    for call in message.get("tool_calls") or []
+                    if call.get("id") is not None
+                )
+        closed.append(message)
+    _close_pending()
+    return closed
+
+
 class SessionManager:
     """会话管理器，负责记录、存储和检索用户交互历史，支持会话管理"""
 
@@ -34,45 +551,47 @@ class SessionManager:
 
     @contextlib.contextmanager
     def _db_connection(self):
-        """获取数据库连接的上下文管理器"""
-        self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        conn = sqlite3.connect(str(self.db_path))
-        try:
+        """获取本进程共享的数据库连接，使用期间独占该连接"""
+        conn, lock = _get_connection(self.db_path, self.config.history.busy_timeout_ms)
+        with lock:
+            try:
+                yield conn
+            except BaseException:
+                # 连接会被复用，不能留下未完成的事务
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+
+    def _begin_immediate(self, cursor) -> None:
+        """开始写事务，数据库被锁定时重试"""
+        begin_immediate(cursor, self.config.history.busy_retries)
+
+    @contextlib.contextmanager
+    def _write_transaction(self):
+        """在获取写锁的事务中使用共享连接，正常退出时提交"""
+        with self._db_connection() as conn:
+            self._begin_immediate(conn)
             yield conn
-        finally:
-            conn.close()
+            conn.commit()
 
     def _init_db(self) -> None:
-        """初始化SQLite数据库，创建必要的表"""
+        """初始化SQLite数据库，每个进程只在首次使用时检查并迁移结构"""
+        if str(self.db_path) in _initialized_dbs:
+            return
         try:
             with self._db_connection() as conn:
                 cursor = conn.cursor()
 
-                # 创建会话表
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS sessions (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    created_at TEXT NOT NULL,
-                    last_used TEXT NOT NULL,
-                    description TEXT,
-                    is_active INTEGER DEFAULT 0
-                )
-                """)
-
-                # 创建历史记录表
-                cursor.execute("""
-                CREATE TABLE IF NOT EXISTS history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    session_id TEXT NOT NULL,
-                    timestamp TEXT NOT NULL,
-                    type TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    response TEXT,
-                    metadata TEXT,
-                    FOREIGN KEY (session_id) REFERENCES sessions(id)
-                )
-                """)
+                # 加写锁后再读取版本，避免多个进程同时迁移
+                self._begin_immediate(cursor)
+                version = cursor.execute("PRAGMA user_version").fetchone()[0]
+                for target_version, statements in SCHEMA_MIGRATIONS:
+                    if target_version <= version:
+                        continue
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute(f"PRAGMA user_version = {target_version}")
+                    logger.debug(f"会话数据库结构已迁移到版本 {target_version}")
 
                 # 确保至少有一个活跃会话
                 cursor.execute("SELECT COUNT(*) FROM sessions WHERE is_active = 1")
@@ -91,11 +610,91 @@ class SessionManager:
                             WHERE id = (SELECT id FROM sessions ORDER BY last_used DESC LIMIT 1)"""
                         )
 
+                if self._ensure_search_index(cursor):
+                    _fts_dbs.add(str(self.db_path))
+
                 conn.commit()
+                _initialized_dbs.add(str(self.db_path))
                 logger.debug(f"会话数据库初始化成功：{self.db_path}")
         except sqlite3.Error as e:
             logger.error(f"初始化会话数据库失败: {e}")
 
+    def _get_fts_tokenizer(self) -> str:
+        """获取配置的全文索引分词器"""
+        tokenizer = self.config.history.fts_tokenizer
+        if tokenizer not in FTS_TOKENIZERS:
+            logger.warning(f"不支持的全文索引分词器: {tokenizer}，使用 unicode61")
+            return "unicode61"
+        return tokenizer
+
+    def _ensure_search_index(self, cursor, rebuild: bool = False) -> bool:
+        """
+        创建全文索引及同步触发器，新建时从已有历史记录回填
+
+        Args:
+            cursor: 处于写事务中的游标
+            rebuild: 是否删除已有索引，按当前配置的分词器重建
+
+        Returns:
+            全文索引是否可用（SQLite 未编译 FTS5 时不可用）
+        """
+        if rebuild:
+            cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+            cursor.execute(f"DROP TABLE IF EXISTS {SEGMENTS_FTS_TABLE}")
+        elif cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (FTS_TABLE,),
+        ).fetchone():
+            return True
+
+        tokenizer = self._get_fts_tokenizer()
+        try:
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+                    content, response, tokenize='{tokenizer}'
+                )
+                """)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"无法创建全文索引，搜索将使用逐行匹配: {e}")
+            return False
+        cursor.execute(f"DROP TABLE IF EXISTS {SEGMENTS_FTS_TABLE}")
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE {SEGMENTS_FTS_TABLE} USING fts5(
+                content, tokenize='{tokenizer}'
+            )
+            """)
+
+        for statement in _FTS_TRIGGERS:
+            cursor.execute(statement)
+        # 在本连接中解压已有的文本并回填
+        cursor.execute(f"""
+            INSERT INTO {FTS_TABLE} (rowid, content, response)
+            SELECT id, content, response FROM history_fts_source
+            """)
+        cursor.execute(f"""
+            INSERT INTO {SEGMENTS_FTS_TABLE} (rowid, content)
+            SELECT id, content FROM interaction_segments_text
+            """)
+        logger.debug(f"已创建全文索引，分词器: {tokenizer}")
+        return True
+
+    def rebuild_search_index(self) -> bool:
+        """按当前配置的分词器重建全文索引，并回填全部历史记录"""
+        try:
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
+                self._begin_immediate(cursor)
+                available = self._ensure_search_index(cursor, rebuild=True)
+                conn.commit()
+            if available:
+                _fts_dbs.add(str(self.db_path))
+            else:
+                _fts_dbs.discard(str(self.db_path))
+            return available
+        except sqlite3.Error as e:
+            logger.error(f"重建全文索引失败: {e}")
+            return False
+
     def _create_default_session(self, cursor):
         """创建默认会话"""
         default_session_id = str(uuid.uuid4())
@@ -114,6 +713,13 @@ class SessionManager:
         )
         return default_session_id
 
+    def _ensure_active_session(self, cursor) -> str:
+        """在当前写事务中获取活跃会话ID，没有活跃会话时创建默认会话"""
+        row = cursor.execute(
+            "SELECT id FROM sessions WHERE is_active = 1 LIMIT 1"
+        ).fetchone()
+        return row[0] if row else self._create_default_session(cursor)
+
     def get_active_session_id(self) -> str:
         """获取当前活跃会话的ID"""
         try:
@@ -137,7 +743,7 @@ class SessionManager:
     ) -> str:
         """创建新的会话，如果名称为空则使用默认名称"""
         try:
-            with self._db_connection() as conn:
+            with self._write_transaction() as conn:
                 cursor = conn.cursor()
 
                 # 如果未提供名称，生成默认名称
@@ -147,8 +753,8 @@ class SessionManager:
                 session_id = str(uuid.uuid4())
                 current_time = datetime.now().isoformat()
 
-                # 将所有会话设为非活跃
-                cursor.execute("UPDATE sessions SET is_active = 0")
+                # 唯一索引保证只有一个活跃会话，先取消当前的活跃会话
+                cursor.execute("UPDATE sessions SET is_active = 0 WHERE is_active = 1")
 
                 # 插入新会话
                 cursor.execute(
@@ -157,7 +763,6 @@ class SessionManager:
                     (session_id, name, current_time, current_time, description, 1),
                 )
 
-                conn.commit()
                 logger.debug(f"已创建新会话: {name}, ID: {session_id}")
                 return session_id
         except sqlite3.Error as e:
@@ -167,7 +772,7 @@ class SessionManager:
     def set_active_session(self, session_id: str) -> bool:
         """设置活跃会话"""
         try:
-            with self._db_connection() as conn:
+            with self._write_transaction() as conn:
                 cursor = conn.cursor()
 
                 # 检查会话是否存在
@@ -179,13 +784,12 @@ class SessionManager:
                     return False
 
                 # 更新所有会话状态
-                cursor.execute("UPDATE sessions SET is_active = 0")
+                cursor.execute("UPDATE sessions SET is_active = 0 WHERE is_active = 1")
                 cursor.execute(
                     "UPDATE sessions SET is_active = 1, last_used = ? WHERE id = ?",
                     (datetime.now().isoformat(), session_id),
                 )
 
-                conn.commit()
                 logger.debug(f"已将会话 {session_id} 设为活跃")
                 return True
         except sqlite3.Error as e:
@@ -195,7 +799,7 @@ class SessionManager:
     def rename_session(self, session_id: str, new_name: str) -> bool:
         """重命名会话"""
         try:
-            with self._db_connection() as conn:
+            with self._write_transaction() as conn:
                 cursor = conn.cursor()
 
                 cursor.execute(
@@ -203,7 +807,6 @@ class SessionManager:
                 )
 
                 affected = cursor.rowcount
-                conn.commit()
 
                 if affected > 0:
                     logger.debug(f"已将会话 {session_id} 重命名为 {new_name}")
@@ -221,38 +824,30 @@ class SessionManager:
             with self._db_connection() as conn:
                 cursor = conn.cursor()
 
-                # 检查是否是活跃会话
-                cursor.execute(
-                    "SELECT is_active FROM sessions WHERE id = ?", (session_id,)
-                )
+                # 检查会话是否存在
+                cursor.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,))
                 result = cursor.fetchone()
 
                 if not result:
                     logger.error(f"会话不存在: {session_id}")
                     return False
 
-                was_active = result[0] == 1
-
-                # 删除历史记录
-                cursor.execute(
-                    "DELETE FROM history WHERE session_id = ?", (session_id,)
-                )
-                # 删除会话
+            # 分批删除历史记录，然后删除会话
+            self._delete_history_batches("session_id = ?", (session_id,))
+            with self._write_transaction() as conn:
+                cursor = conn.cursor()
                 cursor.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
 
-                # 如果删除的是活跃会话，需要重新指定一个活跃会话
-                if was_active:
-                    cursor.execute(
-                        "SELECT id FROM sessions ORDER BY last_used DESC LIMIT 1"
-                    )
-                    result = cursor.fetchone()
-                    if result:
-                        cursor.execute(
-                            "UPDATE sessions SET is_active = 1 WHERE id = ?",
-                            (result[0],),
+                # 如果没有活跃会话了（删除的是活跃会话），重新指定一个活跃会话；
+                # 在写事务中检查，其他进程不会同时修改
+                cursor.execute("SELECT 1 FROM sessions WHERE is_active = 1")
+                if cursor.fetchone() is None:
+                    cursor.execute("""
+                        UPDATE sessions SET is_active = 1 WHERE id = (
+                            SELECT id FROM sessions ORDER BY last_used DESC LIMIT 1
                         )
+                        """)
 
-                conn.commit()
                 logger.debug(f"已删除会话: {session_id}")
                 return True
         except sqlite3.Error as e:
@@ -263,23 +858,12 @@ class SessionManager:
         """获取所有会话列表"""
         try:
             with self._db_connection() as conn:
-                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
 
-                cursor.execute("""
-                    SELECT 
-                        s.*, 
-                        COUNT(h.id) as interaction_count,
-                        MAX(h.timestamp) as last_interaction
-                    FROM 
-                        sessions s
-                    LEFT JOIN 
-                        history h ON s.id = h.session_id
-                    GROUP BY 
-                        s.id
-                    ORDER BY 
-                        s.is_active DESC, s.last_used DESC
-                """)
+                # interaction_count 和 last_interaction 由触发器维护
+                cursor.execute(
+                    "SELECT * FROM sessions ORDER BY is_active DESC, last_used DESC"
+                )
 
                 rows = cursor.fetchall()
                 sessions = [dict(row) for row in rows]
@@ -297,82 +881,127 @@ class SessionManager:
     ) -> int:
         """添加一个用户交互记录"""
         try:
-            with self._db_connection() as conn:
-                cursor = conn.cursor()
-
-                # 如果未指定会话ID，使用当前活跃会话
-                if not session_id:
-                    session_id = self.get_active_session_id()
-
-                # 更新会话的最后使用时间
-                current_time = datetime.now().isoformat()
-                cursor.execute(
-                    "UPDATE sessions SET last_used = ? WHERE id = ?",
-                    (current_time, session_id),
-                )
-
-                # 准备元数据
-                metadata_json = json.dumps(metadata) if metadata else None
-
-                # 插入交互记录
-                cursor.execute(
-                    """INSERT INTO history (session_id, timestamp, type, content, response, metadata) 
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                    (
-                        session_id,
-                        current_time,
-                        "query",  # 使用固定值"query"
-                        content,
-                        response,
-                        metadata_json,
-                    ),
+            with self._write_transaction() as conn:
+                record_id = self._insert_interaction(
+                    conn.cursor(), content, response, metadata, session_id
                 )
-
-                record_id = cursor.lastrowid
-                conn.commit()
-                logger.debug(f"已添加交互记录，ID: {record_id}，会话: {session_id}")
+                logger.debug(f"已添加交互记录，ID: {record_id}")
                 return record_id
         except sqlite3.Error as e:
             logger.error(f"添加交互记录失败: {e}")
             return -1
 
+    def _insert_interaction(
+        self,
+        cursor: sqlite3.Cursor,
+        content: str,
+        response: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+        timestamp: Optional[str] = None,
+    ) -> int:
+        """在当前事务中插入一条交互记录，返回记录 ID"""
+        # 如果未指定会话ID，使用当前活跃会话；已在写事务中，不能调用 create_session
+        if not session_id:
+            session_id = self._ensure_active_session(cursor)
+
+        # 更新会话的最后使用时间
+        current_time = timestamp or datetime.now().isoformat()
+        cursor.execute(
+            "UPDATE sessions SET last_used = ? WHERE id = ?",
+            (current_time, session_id),
+        )
+
+        # 准备元数据
+        metadata_json = json.dumps(metadata) if metadata else None
+        stored, response_ref = self._store_response(cursor, response)
+
+        # 插入交互记录
+        cursor.execute(
+            """INSERT INTO history (session_id, timestamp, type, content, response, metadata, response_ref)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (
+                session_id,
+                current_time,
+                "query",  # 使用固定值"query"
+                content,
+                stored,
+                metadata_json,
+                response_ref,
+            ),
+        )
+        record_id = cursor.lastrowid
+        self._index_interaction(cursor, record_id, content, response)
+        return record_id
+
+    def _index_interaction(
+        self, cursor, record_id: int, content: str, response: Optional[str]
+    ) -> None:
+        """把交互记录的纯文本写入全文索引，全文索引不可用时忽略"""
+        if str(self.db_path) not in _fts_dbs:
+            return
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, content, response) VALUES (?, ?, ?)",
+            (record_id, content, response),
+        )
+
+    def _index_segment(self, cursor, segment_id: int, text: str) -> None:
+        """把段落的纯文本写入全文索引，全文索引不可用时忽略"""
+        if str(self.db_path) not in _fts_dbs:
+            return
+        cursor.execute(
+            f"INSERT INTO {SEGMENTS_FTS_TABLE} (rowid, content) VALUES (?, ?)",
+            (segment_id, text),
+        )
+
     def get_history(
         self,
         limit: int = 10,
         offset: int = 0,
         search_query: Optional[str] = None,
         session_id: Optional[str] = None,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        preview_chars: Optional[int] = None,
     ) -> List[Dict[str, Any]]:
-        """获取交互历史记录"""
+        """
+        获取交互历史记录
+
+        Args:
+            limit: 最多返回的记录数
+            offset: 跳过的记录数，翻页时应使用 before_id
+            search_query: 搜索词
+            session_id: 会话ID，默认为当前活跃会话
+            before_id: 只返回按时间排在该记录之后（更早）的记录，按索引定位，与页数无关
+            after_id: 只返回 ID 大于该值的新记录，按 ID 升序排列，用于持续读取新记录
+            preview_chars: 只读取 content 和 response 的前若干个字符，用于列表显示
+
+        使用全文索引的搜索结果按相关度排序，不支持 before_id 和 after_id。
+        """
         try:
             with self._db_connection() as conn:
-                conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
 
                 # 如果未指定会话ID，使用当前活跃会话
                 if not session_id:
                     session_id = self.get_active_session_id()
 
-                # 构建查询
-                query = """
-                    SELECT h.*, s.name as session_name 
-                    FROM history h 
-                    JOIN sessions s ON h.session_id = s.id 
-                    WHERE h.session_id = ?
-                """
-                params = [session_id]
-
-                # 添加搜索条件
-                if search_query:
-                    query += " AND (h.content LIKE ? OR h.response LIKE ?)"
-                    params.extend([f"%{search_query}%", f"%{search_query}%"])
-
-                # 添加排序和分页
-                query += " ORDER BY h.timestamp DESC LIMIT ? OFFSET ?"
-                params.extend([limit, offset])
-
-                cursor.execute(query, params)
-                rows = cursor.fetchall()
+                columns = self._history_columns(preview_chars)
+                if search_query and self._can_use_fts(search_query):
+                    rows = self._search_fts(
+                        cursor, search_query, session_id, limit, offset, columns
+                    )
+                else:
+                    rows = self._search_like(
+                        cursor,
+                        search_query,
+                        session_id,
+                        limit,
+                        offset,
+                        columns,
+                        before_id=before_id,
+                        after_id=after_id,
+                    )
 
                 # 处理结果
                 results = []
@@ -387,21 +1016,158 @@ class SessionManager:
             logger.error(f"获取历史记录失败: {e}")
             return []
 
+    @staticmethod
+    def _history_columns(preview_chars: Optional[int] = None) -> str:
+        """查询 history_full h 时选择的列，指定 preview_chars 时只返回文本的开头部分"""
+        if preview_chars is None:
+            return "h.*"
+        n = max(0, int(preview_chars))
+        return f"""h.id, h.session_id, h.timestamp, h.type,
+            substr(h.content, 1, {n}) AS content,
+            substr(h.response, 1, {n}) AS response, h.metadata"""
+
+    def _can_use_fts(self, search_query: str) -> bool:
+        """判断搜索词能否使用全文索引"""
+        if str(self.db_path) not in _fts_dbs:
+            return False
+        terms = _parse_search_query(search_query)
+        if not terms:
+            return False
+        # trigram 分词器无法匹配少于三个字符的词
+        if self._get_fts_tokenizer() == "trigram":
+            return all(len(term) >= 3 for term, _ in terms)
+        return True
+
+    def _search_fts(
+        self, cursor, search_query, session_id, limit, offset, columns="h.*"
+    ):
+        """
+        使用全文索引搜索，按 BM25 相关度排序并生成高亮摘要
+
+        回复本身和追加的段落分别建立索引，一条记录取其中最相关的匹配作为排名和摘要。
+        """
+        fts_query = build_fts_query(search_query)
+        cursor.execute(
+            f"""
+            WITH hits (history_id, rank, snippet) AS (
+                SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, 2.0, 1.0),
+                    snippet({FTS_TABLE}, -1, ?, ?, '…', 16)
+                FROM {FTS_TABLE}
+                JOIN history h ON h.id = {FTS_TABLE}.rowid
+                WHERE {FTS_TABLE} MATCH ? AND h.session_id = ?
+                UNION ALL
+                SELECT g.history_id, bm25({SEGMENTS_FTS_TABLE}),
+                    snippet({SEGMENTS_FTS_TABLE}, 0, ?, ?, '…', 16)
+                FROM {SEGMENTS_FTS_TABLE}
+                JOIN interaction_segments g ON g.id = {SEGMENTS_FTS_TABLE}.rowid
+                JOIN history h ON h.id = g.history_id
+                WHERE {SEGMENTS_FTS_TABLE} MATCH ? AND h.session_id = ?
+            ),
+            -- 与 MIN 一起查询的 snippet 取自排名最高的那一行
+            best AS (
+                SELECT history_id, MIN(rank) AS rank, snippet
+                FROM hits GROUP BY history_id
+            )
+            SELECT {columns}, s.name as session_name, best.snippet, best.rank
+            FROM best
+            JOIN history_full h ON h.id = best.history_id
+            JOIN sessions s ON h.session_id = s.id
+            ORDER BY best.rank
+            LIMIT ? OFFSET ?
+            """,
+            (
+                SNIPPET_START,
+                SNIPPET_END,
+                fts_query,
+                session_id,
+                SNIPPET_START,
+                SNIPPET_END,
+                fts_query,
+                session_id,
+                limit,
+                offset,
+            ),
+        )
+        return cursor.fetchall()
+
+    def _search_like(
+        self,
+        cursor,
+        search_query,
+        session_id,
+        limit,
+        offset,
+        columns="h.*",
+        before_id=None,
+        after_id=None,
+    ):
+        """按时间倒序读取历史记录，有搜索词时逐行匹配"""
+        query = f"""
+            SELECT {columns}, s.name as session_name
+            FROM history_full h
+            JOIN sessions s ON h.session_id = s.id
+            WHERE h.session_id = ?
+        """
+        params = [session_id]
+
+        # 添加搜索条件
+        if search_query:
+            query += " AND (h.content LIKE ? OR h.response LIKE ?)"
+            params.extend([f"%{search_query}%", f"%{search_query}%"])
+
+        # 按 (session_id, timestamp) 索引从上一页的最后一条记录继续读取，不需要跳过前面的记录
+        if before_id is not None:
+            query += """ AND (h.timestamp, h.id) < (
+                SELECT timestamp, id FROM history WHERE id = ?
+            )"""
+            params.append(before_id)
+
+        # 添加排序和分页
+        if after_id is not None:
+            query += " AND h.id > ? ORDER BY h.id LIMIT ? OFFSET ?"
+            params.extend([after_id, limit, offset])
+        else:
+            query += " ORDER BY h.timestamp DESC, h.id DESC LIMIT ? OFFSET ?"
+            params.extend([limit, offset])
+
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+    def semantic_search(
+        self, query: str, limit: int = 10, session_id: Optional[str] = None
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        按语义搜索交互历史，搜索前先为新的历史记录建立向量索引
+
+        Returns:
+            按相似度排序的记录，嵌入模型不可用时返回 None
+        """
+        from viby.utils.history_index import HistoryVectorIndex
+
+        if not session_id:
+            session_id = self.get_active_session_id()
+        try:
+            index = HistoryVectorIndex(self, self.config.embedding.model_name)
+            added = index.sync()
+            if added:
+                logger.debug(f"已为 {added} 条历史记录建立向量索引")
+            return index.search(query, limit=limit, session_id=session_id)
+        except (RuntimeError, OSError, sqlite3.Error) as e:
+            logger.error(f"语义搜索失败: {e}")
+            return None
+
     def clear_history(self, session_id: Optional[str] = None) -> bool:
         """清除指定会话的历史记录，并重置ID自增器"""
         try:
-            with self._db_connection() as conn:
-                cursor = conn.cursor()
+            # 如果未指定会话ID，使用当前活跃会话
+            if not session_id:
+                session_id = self.get_active_session_id()
 
-                # 如果未指定会话ID，使用当前活跃会话
-                if not session_id:
-                    session_id = self.get_active_session_id()
-
-                # 删除指定会话的交互历史
-                cursor.execute(
-                    "DELETE FROM history WHERE session_id = ?", (session_id,)
-                )
+            # 分批删除指定会话的交互历史
+            self._delete_history_batches("session_id = ?", (session_id,))
 
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
                 # 重置自增器
                 cursor.execute("DELETE FROM sqlite_sequence WHERE name='history'")
 
@@ -413,6 +1179,270 @@ class SessionManager:
             logger.error(f"清除历史记录失败: {e}")
             return False
 
+    def _delete_history_batches(self, where: str, params: Tuple = ()) -> int:
+        """
+        分批删除满足条件的历史记录，每批一个事务，删除后回收空闲页
+
+        Returns:
+            删除的记录数
+        """
+        deleted = 0
+        while True:
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
+                self._begin_immediate(cursor)
+                cursor.execute(
+                    f"""
+                    DELETE FROM history WHERE id IN (
+                        SELECT id FROM history WHERE {where} LIMIT ?
+                    )
+                    """,
+                    (*params, DELETE_BATCH_SIZE),
+                )
+                count = cursor.rowcount
+                conn.commit()
+            deleted += count
+            if count < DELETE_BATCH_SIZE:
+                break
+        if deleted:
+            self._incremental_vacuum()
+        return deleted
+
+    def _incremental_vacuum(self) -> None:
+        """把空闲页归还给文件系统（仅 auto_vacuum 为 INCREMENTAL 的数据库）"""
+        with self._db_connection() as conn:
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+            if mode == _AUTO_VACUUM_INCREMENTAL:
+                conn.execute("PRAGMA incremental_vacuum").fetchall()
+
+    def get_storage_size(self) -> int:
+        """数据库文件及其 WAL 文件占用的字节数"""
+        size = 0
+        for suffix in ("", "-wal"):
+            path = Path(str(self.db_path) + suffix)
+            if path.exists():
+                size += path.stat().st_size
+        return size
+
+    def _collect_expired(
+        self, cursor, max_age_days: int, max_rows: int, max_bytes: int
+    ) -> None:
+        """把超出保留策略的记录ID写入临时表 gc_candidates"""
+        if max_age_days > 0:
+            cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat()
+            # 逐个会话使用 (session_id, timestamp) 索引
+            cursor.execute(
+                """
+                INSERT OR IGNORE INTO gc_candidates (id)
+                SELECT h.id FROM sessions s
+                JOIN history h ON h.session_id = s.id AND h.timestamp < ?
+                """,
+                (cutoff,),
+            )
+        if max_rows > 0:
+            # 交互数由触发器维护，只检查超出上限的会话
+            for (session_id,) in cursor.execute(
+                "SELECT id FROM sessions WHERE interaction_count > ?", (max_rows,)
+            ).fetchall():
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO gc_candidates (id)
+                    SELECT id FROM history WHERE session_id = ?
+                    ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?
+                    """,
+                    (session_id, max_rows),
+                )
+        if max_bytes > 0:
+            # 从最新的记录开始累计字节数，超出上限之后的记录全部删除
+            for (session_id,) in cursor.execute(
+                "SELECT id FROM sessions WHERE interaction_count > 0"
+            ).fetchall():
+                cursor.execute(
+                    """
+                    INSERT OR IGNORE INTO gc_candidates (id)
+                    SELECT id FROM (
+                        SELECT h.id, SUM(
+                            length(CAST(h.content AS BLOB))
+                            + COALESCE(length(CAST(h.response AS BLOB)), b.size, 0)
+                            + COALESCE(length(CAST(h.metadata AS BLOB)), 0)
+                            + COALESCE((
+                                SELECT SUM(COALESCE(
+                                    length(CAST(g.content AS BLOB)), gb.size, 0
+                                ))
+                                FROM interaction_segments g
+                                LEFT JOIN history_blobs gb ON gb.hash = g.content_ref
+                                WHERE g.history_id = h.id
+                            ), 0)
+                        ) OVER (ORDER BY h.timestamp DESC, h.id DESC) AS total
+                        FROM history h
+                        LEFT JOIN history_blobs b ON b.hash = h.response_ref
+                        WHERE h.session_id = ?
+                    )
+                    WHERE total > ?
+                    """,
+                    (session_id, max_bytes),
+                )
+
+    def apply_retention(
+        self,
+        max_age_days: Optional[int] = None,
+        max_rows: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        archive: Optional[bool] = None,
+        progress_callback: Optional[Callable[[int], None]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        按保留策略删除旧的交互记录，未指定的参数使用 history 配置
+
+        记录分批删除，每批一个事务；启用归档时删除前先写入历史目录下 history_archive 中的
+        压缩 JSONL 文件，可以用 import_history 恢复。
+
+        Args:
+            max_age_days: 删除早于该天数的记录
+            max_rows: 每个会话最多保留的记录数
+            max_bytes: 每个会话的记录最多占用的字节数
+            archive: 删除前是否归档
+            progress_callback: 每删除一批记录后以该批的记录数调用
+
+        Returns:
+            包含 deleted（删除的记录数）和 archive（归档文件路径或 None）的结果，失败时返回 None
+        """
+        history_config = self.config.history
+        if max_age_days is None:
+            max_age_days = history_config.retention_days
+        if max_rows is None:
+            max_rows = history_config.max_rows_per_session
+        if max_bytes is None:
+            max_bytes = history_config.max_bytes_per_session
+        if archive is None:
+            archive = history_config.archive_on_gc
+
+        result: Dict[str, Any] = {"deleted": 0, "archive": None}
+        try:
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "CREATE TEMP TABLE IF NOT EXISTS gc_candidates "
+                    "(id INTEGER PRIMARY KEY)"
+                )
+                cursor.execute("DELETE FROM gc_candidates")
+                self._collect_expired(cursor, max_age_days, max_rows, max_bytes)
+                conn.commit()
+
+            with contextlib.ExitStack() as stack:
+                writer = None
+                while True:
+                    with self._db_connection() as conn:
+                        cursor = conn.cursor()
+                        self._begin_immediate(cursor)
+                        last_id = cursor.execute(
+                            """
+                            SELECT MAX(id) FROM (
+                                SELECT id FROM gc_candidates ORDER BY id LIMIT ?
+                            )
+                            """,
+                            (DELETE_BATCH_SIZE,),
+                        ).fetchone()[0]
+                        if last_id is None:
+                            conn.rollback()
+                            break
+
+                        if archive:
+                            if writer is None:
+                                path = self._new_archive_path()
+                                stream = stack.enter_context(
+                                    history_io.open_text(str(path), "w")
+                                )
+                                writer = history_io.RecordWriter(stream, "jsonl", [])
+                                result["archive"] = str(path)
+                            rows = cursor.execute(
+                                """
+                                SELECT h.*, s.name as session_name
+                                FROM history_full h
+                                JOIN sessions s ON h.session_id = s.id
+                                WHERE h.id IN (
+                                    SELECT id FROM gc_candidates WHERE id <= ?
+                                )
+                                ORDER BY h.id
+                                """,
+                                (last_id,),
+                            ).fetchall()
+                            writer.write_batch([dict(row) for row in rows])
+                            # 归档内容落盘后再提交删除
+                            writer.stream.flush()
+
+                        cursor.execute(
+                            """
+                            DELETE FROM history WHERE id IN (
+                                SELECT id FROM gc_candidates WHERE id <= ?
+                            )
+                            """,
+                            (last_id,),
+                        )
+                        count = cursor.rowcount
+                        cursor.execute(
+                            "DELETE FROM gc_candidates WHERE id <= ?", (last_id,)
+                        )
+                        conn.commit()
+
+                    result["deleted"] += count
+                    self._incremental_vacuum()
+                    if progress_callback:
+                        progress_callback(count)
+
+            logger.info(f"保留策略已删除 {result['deleted']} 条历史记录")
+            return result
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.error(f"执行历史记录保留策略失败: {e}")
+            return None
+
+    def _new_archive_path(self) -> Path:
+        """本次清理的归档文件路径"""
+        archive_dir = self.db_path.with_name("history_archive")
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        return archive_dir / f"history-{datetime.now():%Y%m%d-%H%M%S-%f}.jsonl.gz"
+
+    def compact_database(self) -> bool:
+        """
+        回收数据库文件中的空闲空间并截断 WAL 文件
+
+        压缩前把旧的大段内联回复转存到 history_blobs，并删除不再被引用的内容。
+
+        auto_vacuum 不是 INCREMENTAL 的旧数据库会执行一次完整的 VACUUM 并转换模式，
+        之后的删除都可以增量回收空间。
+        """
+        try:
+            moved = self._externalize_responses()
+            if moved:
+                logger.debug(f"已把 {moved} 条大段回复转存到 history_blobs")
+            with self._db_connection() as conn:
+                # 删除不再被引用的内容
+                conn.execute("""
+                    DELETE FROM history_blobs
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM history WHERE response_ref = history_blobs.hash
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1 FROM interaction_segments
+                        WHERE content_ref = history_blobs.hash
+                    )
+                    AND NOT EXISTS (
+                        SELECT 1 FROM messages WHERE content_ref = history_blobs.hash
+                    )
+                    """)
+                conn.commit()
+                mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+                if mode != _AUTO_VACUUM_INCREMENTAL:
+                    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                    conn.execute("VACUUM")
+                else:
+                    conn.execute("PRAGMA incremental_vacuum").fetchall()
+                conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"压缩历史数据库失败: {e}")
+            return False
+
     def _generate_default_session_name(self) -> str:
         """生成默认会话名称 (会话+数字)"""
         try:
@@ -430,94 +1460,569 @@ class SessionManager:
     def export_history(
         self,
         file_path: str,
-        format_type: str = "json",
+        format_type: Optional[str] = None,
         session_id: Optional[str] = None,
+        all_sessions: bool = False,
+        progress_callback: Optional[Callable[[int], None]] = None,
     ) -> bool:
-        """导出历史记录到文件"""
+        """
+        流式导出历史记录到文件
+
+        记录按批从游标读取并写出，内存占用与记录数无关。文件名以 .gz 或 .zst 结尾时压缩输出。
+
+        Args:
+            file_path: 导出文件路径
+            format_type: 导出格式，默认根据扩展名推断
+            session_id: 会话ID，默认为当前活跃会话
+            all_sessions: 导出所有会话
+            progress_callback: 每写出一批记录后以该批的记录数调用
+        """
+        format_type = format_type or history_io.infer_format(file_path)
         try:
-            # 如果未指定会话ID，使用当前活跃会话
-            if not session_id:
-                session_id = self.get_active_session_id()
-
-            # 获取历史记录
-            records = self._get_records_for_export(session_id)
-
-            # 如果没有记录，直接返回成功
-            if not records:
-                return True
-
-            # 导出文件
-            return self._write_export_file(file_path, records, format_type)
+            if all_sessions:
+                session_ids = [session["id"] for session in self.get_sessions()]
+            else:
+                session_ids = [session_id or self.get_active_session_id()]
+
+            with (
+                history_io.open_text(file_path, "w") as f,
+                self._db_connection() as conn,
+            ):
+                writer = None
+                for sid in session_ids:
+                    cursor = conn.execute(
+                        """
+                        SELECT h.*, s.name as session_name
+                        FROM history_full h
+                        JOIN sessions s ON h.session_id = s.id
+                        WHERE h.session_id = ?
+                        ORDER BY h.timestamp DESC
+                        """,
+                        (sid,),
+                    )
+                    if writer is None:
+                        fieldnames = [column[0] for column in cursor.description]
+                        writer = history_io.RecordWriter(f, format_type, fieldnames)
+                    while True:
+                        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+                        if not rows:
+                            break
+                        writer.write_batch([dict(row) for row in rows])
+                        if progress_callback:
+                            progress_callback(len(rows))
+                if writer is not None:
+                    writer.close()
+
+            logger.info(f"历史记录已导出到 {file_path}, 格式: {format_type}")
+            return True
         except Exception as e:
             logger.error(f"导出历史记录失败: {e}")
+            with contextlib.suppress(OSError):
+                Path(file_path).unlink()
             return False
 
-    def _get_records_for_export(self, session_id: str) -> List[Dict[str, Any]]:
-        """获取用于导出的记录"""
+    def import_history(
+        self,
+        file_path: str,
+        format_type: Optional[str] = None,
+        session_id: Optional[str] = None,
+        progress_callback: Optional[Callable[[int], None]] = None,
+    ) -> Optional[Dict[str, int]]:
+        """
+        从导出文件批量导入历史记录
+
+        记录保留原来的会话ID，本地不存在的会话会被创建；指定 session_id 时全部导入到该会话。
+        会话、时间戳和内容哈希都相同的记录视为重复，不会再次导入，因此可以重复导入同一文件，
+        或合并多台机器导出的历史。
+
+        Args:
+            file_path: 导入文件路径，支持 json、jsonl 和 csv，可以是 .gz 或 .zst 压缩文件
+            format_type: 文件格式，默认根据扩展名推断
+            session_id: 导入到指定会话
+            progress_callback: 每处理一批记录后以该批的记录数调用
+
+        Returns:
+            包含 imported、skipped 和 sessions（新建的会话数）的统计，失败时返回 None
+        """
+        stats = {"imported": 0, "skipped": 0, "sessions": 0}
+        known_sessions: Dict[str, str] = {}
+        try:
+            if session_id:
+                if not self._session_exists(session_id):
+                    logger.error(f"会话不存在: {session_id}")
+                    return None
+                known_sessions[session_id] = session_id
+            default_session = session_id or self.get_active_session_id()
+
+            records = history_io.iter_records(file_path, format_type)
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(_IMPORT_STAGING_TABLE)
+                fts_start = None
+                transaction_rows = 0
+                try:
+                    for batch in history_io.batched(records, IMPORT_BATCH_SIZE):
+                        if not transaction_rows:
+                            fts_start = self._begin_import(cursor)
+                        self._import_batch(
+                            cursor,
+                            batch,
+                            session_id,
+                            default_session,
+                            known_sessions,
+                            stats,
+                        )
+                        transaction_rows += len(batch)
+                        if transaction_rows >= IMPORT_TRANSACTION_SIZE:
+                            self._finish_import(cursor, fts_start)
+                            conn.commit()
+                            transaction_rows = 0
+                        if progress_callback:
+                            progress_callback(len(batch))
+                    if transaction_rows:
+                        self._finish_import(cursor, fts_start)
+                        conn.commit()
+                finally:
+                    if conn.in_transaction:
+                        conn.rollback()
+                    cursor.execute("DROP TABLE IF EXISTS temp.import_staging")
+
+            logger.info(
+                f"已从 {file_path} 导入 {stats['imported']} 条历史记录，"
+                f"跳过 {stats['skipped']} 条重复记录"
+            )
+            return stats
+        except (OSError, ValueError, sqlite3.Error) as e:
+            logger.error(f"导入历史记录失败: {e}")
+            return None
+
+    def _session_exists(self, session_id: str) -> bool:
         with self._db_connection() as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
+            return (
+                conn.execute(
+                    "SELECT 1 FROM sessions WHERE id = ?", (session_id,)
+                ).fetchone()
+                is not None
+            )
 
-            cursor.execute(
-                """
-                SELECT h.*, s.name as session_name 
-                FROM history h 
-                JOIN sessions s ON h.session_id = s.id 
-                WHERE h.session_id = ? 
-                ORDER BY h.timestamp DESC
-                """,
-                (session_id,),
+    def _begin_import(self, cursor) -> Optional[int]:
+        """
+        开始一个导入事务；全文索引可用时在事务结束前一次性补写本事务导入的记录
+
+        Returns:
+            需要补写全文索引的起始记录ID，全文索引不可用时返回 None
+        """
+        self._begin_immediate(cursor)
+        if str(self.db_path) not in _fts_dbs:
+            return None
+        # AUTOINCREMENT 保证新记录的ID大于已有的最大ID
+        return cursor.execute("SELECT COALESCE(MAX(id), 0) FROM history").fetchone()[0]
+
+    def _finish_import(self, cursor, fts_start: Optional[int]) -> None:
+        """按记录ID顺序补写本事务导入的记录的全文索引"""
+        if fts_start is None:
+            return
+        cursor.execute(
+            f"""
+            INSERT INTO {FTS_TABLE} (rowid, content, response)
+            SELECT id, content, response FROM history_fts_source WHERE id > ?
+            """,
+            (fts_start,),
+        )
+
+    def _import_batch(
+        self,
+        cursor,
+        records: List[Dict[str, Any]],
+        target_session: Optional[str],
+        default_session: str,
+        known_sessions: Dict[str, str],
+        stats: Dict[str, int],
+    ) -> None:
+        """在当前事务中写入一批记录，跳过已存在的重复记录"""
+        rows = []
+        for record in records:
+            content = record.get("content")
+            if not content:
+                continue
+            session_id = target_session or self._map_import_session(
+                cursor, record, default_session, known_sessions, stats
+            )
+            response = record.get("response")
+            metadata = record.get("metadata")
+            if metadata is not None and not isinstance(metadata, str):
+                metadata = json.dumps(metadata)
+            content_hash = hashlib.sha256(
+                f"{content}\0{response or ''}".encode("utf-8")
+            ).hexdigest()
+            rows.append(
+                (
+                    session_id,
+                    record.get("timestamp") or datetime.now().isoformat(),
+                    record.get("type") or "query",
+                    content,
+                    response,
+                    metadata,
+                    content_hash,
+                )
             )
 
-            rows = cursor.fetchall()
-            records = [dict(row) for row in rows]
+        cursor.executemany(
+            "INSERT OR IGNORE INTO import_staging VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        # 先去掉已存在的记录，再只为实际写入的记录保存大段回复，重复记录不会留下无用的数据。
+        # 已有记录没有保存哈希，用会话和时间戳索引定位后比较完整回复，
+        # 导出文件中的回复包含追加的段落
+        cursor.execute("""
+            DELETE FROM import_staging
+            WHERE EXISTS (
+                SELECT 1 FROM history_full h
+                WHERE h.session_id = import_staging.session_id
+                    AND h.timestamp = import_staging.timestamp
+                    AND h.content = import_staging.content
+                    AND h.response IS import_staging.response
+            )
+            """)
+        new_rows = []
+        for session_id, timestamp, kind, content, response, metadata in cursor.execute(
+            """
+            SELECT session_id, timestamp, type, content, response, metadata
+            FROM import_staging ORDER BY rowid
+            """
+        ).fetchall():
+            stored, response_ref = self._store_response(cursor, response)
+            new_rows.append(
+                (session_id, timestamp, kind, content, stored, metadata, response_ref)
+            )
+        cursor.executemany(
+            """
+            INSERT INTO history (
+                session_id, timestamp, type, content, response, metadata, response_ref
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            new_rows,
+        )
+        imported = len(new_rows)
+        cursor.execute("DELETE FROM import_staging")
+        stats["imported"] += imported
+        # 重复记录和缺少内容的无效记录都计为跳过
+        stats["skipped"] += len(records) - imported
 
-            # 处理元数据字段
-            for record in records:
-                if record.get("metadata"):
-                    record["metadata"] = json.loads(record["metadata"])
+    def _map_import_session(
+        self,
+        cursor,
+        record: Dict[str, Any],
+        default_session: str,
+        known_sessions: Dict[str, str],
+        stats: Dict[str, int],
+    ) -> str:
+        """确定导入记录所属的本地会话，本地不存在时按原ID和名称创建"""
+        source_id = record.get("session_id")
+        if not source_id:
+            return default_session
+        if source_id in known_sessions:
+            return known_sessions[source_id]
 
-            return records
+        current_time = datetime.now().isoformat()
+        cursor.execute(
+            """INSERT OR IGNORE INTO sessions (id, name, created_at, last_used, description, is_active)
+            VALUES (?, ?, ?, ?, ?, 0)""",
+            (
+                source_id,
+                record.get("session_name") or f"导入会话{source_id[:8]}",
+                current_time,
+                current_time,
+                "从导出文件导入的会话",
+            ),
+        )
+        if cursor.rowcount:
+            stats["sessions"] += 1
+        known_sessions[source_id] = source_id
+        return source_id
+
+    def _store_response(
+        self, cursor, response: Optional[str]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        """
+        大段回复按内容哈希压缩保存到 history_blobs
+
+        Returns:
+            写入 history 的 (response, response_ref)，二者只有一个非空
+        """
+        threshold = self.config.history.blob_threshold
+        if not response or threshold <= 0:
+            return response, None
+        data = response.encode("utf-8")
+        if len(data) < threshold:
+            return response, None
+
+        digest = hashlib.sha256(data).hexdigest()
+        if cursor.execute(
+            "SELECT 1 FROM history_blobs WHERE hash = ?", (digest,)
+        ).fetchone():
+            return None, digest
+
+        codec = self.config.history.blob_codec
+        try:
+            compressed = history_io.compress_bytes(data, codec)
+        except ValueError as e:
+            logger.warning(f"{e}，改用 zlib 压缩")
+            codec, compressed = "zlib", history_io.compress_bytes(data, "zlib")
+        if len(compressed) >= len(data):
+            codec, compressed = "raw", data
+        cursor.execute(
+            "INSERT INTO history_blobs (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+            (digest, codec, len(data), compressed),
+        )
+        return None, digest
+
+    def _externalize_responses(self) -> int:
+        """把阈值以上的内联回复转存到 history_blobs，用于启用该功能之前的记录"""
+        threshold = self.config.history.blob_threshold
+        if threshold <= 0:
+            return 0
+        moved = 0
+        last_id = 0
+        while True:
+            with self._db_connection() as conn:
+                cursor = conn.cursor()
+                self._begin_immediate(cursor)
+                rows = cursor.execute(
+                    """
+                    SELECT id, response FROM history
+                    WHERE id > ? AND response_ref IS NULL
+                        AND length(CAST(response AS BLOB)) >= ?
+                    ORDER BY id LIMIT ?
+                    """,
+                    (last_id, threshold, DELETE_BATCH_SIZE),
+                ).fetchall()
+                for row in rows:
+                    response, response_ref = self._store_response(
+                        cursor, row["response"]
+                    )
+                    cursor.execute(
+                        "UPDATE history SET response = ?, response_ref = ? WHERE id = ?",
+                        (response, response_ref, row["id"]),
+                    )
+                conn.commit()
+            if not rows:
+                return moved
+            moved += len(rows)
+            last_id = rows[-1]["id"]
+
+    def append_segment(self, record_id: int, text: str) -> bool:
+        """
+        向交互记录追加一段回复（工具结果或后续回复）
+
+        段落单独保存，读取时与回复拼接，每次写入只与段落本身的大小有关。
+        """
+        if not text:
+            return True
+        try:
+            with self._write_transaction() as conn:
+                appended = self._insert_segment(conn.cursor(), record_id, text)
+                if not appended:
+                    logger.warning(f"交互记录不存在，无法追加: {record_id}")
+                return appended
+        except sqlite3.Error as e:
+            logger.error(f"追加交互记录失败: {e}")
+            return False
 
-    def _write_export_file(
-        self, file_path: str, records: List[Dict[str, Any]], format_type: str
+    def _insert_segment(
+        self,
+        cursor: sqlite3.Cursor,
+        record_id: int,
+        text: str,
+        timestamp: Optional[str] = None,
     ) -> bool:
-        """写入导出文件"""
-        with open(file_path, "w", encoding="utf-8") as f:
-            if format_type == "json":
-                json.dump(records, f, ensure_ascii=False, indent=2)
-            elif format_type == "csv":
-                if not records:
-                    return True
+        """在当前事务中追加一个段落，交互记录不存在时返回 False"""
+        content, content_ref = self._store_response(cursor, text)
+        cursor.execute(
+            """
+            INSERT INTO interaction_segments
+                (history_id, created_at, content, content_ref)
+            SELECT id, ?, ?, ? FROM history WHERE id = ?
+            """,
+            (
+                timestamp or datetime.now().isoformat(),
+                content,
+                content_ref,
+                record_id,
+            ),
+        )
+        if not cursor.rowcount:
+            return False
+        self._index_segment(cursor, cursor.lastrowid, text)
+        return True
 
-                # CSV导出
-                writer = csv.DictWriter(f, fieldnames=records[0].keys())
-                writer.writeheader()
-
-                # 处理复杂字段
-                for record in records:
-                    if isinstance(record.get("metadata"), dict):
-                        record["metadata"] = json.dumps(record["metadata"])
-                    writer.writerow(record)
-            elif format_type == "yaml":
-                yaml.dump(records, f, allow_unicode=True)
-            else:
-                logger.error(f"不支持的导出格式: {format_type}")
-                return False
+    def add_messages(self, record_id: int, messages: List[Dict[str, Any]]) -> bool:
+        """
+        保存一次交互中按角色划分的完整消息
 
-        logger.info(f"历史记录已导出到 {file_path}, 格式: {format_type}")
-        return True
+        Args:
+            record_id: 消息所属的交互记录 ID
+            messages: OpenAI 格式的消息，可以带有 token_count（估算的 token 数）
+                和 compacted（是否为压缩摘要）字段
+        """
+        try:
+            with self._write_transaction() as conn:
+                saved = self._insert_messages(conn.cursor(), record_id, messages)
+            if not saved and messages:
+                logger.warning(f"交互记录不存在，无法保存消息: {record_id}")
+            return bool(saved) or not messages
+        except sqlite3.Error as e:
+            logger.error(f"保存交互消息失败: {e}")
+            return False
 
-    def update_interaction(self, record_id: int, new_response: str) -> bool:
-        """更新交互记录的response字段"""
+    def _insert_messages(
+        self,
+        cursor: sqlite3.Cursor,
+        record_id: int,
+        messages: List[Dict[str, Any]],
+        timestamp: Optional[str] = None,
+    ) -> int:
+        """在当前事务中保存消息，返回保存的条数，交互记录不存在时不保存"""
+        if not cursor.execute(
+            "SELECT 1 FROM history WHERE id = ?", (record_id,)
+        ).fetchone():
+            return 0
+        created_at = timestamp or datetime.now().isoformat()
+        rows = []
+        for message in messages:
+            content, content_ref = self._store_response(cursor, message.get("content"))
+            tool_calls = message.get("tool_calls")
+            rows.append(
+                (
+                    record_id,
+                    created_at,
+                    message["role"],
+                    content,
+                    content_ref,
+                    json.dumps(tool_calls, ensure_ascii=False) if tool_calls else None,
+                    message.get("tool_call_id"),
+                    int(message.get("token_count") or 0),
+                    1 if message.get("compacted") else 0,
+                )
+            )
+        cursor.executemany(
+            """
+            INSERT INTO messages (history_id, created_at, role, content, content_ref,
+                tool_calls, tool_call_id, token_count, compacted)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+        return len(rows)
+
+    def get_recent_messages(
+        self,
+        max_turns: int = 3,
+        session_id: Optional[str] = None,
+        max_tool_chars: int = REPLAY_TOOL_RESULT_CHARS,
+    ) -> List[Dict[str, Any]]:
+        """
+        按原样重建最近几次交互的消息列表，用作下一轮对话的上下文
+
+        保存了完整消息的交互直接使用保存的消息（包括工具调用和工具结果）；
+        更早的或导入的交互只有问题和回复，转换为一问一答。
+        最近的压缩摘要已经概括了它之前的对话，从摘要开始重建。
+        没有结果的工具调用（工具执行前被中断）补上已取消的结果。
+        工具结果（如很长的命令输出）超过 max_tool_chars 个字符时从中间省略，
+        避免一条结果占满上下文窗口。
+
+        Returns:
+            OpenAI 格式的消息，从最早的开始
+        """
+        if max_turns <= 0:
+            return []
         try:
             with self._db_connection() as conn:
+                if not session_id:
+                    session_id = self.get_active_session_id()
+                # 保存了消息的交互不需要读取（可能很长的）完整回复
+                turns = conn.execute(
+                    """
+                    SELECT h.id, h.content, CASE WHEN EXISTS (
+                        SELECT 1 FROM messages WHERE history_id = h.id
+                    ) THEN NULL ELSE h.response END AS response
+                    FROM history_full h
+                    WHERE h.session_id = ?
+                    ORDER BY h.timestamp DESC, h.id DESC LIMIT ?
+                    """,
+                    (session_id, max_turns),
+                ).fetchall()[::-1]
+                if not turns:
+                    return []
+
+                placeholders = ",".join("?" * len(turns))
+                rows = conn.execute(
+                    f"""
+                    SELECT m.history_id, m.role,
+                        {_stored_text_sql("m.content", "m.content_ref")} AS content,
+                        m.tool_calls, m.tool_call_id, m.compacted
+                    FROM messages m
+                    WHERE m.history_id IN ({placeholders})
+                    ORDER BY m.history_id, m.id
+                    """,
+                    [turn["id"] for turn in turns],
+                ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"读取交互消息失败: {e}")
+            return []
+
+        stored: Dict[int, List[sqlite3.Row]] = {}
+        for row in rows:
+            stored.setdefault(row["history_id"], []).append(row)
+
+        messages: List[Dict[str, Any]] = []
+        for turn in turns:
+            turn_rows = stored.get(turn["id"])
+            if not turn_rows:
+                if turn["content"]:
+                    messages.append({"role": "user", "content": turn["content"]})
+                    if turn["response"]:
+                        messages.append(
+                            {"role": "assistant", "content": turn["response"]}
+                        )
+                continue
+            for row in turn_rows:
+                if row["compacted"]:
+                    # 摘要之前的消息已被概括
+                    messages = []
+                message = {"role": row["role"], "content": row["content"] or ""}
+                if row["role"] == "tool":
+                    message["content"] = _truncate_middle(
+                        message["content"], max_tool_chars
+                    )
+                if row["tool_calls"]:
+                    message["tool_calls"] = json.loads(row["tool_calls"])
+                if row["tool_call_id"]:
+                    message["tool_call_id"] = row["tool_call_id"]
+                messages.append(message)
+        return close_tool_calls(messages)
+
+    def update_interaction(self, record_id: int, new_response: str) -> bool:
+        """替换交互记录的完整回复，已追加的段落一并删除"""
+        try:
+            with self._write_transaction() as conn:
                 cursor = conn.cursor()
                 cursor.execute(
-                    """UPDATE history SET response=? WHERE id=?""",
-                    (new_response, record_id),
+                    "DELETE FROM interaction_segments WHERE history_id = ?",
+                    (record_id,),
                 )
-                conn.commit()
+                response, response_ref = self._store_response(cursor, new_response)
+                cursor.execute(
+                    """UPDATE history SET response=?, response_ref=? WHERE id=?""",
+                    (response, response_ref, record_id),
+                )
+                if cursor.rowcount and str(self.db_path) in _fts_dbs:
+                    content = cursor.execute(
+                        "SELECT content FROM history WHERE id = ?", (record_id,)
+                    ).fetchone()[0]
+                    cursor.execute(
+                        f"DELETE FROM {FTS_TABLE} WHERE rowid = ?", (record_id,)
+                    )
+                    self._index_interaction(cursor, record_id, content, new_response)
 
                 logger.debug(f"已更新交互记录，ID: {record_id}")
                 return True
@@ -0,0 +1,288 @@
+"""
+会话历史的语义搜索索引
+
+每条交互的嵌入向量以 float16 追加写入 history.db 旁边的内存映射文件，对应的历史记录 ID
+保存在另一个 int64 文件中。索引按历史记录 ID 增量更新，只为新记录生成向量；历史记录被删除时，
+触发器把 ID 写入 history_deletions 表，下次更新索引时将对应向量标记为已删除，
+已删除的向量过多时压缩文件。
+
+生成向量时优先使用正在运行的嵌入模型服务器，否则在本进程中加载模型。
+"""
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 每批生成向量的记录数
+EMBED_BATCH_SIZE = 256
+# 搜索时每次转换为 float32 计算的向量数，限制临时内存占用
+SEARCH_CHUNK_SIZE = 65536
+# 每条记录参与生成向量的最大字符数
+MAX_TEXT_CHARS = 1000
+
+_TRACKING_STATEMENTS = [
+    "CREATE TABLE IF NOT EXISTS history_deletions (id INTEGER PRIMARY KEY)",
+    """
+    CREATE TRIGGER IF NOT EXISTS history_vectors_delete AFTER DELETE ON history
+    BEGIN
+        INSERT OR IGNORE INTO history_deletions (id) VALUES (OLD.id);
+    END
+    """,
+]
+
+
+def embed_texts(texts: List[str]) -> Optional[np.ndarray]:
+    """
+    生成归一化的嵌入向量
+
+    Returns:
+        形状为 (len(texts), dim) 的 float32 数组，模型不可用时返回 None
+    """
+    from viby.viby_tool_search.client import embed_texts as embed_with_server
+
+    embeddings = embed_with_server(texts)
+    if embeddings is None:
+        from viby.viby_tool_search.embedding_manager import EmbeddingManager
+
+        embeddings = EmbeddingManager().encode(texts)
+    return embeddings
+
+
+class HistoryVectorIndex:
+    """基于内存映射文件的会话历史向量索引"""
+
+    def __init__(self, session_manager, model_name: str):
+        """
+        Args:
+            session_manager: 提供数据库连接的 SessionManager
+            model_name: 嵌入模型名称，与已有索引不一致时重建索引
+        """
+        self.session_manager = session_manager
+        self.model_name = model_name
+        base = Path(session_manager.db_path).with_name("history_vectors")
+        self.vectors_path = base.with_suffix(".f16")
+        self.ids_path = base.with_suffix(".ids")
+        self.meta_path = base.with_suffix(".json")
+        self.dim: Optional[int] = None
+        self._load_meta()
+
+    def _load_meta(self) -> None:
+        """读取索引元数据，模型变化或文件不完整时清空索引"""
+        meta = {}
+        if self.meta_path.exists():
+            try:
+                meta = json.loads(self.meta_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError) as e:
+                logger.warning(f"读取历史向量索引元数据失败: {e}")
+
+        if meta.get("model") != self.model_name or not meta.get("dim"):
+            self._reset()
+            return
+
+        self.dim = int(meta["dim"])
+        expected_size = self._count() * self.dim * 2
+        size = self.vectors_path.stat().st_size if self.vectors_path.exists() else 0
+        if size > expected_size:
+            # 上次追加时向量已写入而 ID 未写入，丢弃多出的部分
+            with open(self.vectors_path, "r+b") as f:
+                f.truncate(expected_size)
+        elif size < expected_size:
+            logger.warning("历史向量索引文件不完整，重新建立索引")
+            self._reset()
+
+    def _reset(self) -> None:
+        """删除索引文件"""
+        for path in (self.vectors_path, self.ids_path, self.meta_path):
+            path.unlink(missing_ok=True)
+        self.dim = None
+        # 触发器和表一起删除，否则删除历史记录时触发器找不到表而失败
+        with self.session_manager._write_transaction() as conn:
+            conn.execute("DROP TRIGGER IF EXISTS history_vectors_delete")
+            conn.execute("DROP TABLE IF EXISTS history_deletions")
+
+    def _write_meta(self) -> None:
+        meta = {"model": self.model_name, "dim": self.dim}
+        self.meta_path.write_text(json.dumps(meta), encoding="utf-8")
+
+    def _count(self) -> int:
+        """索引中的向量数（包括已删除的）"""
+        if not self.ids_path.exists():
+            return 0
+        return self.ids_path.stat().st_size // 8
+
+    def _load_ids(self, mode: str = "r") -> np.ndarray:
+        count = self._count()
+        if not count:
+            return np.empty(0, dtype=np.int64)
+        return np.memmap(self.ids_path, dtype=np.int64, mode=mode, shape=(count,))
+
+    def _load_vectors(self) -> np.ndarray:
+        count = self._count()
+        return np.memmap(
+            self.vectors_path, dtype=np.float16, mode="r", shape=(count, self.dim)
+        )
+
+    def _append(self, ids: List[int], vectors: np.ndarray) -> None:
+        """追加一批向量，先写向量再写 ID，中断时不完整的数据会在加载时被发现"""
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+            self._write_meta()
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float16).tobytes())
+        with open(self.ids_path, "ab") as f:
+            f.write(np.asarray(ids, dtype=np.int64).tobytes())
+
+    def _apply_deletions(self) -> None:
+        """把已删除的历史记录对应的向量标记为删除"""
+        with self.session_manager._write_transaction() as conn:
+            cursor = conn.cursor()
+            for statement in _TRACKING_STATEMENTS:
+                cursor.execute(statement)
+            deleted = [
+                row[0] for row in cursor.execute("SELECT id FROM history_deletions")
+            ]
+            if deleted and self._count():
+                ids = self._load_ids("r+")
+                ids[np.isin(ids, np.asarray(deleted, dtype=np.int64))] = -1
+                ids.flush()
+                del ids
+            cursor.execute("DELETE FROM history_deletions")
+
+        ids = self._load_ids()
+        removed = int(np.count_nonzero(ids < 0))
+        if removed and removed * 2 >= len(ids):
+            self._compact()
+
+    def _compact(self) -> None:
+        """重写索引文件，去掉已删除的向量"""
+        ids = np.array(self._load_ids())
+        live = ids >= 0
+        vectors = np.array(self._load_vectors()[live])
+        for path, data in ((self.vectors_path, vectors), (self.ids_path, ids[live])):
+            tmp_path = path.with_suffix(path.suffix + ".tmp")
+            data.tofile(tmp_path)
+            tmp_path.replace(path)
+        logger.debug(f"已压缩历史向量索引，保留 {int(live.sum())} 条")
+
+    def _watermark(self) -> int:
+        """索引中最大的有效历史记录 ID，之后的记录尚未建立索引"""
+        ids = self._load_ids()
+        live = ids[ids >= 0]
+        return int(live.max()) if len(live) else 0
+
+    def sync(self) -> int:
+        """
+        为尚未建立索引的历史记录生成向量
+
+        Returns:
+            新增的向量数
+
+        Raises:
+            RuntimeError: 嵌入模型不可用
+        """
+        self._apply_deletions()
+        last_id = self._watermark()
+        added = 0
+        while True:
+            with self.session_manager._db_connection() as conn:
+                rows = conn.execute(
+                    """
+                    SELECT id, content, response FROM history_full
+                    WHERE id > ? ORDER BY id LIMIT ?
+                    """,
+                    (last_id, EMBED_BATCH_SIZE),
+                ).fetchall()
+            if not rows:
+                return added
+
+            texts = [
+                f"{row['content']}\n{row['response'] or ''}"[:MAX_TEXT_CHARS]
+                for row in rows
+            ]
+            vectors = embed_texts(texts)
+            if vectors is None:
+                raise RuntimeError("嵌入模型不可用")
+            ids = [row["id"] for row in rows]
+            self._append(ids, vectors)
+            last_id = ids[-1]
+            added += len(ids)
+
+    def search(
+        self, query: str, limit: int = 10, session_id: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        搜索与查询语义最接近的历史记录
+
+        Returns:
+            按相似度降序排列的记录，每条记录带有 score 字段
+
+        Raises:
+            RuntimeError: 嵌入模型不可用
+        """
+        if not self._count() or limit <= 0:
+            return []
+        query_vectors = embed_texts([query])
+        if query_vectors is None:
+            raise RuntimeError("嵌入模型不可用")
+        query_vector = np.asarray(query_vectors[0], dtype=np.float32)
+
+        ids = np.array(self._load_ids())
+        valid = ids >= 0
+        if session_id:
+            with self.session_manager._db_connection() as conn:
+                session_ids = [
+                    row[0]
+                    for row in conn.execute(
+                        "SELECT id FROM history WHERE session_id = ?", (session_id,)
+                    )
+                ]
+            valid &= np.isin(ids, np.asarray(session_ids, dtype=np.int64))
+        candidates = int(np.count_nonzero(valid))
+        if not candidates:
+            return []
+
+        # 向量已归一化，点积即余弦相似度
+        vectors = self._load_vectors()
+        scores = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), SEARCH_CHUNK_SIZE):
+            chunk = np.asarray(vectors[start : start + SEARCH_CHUNK_SIZE], np.float32)
+            scores[start : start + len(chunk)] = chunk @ query_vector
+        scores[~valid] = -np.inf
+
+        k = min(limit, candidates)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self._fetch_records(ids[top].tolist(), scores[top].tolist())
+
+    def _fetch_records(
+        self, record_ids: List[int], scores: List[float]
+    ) -> List[Dict[str, Any]]:
+        """按给定顺序读取历史记录"""
+        placeholders = ",".join("?" * len(record_ids))
+        with self.session_manager._db_connection() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT h.*, s.name as session_name
+                FROM history_full h
+                JOIN sessions s ON h.session_id = s.id
+                WHERE h.id IN ({placeholders})
+                """,
+                record_ids,
+            ).fetchall()
+
+        by_id = {row["id"]: dict(row) for row in rows}
+        records = []
+        for record_id, score in zip(record_ids, scores):
+            record = by_id.get(record_id)
+            if record is None:
+                continue
+            if record["metadata"]:
+                record["metadata"] = json.loads(record["metadata"])
+            record["score"] = score
+            records.append(record)
+        return records
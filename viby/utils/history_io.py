@@ -0,0 +1,275 @@
+"""
+会话历史的流式导入导出格式
+
+导出时逐批写出数据库游标返回的记录，导入时逐条解析文件，内存占用都与记录总数无关：
+
+- json: 一个 JSON 数组，每条记录占一行
+- jsonl: 每行一条 JSON 记录
+- csv: 带表头的 CSV，metadata 保存为 JSON 字符串
+- yaml: 一个 YAML 列表（只支持导出）
+
+文件名以 .gz 或 .zst 结尾时透明地压缩和解压，zstd 需要 Python 3.14 的
+compression.zstd 或 zstandard 包。历史数据库中的大段内容也使用这里的编码压缩。
+"""
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import zlib
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional
+
+import yaml
+
+EXPORT_FORMATS = ("json", "jsonl", "csv", "yaml")
+# 历史数据库中大段内容的压缩编码，raw 表示不压缩
+BLOB_CODECS = ("raw", "zlib", "zstd")
+IMPORT_FORMATS = ("json", "jsonl", "csv")
+
+# 解析 JSON 数组时每次读取的字符数
+READ_CHUNK_SIZE = 1 << 16
+
+# 压缩文件扩展名
+GZIP_SUFFIXES = (".gz", ".gzip")
+ZSTD_SUFFIXES = (".zst", ".zstd")
+
+_FORMAT_SUFFIXES = {
+    ".json": "json",
+    ".jsonl": "jsonl",
+    ".ndjson": "jsonl",
+    ".csv": "csv",
+    ".yaml": "yaml",
+    ".yml": "yaml",
+}
+
+try:
+    _YamlDumper = yaml.CSafeDumper
+except AttributeError:  # 未编译 libyaml 时使用纯 Python 实现
+    _YamlDumper = yaml.SafeDumper
+
+
+def _zstd_module():
+    """返回可用的 zstd 实现，两者都提供 open、compress 和 decompress"""
+    try:
+        from compression import zstd
+
+        return zstd
+    except ImportError:
+        pass
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd 压缩需要安装 zstandard 包: pip install zstandard")
+    return zstandard
+
+
+def _open_zstd(path: str, mode: str) -> IO:
+    return _zstd_module().open(path, mode)
+
+
+def compress_bytes(data: bytes, codec: str) -> bytes:
+    """
+    按 BLOB_CODECS 中的编码压缩数据
+
+    Raises:
+        ValueError: 不支持的编码或没有可用的 zstd 实现
+    """
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.compress(data, 6)
+    if codec == "zstd":
+        return _zstd_module().compress(data)
+    raise ValueError(f"不支持的压缩编码: {codec}")
+
+
+def decompress_bytes(data: bytes, codec: str) -> bytes:
+    """解压 compress_bytes 的结果"""
+    if codec == "raw":
+        return data
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        return _zstd_module().decompress(data)
+    raise ValueError(f"不支持的压缩编码: {codec}")
+
+
+def open_text(path: str, mode: str = "r") -> IO[str]:
+    """
+    以文本模式打开文件，按扩展名透明地处理 gzip 和 zstd 压缩
+
+    Args:
+        path: 文件路径
+        mode: "r" 或 "w"
+
+    Raises:
+        ValueError: 需要 zstd 但没有可用的实现
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix in GZIP_SUFFIXES:
+        return gzip.open(path, mode + "t", encoding="utf-8", newline="")
+    if suffix in ZSTD_SUFFIXES:
+        return io.TextIOWrapper(
+            _open_zstd(path, mode + "b"), encoding="utf-8", newline=""
+        )
+    return open(path, mode, encoding="utf-8", newline="")
+
+
+def infer_format(path: str, default: str = "json") -> str:
+    """根据扩展名（忽略压缩扩展名）推断文件格式"""
+    file_path = Path(path)
+    if file_path.suffix.lower() in GZIP_SUFFIXES + ZSTD_SUFFIXES:
+        file_path = file_path.with_suffix("")
+    return _FORMAT_SUFFIXES.get(file_path.suffix.lower(), default)
+
+
+class RecordWriter:
+    """把历史记录逐批写入导出文件"""
+
+    def __init__(self, stream: IO[str], format_type: str, fieldnames: List[str]):
+        """
+        Args:
+            stream: 以文本模式打开的输出流
+            format_type: 导出格式，见 EXPORT_FORMATS
+            fieldnames: 记录的字段名，CSV 表头使用
+
+        Raises:
+            ValueError: 不支持的导出格式
+        """
+        if format_type not in EXPORT_FORMATS:
+            raise ValueError(f"不支持的导出格式: {format_type}")
+        self.stream = stream
+        self.format_type = format_type
+        self.count = 0
+        self._csv_writer: Optional[csv.DictWriter] = None
+        if format_type == "json":
+            stream.write("[")
+        elif format_type == "csv":
+            self._csv_writer = csv.DictWriter(stream, fieldnames=fieldnames)
+            self._csv_writer.writeheader()
+
+    @staticmethod
+    def _parse_metadata(record: Dict[str, Any]) -> Dict[str, Any]:
+        if record.get("metadata"):
+            record["metadata"] = json.loads(record["metadata"])
+        return record
+
+    def write_batch(self, records: List[Dict[str, Any]]) -> None:
+        """写入一批记录，metadata 为数据库中的 JSON 字符串"""
+        if not records:
+            return
+        if self.format_type == "csv":
+            self._csv_writer.writerows(records)
+        elif self.format_type == "yaml":
+            # 顶层列表逐批写出，拼接后仍是同一个列表
+            yaml.dump(
+                [self._parse_metadata(record) for record in records],
+                self.stream,
+                Dumper=_YamlDumper,
+                allow_unicode=True,
+                sort_keys=False,
+            )
+        else:
+            lines = [
+                json.dumps(self._parse_metadata(record), ensure_ascii=False)
+                for record in records
+            ]
+            if self.format_type == "json":
+                prefix = ",\n" if self.count else "\n"
+                self.stream.write(prefix + ",\n".join(lines))
+            else:
+                self.stream.write("\n".join(lines) + "\n")
+        self.count += len(records)
+
+    def close(self) -> None:
+        """写出文件结尾"""
+        if self.format_type == "json":
+            self.stream.write("\n]\n" if self.count else "]\n")
+        elif self.format_type == "yaml" and not self.count:
+            self.stream.write("[]\n")
+
+
+def _iter_json_array(stream: IO[str]) -> Iterator[Dict[str, Any]]:
+    """逐个解析 JSON 数组中的元素，不把整个文件读入内存"""
+    decoder = json.JSONDecoder()
+    buffer = stream.read(READ_CHUNK_SIZE).lstrip()
+    if not buffer:
+        return
+    if not buffer.startswith("["):
+        raise ValueError("JSON 文件应为记录数组")
+    pos = 1
+    eof = False
+    while True:
+        # 跳过元素之间的空白和逗号，必要时读取更多内容
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) or eof:
+                break
+            chunk = stream.read(READ_CHUNK_SIZE)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+        if pos >= len(buffer):
+            raise ValueError("JSON 文件不完整")
+        if buffer[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # 元素跨越了读取边界
+            chunk = stream.read(READ_CHUNK_SIZE)
+            buffer, pos, eof = buffer[pos:] + chunk, 0, not chunk
+            continue
+        yield record
+        pos = end
+
+
+def _iter_csv(stream: IO[str]) -> Iterator[Dict[str, Any]]:
+    for row in csv.DictReader(stream):
+        # CSV 无法区分空字符串和 NULL，按导出时的 NULL 处理
+        for key in ("response", "metadata"):
+            if row.get(key) == "":
+                row[key] = None
+        yield row
+
+
+def iter_records(
+    path: str, format_type: Optional[str] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    逐条读取导出文件中的历史记录
+
+    Args:
+        path: 文件路径，以 .gz 或 .zst 结尾时解压读取
+        format_type: 文件格式，默认根据扩展名推断
+
+    Raises:
+        ValueError: 不支持的格式或文件内容无效
+    """
+    format_type = format_type or infer_format(path)
+    if format_type not in IMPORT_FORMATS:
+        raise ValueError(f"不支持导入的格式: {format_type}")
+    with open_text(path, "r") as f:
+        if format_type == "json":
+            yield from _iter_json_array(f)
+        elif format_type == "csv":
+            yield from _iter_csv(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def batched(
+    records: Iterable[Dict[str, Any]], size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    """把记录流按 size 条分批"""
+    iterator = iter(records)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -0,0 +1,270 @@
+"""
+会话历史的后台写入
+
+模型回复结束和工具执行完成时，交互记录、追加的段落和本轮的完整消息先放入一个有界队列，
+由后台线程批量写入：
+同一批中的所有写入在一个事务中提交，回复的延迟不再包含磁盘同步的时间。
+队列已满时调用方等待队列写完后同步写入，保证写入顺序不变。
+进程退出时通过 atexit 写完队列中剩余的记录。
+
+配置项 history.write_queue_size 为 0 时所有写入都同步执行。
+"""
+
+import atexit
+import logging
+import queue
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Union
+
+from viby.config import config
+
+logger = logging.getLogger(__name__)
+
+# 每个事务最多包含的写入数
+WRITE_BATCH_SIZE = 256
+# 进程退出时等待队列写完的最长时间（秒）
+EXIT_FLUSH_TIMEOUT = 10.0
+
+
+class PendingRecord:
+    """已提交给后台线程、可能尚未写入的交互记录"""
+
+    def __init__(self):
+        self.id: Optional[int] = None
+        self._written = threading.Event()
+
+    def _resolve(self, record_id: int) -> None:
+        self.id = record_id
+        self._written.set()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        等待记录写入
+
+        Returns:
+            记录 ID，写入失败时为 -1，超时返回 None
+        """
+        if not self._written.wait(timeout):
+            return None
+        return self.id
+
+
+def _as_pending(record: Union[PendingRecord, int]) -> PendingRecord:
+    """把已有记录的 ID 包装为已写入的 PendingRecord"""
+    if isinstance(record, PendingRecord):
+        return record
+    pending = PendingRecord()
+    pending._resolve(record)
+    return pending
+
+
+class _Write:
+    """队列中的一次写入"""
+
+    __slots__ = ("kind", "args", "timestamp", "record")
+
+    def __init__(self, kind: str, args: tuple, record: Optional[PendingRecord]):
+        self.kind = kind
+        self.args = args
+        # 使用提交时的时间，而不是实际写入的时间
+        self.timestamp = datetime.now().isoformat()
+        self.record = record
+
+
+class HistoryRecorder:
+    """把交互记录交给后台线程批量写入的记录器"""
+
+    def __init__(self, session_manager, queue_size: Optional[int] = None):
+        """
+        Args:
+            session_manager: 执行写入的 SessionManager
+            queue_size: 队列容量，默认使用 history.write_queue_size，0 表示同步写入
+        """
+        self.session_manager = session_manager
+        if queue_size is None:
+            queue_size = config.history.write_queue_size
+        self.queue_size = max(0, int(queue_size))
+        self._queue: "queue.Queue[_Write]" = queue.Queue(self.queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+        # 已提交但尚未写完的写入数
+        self._unfinished = 0
+        self._idle = threading.Condition()
+
+    def record_interaction(
+        self,
+        content: str,
+        response: Optional[str] = None,
+        metadata: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+    ) -> PendingRecord:
+        """提交一条新的交互记录"""
+        record = PendingRecord()
+        self._submit(
+            _Write("interaction", (content, response, metadata, session_id), record)
+        )
+        return record
+
+    def append_segment(self, record: Union[PendingRecord, int], text: str) -> bool:
+        """
+        向交互记录追加一个段落
+
+        Args:
+            record: record_interaction 返回的记录或已有记录的 ID
+            text: 段落内容
+
+        Returns:
+            后台写入时总是返回 True，同步写入时返回是否写入成功
+        """
+        if not text:
+            return True
+        return self._submit(_Write("segment", (text,), _as_pending(record)))
+
+    def record_messages(
+        self, record: Union[PendingRecord, int], messages: List[Dict[str, Any]]
+    ) -> bool:
+        """
+        保存交互中按角色划分的完整消息，参数见 SessionManager.add_messages
+
+        Returns:
+            后台写入时总是返回 True，同步写入时返回是否写入成功
+        """
+        if not messages:
+            return True
+        return self._submit(_Write("messages", (list(messages),), _as_pending(record)))
+
+    def _submit(self, write: _Write) -> bool:
+        if self.queue_size:
+            self._ensure_thread()
+            with self._idle:
+                self._unfinished += 1
+            try:
+                self._queue.put_nowait(write)
+                return True
+            except queue.Full:
+                with self._idle:
+                    self._unfinished -= 1
+                logger.debug("历史记录写入队列已满，改为同步写入")
+                # 先写完队列中更早的记录，再写入本条，保持写入顺序
+                self.flush()
+        return self._write_batch([write])
+
+    def _ensure_thread(self) -> None:
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="viby-history-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _run(self) -> None:
+        """后台线程：取出队列中已有的写入，每批在一个事务中提交"""
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:  # 写入线程不能退出，否则队列不再被消费
+                logger.error(f"后台写入历史记录失败: {e}")
+                for write in batch:
+                    if write.kind == "interaction" and write.record.wait(0) is None:
+                        write.record._resolve(-1)
+            finally:
+                with self._idle:
+                    self._unfinished -= len(batch)
+                    self._idle.notify_all()
+
+    def _write_batch(self, batch: List[_Write]) -> bool:
+        """在一个事务中写入一批记录，失败时逐条重试，避免一条错误影响整批"""
+        try:
+            return self._apply(batch)
+        except sqlite3.Error as e:
+            if len(batch) == 1:
+                logger.error(f"写入历史记录失败: {e}")
+                if batch[0].kind == "interaction":
+                    batch[0].record._resolve(-1)
+                return False
+        return all([self._write_batch([write]) for write in batch])
+
+    def _apply(self, batch: List[_Write]) -> bool:
+        """在一个事务中写入，返回段落和消息是否全部保存成功"""
+        manager = self.session_manager
+        resolved = []
+        appended = True
+        with manager._write_transaction() as conn:
+            cursor = conn.cursor()
+            for write in batch:
+                if write.kind == "interaction":
+                    record_id = manager._insert_interaction(
+                        cursor, *write.args, timestamp=write.timestamp
+                    )
+                    # 同一批中后面的段落需要该 ID，提交后才通知等待者
+                    write.record.id = record_id
+                    resolved.append((write.record, record_id))
+                    continue
+                # 队列按提交顺序写入，记录已在更早的批次或本批中写入
+                record_id = write.record.id
+                if record_id is None or record_id < 0:
+                    logger.warning("交互记录写入失败，丢弃追加的内容")
+                    appended = False
+                elif write.kind == "messages":
+                    if not manager._insert_messages(
+                        cursor, record_id, write.args[0], timestamp=write.timestamp
+                    ):
+                        logger.warning(f"交互记录不存在，无法保存消息: {record_id}")
+                        appended = False
+                elif not manager._insert_segment(
+                    cursor, record_id, write.args[0], timestamp=write.timestamp
+                ):
+                    logger.warning(f"交互记录不存在，无法追加: {record_id}")
+                    appended = False
+        for record, record_id in resolved:
+            record._resolve(record_id)
+        return appended
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        等待已提交的写入全部完成
+
+        Returns:
+            是否在超时前写完
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._unfinished <= 0, timeout)
+
+
+_recorders: Dict[str, HistoryRecorder] = {}
+_recorders_lock = threading.Lock()
+
+
+def get_recorder(session_manager) -> HistoryRecorder:
+    """获取写入该历史数据库的记录器，同一进程中共享"""
+    key = str(session_manager.db_path)
+    with _recorders_lock:
+        recorder = _recorders.get(key)
+        if recorder is None:
+            recorder = HistoryRecorder(session_manager)
+            _recorders[key] = recorder
+        return recorder
+
+
+def flush_all(timeout: Optional[float] = None) -> bool:
+    """等待所有记录器的写入完成，读取历史记录前调用以读到刚提交的记录"""
+    with _recorders_lock:
+        recorders = list(_recorders.values())
+    return all([recorder.flush(timeout) for recorder in recorders])
+
+
+def _flush_at_exit() -> None:
+    if not flush_all(EXIT_FLUSH_TIMEOUT):
+        logger.warning("退出时仍有历史记录未写入")
+
+
+# 在 history 模块注册的关闭连接之后注册，退出时先于它执行
+atexit.register(_flush_at_exit)
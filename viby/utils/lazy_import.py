@@ -103,6 +103,9 @@ def lazy_class(module_name: str, class_name: str) -> type:
             return real_class(*args, **kwargs)
 
         def __init_subclass__(cls, **kwargs):
+            # 创建代理类本身时不应触发导入
+            if cls.__dict__.get("_lazy_proxy"):
+                return
             real_class = getattr(importlib.import_module(module_name), class_name)
             _LOADED_LAZY_MODULES.add(module_name)
             return type(f"LazySubclassOf{class_name}", (real_class,), {})
@@ -120,7 +123,9 @@ def lazy_class(module_name: str, class_name: str) -> type:
             _LOADED_LAZY_MODULES.add(module_name)
             return getattr(real_class, name)
 
-    return cast(type, LazyMetaclass(f"Lazy{class_name}", (LazyClass,), {}))
+    return cast(
+        type, LazyMetaclass(f"Lazy{class_name}", (LazyClass,), {"_lazy_proxy": True})
+    )
 
 
 def get_loaded_modules() -> Set[str]:
@@ -0,0 +1,126 @@
+"""
+非交互输出模式
+
+stdout 不是终端（例如管道）时，模型回复不经过 rich 渲染，直接写到 stdout：
+
+- raw: 原样写出每个增量文本
+- json: 结束时输出一个包含完整回复和统计信息的 JSON 对象
+- ndjson: 每个增量一行 JSON，最后一行为 token 用量和延迟统计
+
+本模块不依赖 rich、prompt_toolkit 和 flatlatex，这些模式下也不会导入它们。
+"""
+
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional, TextIO
+
+OUTPUT_RICH = "rich"
+OUTPUT_RAW = "raw"
+OUTPUT_JSON = "json"
+OUTPUT_NDJSON = "ndjson"
+OUTPUT_MODES = (OUTPUT_RICH, OUTPUT_RAW, OUTPUT_JSON, OUTPUT_NDJSON)
+
+# 需要结构化统计信息的输出模式
+STRUCTURED_OUTPUT_MODES = (OUTPUT_JSON, OUTPUT_NDJSON)
+
+
+def resolve_output_mode(mode: Optional[str], stream: Optional[TextIO] = None) -> str:
+    """
+    确定输出模式，未指定时 stdout 为终端则使用 rich 渲染，否则使用 raw
+
+    Raises:
+        ValueError: 不支持的输出模式
+    """
+    if mode:
+        mode = mode.lower()
+        if mode not in OUTPUT_MODES:
+            raise ValueError(
+                f"不支持的输出模式: {mode}，可选值: {', '.join(OUTPUT_MODES)}"
+            )
+        return mode
+    stream = stream or sys.stdout
+    isatty = getattr(stream, "isatty", None)
+    return OUTPUT_RICH if isatty and isatty() else OUTPUT_RAW
+
+
+class OutputWriter:
+    """把模型回复按 raw/json/ndjson 格式写到 stdout，并统计 token 用量和延迟"""
+
+    def __init__(self, mode: str, stream: Optional[TextIO] = None):
+        self.mode = mode
+        # 保存真正的 stdout，执行期间其他输出可能被重定向到 stderr
+        self.stream = stream or sys.stdout
+        self.start_time = time.perf_counter()
+        self.first_token_time: Optional[float] = None
+        self.llm_calls = 0
+        self.model: Optional[str] = None
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self._chunks: List[str] = []  # 仅 json 模式需要保存完整回复
+        self._ends_with_newline = True
+
+    def _emit(self, text: str) -> None:
+        self.stream.write(text)
+        self.stream.flush()
+
+    def _emit_record(self, record: Dict[str, Any]) -> None:
+        self._emit(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write(self, text: str) -> None:
+        """写出一个增量文本"""
+        if not text:
+            return
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+
+        if self.mode == OUTPUT_NDJSON:
+            self._emit_record({"type": "delta", "content": text})
+        elif self.mode == OUTPUT_JSON:
+            self._chunks.append(text)
+        else:
+            self._emit(text)
+            self._ends_with_newline = text.endswith("\n")
+
+    def end_call(self, token_tracker=None) -> None:
+        """一次模型调用结束，累计其 token 用量"""
+        self.llm_calls += 1
+        if token_tracker is None:
+            return
+        self.model = token_tracker.model_name or self.model
+        self.prompt_tokens += token_tracker.prompt_tokens
+        self.completion_tokens += token_tracker.completion_tokens
+        self.total_tokens += token_tracker.total_tokens
+
+    def get_stats(self) -> Dict[str, Any]:
+        """返回本次运行的 token 用量和延迟统计"""
+        now = time.perf_counter()
+        ttft = (
+            self.first_token_time - self.start_time
+            if self.first_token_time is not None
+            else None
+        )
+        return {
+            "model": self.model,
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "ttft_ms": round(ttft * 1000, 1) if ttft is not None else None,
+            "latency_ms": round((now - self.start_time) * 1000, 1),
+        }
+
+    def finish(self) -> None:
+        """输出结束，写出 json 结果或 ndjson 统计记录"""
+        if self.mode == OUTPUT_NDJSON:
+            self._emit_record({"type": "stats", **self.get_stats()})
+        elif self.mode == OUTPUT_JSON:
+            self._emit_record(
+                {
+                    "content": "".join(self._chunks),
+                    "stats": self.get_stats(),
+                }
+            )
+        elif not self._ends_with_newline:
+            self._emit("\n")
@@ -0,0 +1,191 @@
+"""
+流式回复的共享缓冲区
+
+模型回复的增量文本只追加到一个 StreamBuffer 中：历史记录、LLM 节点和渲染器都读取同一份
+数据，不再各自拼接副本。生产者线程消费模型的流式响应，渲染端按固定的时间预算读取这段时间内
+到达的全部增量并合并成一帧，因此渲染次数只与时间有关，与服务端增量的粒度无关。
+
+运行 ``python -m viby.utils.stream`` 可以比较合并帧与逐增量渲染每千个 token 的 CPU 耗时。
+"""
+
+import threading
+import time
+from typing import Iterable, Iterator, List, Optional
+
+# 默认帧间隔（秒），约 30 帧每秒
+FRAME_INTERVAL = 1 / 30
+
+
+class StreamBuffer:
+    """只追加的流式文本缓冲区，支持一个生产者和一个按帧读取的消费者"""
+
+    def __init__(self, cancel_event: Optional[threading.Event] = None):
+        """
+        Args:
+            cancel_event: 可选的取消事件，设置后生产者停止消费，按帧读取立即结束
+        """
+        self.cancel_event = cancel_event
+        self._parts: List[str] = []
+        self._size = 0
+        self._closed = False
+        self._error: Optional[BaseException] = None
+        self._condition = threading.Condition()
+        # CancellationToken 取消时会主动唤醒等待中的读取端，普通 Event 只能轮询
+        add_callback = getattr(cancel_event, "add_callback", None)
+        self._cancel_notifies = add_callback is not None
+        if add_callback:
+            add_callback(self._wake)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def cancelled(self) -> bool:
+        """是否已被取消"""
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    @property
+    def closed(self) -> bool:
+        """生产者是否已经结束"""
+        return self._closed
+
+    def _wake(self) -> None:
+        with self._condition:
+            self._condition.notify_all()
+
+    def append(self, chunk: str) -> None:
+        """追加一段文本"""
+        if not chunk:
+            return
+        with self._condition:
+            self._parts.append(chunk)
+            self._size += len(chunk)
+            self._condition.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """标记生产结束，error 会在按帧读取完剩余内容后抛出"""
+        with self._condition:
+            self._closed = True
+            self._error = error
+            self._condition.notify_all()
+
+    def getvalue(self) -> str:
+        """返回目前为止的完整文本"""
+        with self._condition:
+            return "".join(self._parts)
+
+    def pump(self, source: Iterable) -> None:
+        """
+        在当前线程中消费 source 直到结束或被取消，然后关闭缓冲区
+
+        source 负责把文本写入本缓冲区（例如 ModelManager.get_response(buffer=...)），
+        这里只驱动它运行。
+        """
+        error = None
+        try:
+            for _ in source:
+                if self.cancelled:
+                    break
+        except BaseException as e:  # 转交给消费者所在的线程处理
+            error = e
+        finally:
+            close = getattr(source, "close", None)
+            if close:
+                close()
+            self.close(error)
+
+    def start(self, source: Iterable) -> threading.Thread:
+        """在后台线程中运行 pump"""
+        thread = threading.Thread(target=self.pump, args=(source,), daemon=True)
+        thread.start()
+        return thread
+
+    def frames(self, interval: float = FRAME_INTERVAL) -> Iterator[str]:
+        """
+        按时间预算读取新增文本
+
+        每一帧合并上一帧之后到达的全部增量；两帧之间至少间隔 interval 秒。
+        生产者结束、出错或缓冲区被取消时，输出剩余内容后停止。
+        """
+        # 普通 Event 没有通知机制，等待时按帧间隔轮询
+        poll = None
+        if not self._cancel_notifies:
+            poll = interval if interval > 0 else FRAME_INTERVAL
+        read_parts = 0
+        next_frame = time.monotonic()
+        while True:
+            with self._condition:
+                while (
+                    len(self._parts) == read_parts
+                    and not self._closed
+                    and not self.cancelled
+                ):
+                    self._condition.wait(poll)
+                # 在帧截止时间前继续收集增量
+                remaining = next_frame - time.monotonic()
+                while remaining > 0 and not self._closed and not self.cancelled:
+                    self._condition.wait(remaining)
+                    remaining = next_frame - time.monotonic()
+
+                text = "".join(self._parts[read_parts:])
+                read_parts = len(self._parts)
+                done = self._closed or self.cancelled
+                error = self._error
+
+            if text:
+                yield text
+                next_frame = time.monotonic() + interval
+            if done:
+                if error is not None and not self.cancelled:
+                    raise error
+                return
+
+
+def benchmark(
+    tokens: int = 4000, interval: float = FRAME_INTERVAL, delay: float = 0.0002
+) -> float:
+    """
+    测量流式渲染每千个 token 的 CPU 耗时
+
+    Args:
+        tokens: 模拟的 token 数量
+        interval: 帧间隔，0 表示每个增量渲染一次
+        delay: 模拟服务端两个增量之间的间隔（秒）
+
+    Returns:
+        每千个 token 的 CPU 时间（秒）
+    """
+    import io
+
+    from rich.console import Console
+
+    from viby.utils.ui import render_markdown_stream
+
+    words = ["Streaming", " **markdown**", " with", " `code`", " and", " text.\n\n"]
+
+    def _source(buffer: StreamBuffer):
+        for i in range(tokens):
+            buffer.append(words[i % len(words)])
+            time.sleep(delay)
+            yield
+
+    console = Console(file=io.StringIO(), width=100, height=40, force_terminal=True)
+    buffer = StreamBuffer()
+    start = time.process_time()
+    buffer.start(_source(buffer))
+    render_markdown_stream(
+        buffer,
+        console_instance=console,
+        refresh_per_second=1 / interval if interval else 0,
+    )
+    return (time.process_time() - start) / tokens * 1000
+
+
+if __name__ == "__main__":
+    # 以模块方式运行时，使用与渲染器相同的 StreamBuffer 类
+    from viby.utils.stream import benchmark as _benchmark
+
+    per_delta = _benchmark(interval=0)
+    coalesced = _benchmark()
+    print(f"逐增量渲染: {per_delta * 1000:7.1f} ms CPU / 1k tokens")
+    print(f"合并帧渲染: {coalesced * 1000:7.1f} ms CPU / 1k tokens")
@@ -7,12 +7,15 @@ Viby 应用统一 UI 界面模块
 import re
 import json
 import shutil
-from typing import Iterable, Optional
+from functools import lru_cache
+from typing import Iterable, Optional, Union
 
 from rich.console import Console
 from rich.markdown import Markdown
 from rich.live import Live
-from flatlatex import converter
+from rich.segment import Segments
+
+from viby.utils.stream import StreamBuffer
 
 
 # 基本颜色定义
@@ -45,8 +48,11 @@ class Colors:
 # 统一的输出方式
 console = Console()
 
-# LaTeX 渲染器
-MATH_CONVERTER = converter()
+# LaTeX 公式：$$...$$ 可跨行，$...$ 限于单行；同一位置优先匹配 $$...$$
+_MATH_PATTERN = re.compile(r"\$\$(.+?)\$\$|\$([^\n]+?)\$", re.DOTALL)
+
+# LaTeX 渲染器，首次遇到公式时才创建
+_math_converter = None
 
 
 # 基本界面元素
@@ -130,29 +136,75 @@ def process_markdown_links(text):
     return re.sub(link_pattern, replace_link, text)
 
 
+def _get_math_converter():
+    """获取 LaTeX 渲染器，首次调用时才导入 flatlatex 并创建"""
+    global _math_converter
+    if _math_converter is None:
+        from flatlatex import converter
+
+        _math_converter = converter()
+    return _math_converter
+
+
+@lru_cache(maxsize=1024)
+def _convert_math(expr: str) -> Optional[str]:
+    """转换单个公式，结果按表达式缓存；无法转换时返回 None"""
+    try:
+        return _get_math_converter().convert(expr)
+    except Exception:
+        return None
+
+
+def _replace_math(match: "re.Match") -> str:
+    expr = match.group(1) if match.group(1) is not None else match.group(2)
+    converted = _convert_math(expr)
+    return match.group(0) if converted is None else converted
+
+
 def _process_latex_tokens(text: str) -> str:
     """转换 LaTeX 数学公式 ($...$ 和 $$...$$) 为 Unicode。"""
+    if "$" not in text:
+        return text
+    return _MATH_PATTERN.sub(_replace_math, text)
 
-    # 转换 display math $$...$$
-    def _convert_display(m):
-        expr = m.group(1)
-        try:
-            return MATH_CONVERTER.convert(expr)
-        except Exception:
-            return m.group(0)
 
-    text = re.sub(r"\$\$(.+?)\$\$", _convert_display, text, flags=re.DOTALL)
+class LatexStreamProcessor:
+    """
+    增量转换仍在增长的文本中的公式
 
-    # 转换 inline math $...$
-    def _convert_inline(m):
-        expr = m.group(1)
-        try:
-            return MATH_CONVERTER.convert(expr)
-        except Exception:
-            return m.group(0)
+    已经闭合且不会再变化的公式只转换一次，其转换结果连同之前的文本一起缓存；
+    之后的调用只扫描缓存前缀之后新增的部分。
+    """
 
-    text = re.sub(r"\$(.+?)\$", _convert_inline, text)
-    return text
+    def __init__(self):
+        self._source = ""  # 已确定部分的原文
+        self._converted = ""  # 已确定部分的转换结果
+
+    def process(self, text: str) -> str:
+        """返回 text 转换公式后的结果，text 通常是上一次传入文本的延续"""
+        if not text.startswith(self._source):
+            self._source = self._converted = ""
+        if "$" not in text:
+            return text
+
+        pos = len(self._source)
+        parts = []
+        stable = True
+        for match in _MATH_PATTERN.finditer(text, pos):
+            parts.append(text[pos : match.start()])
+            parts.append(_replace_math(match))
+            pos = match.end()
+            # 以 $$ 开头却按单行公式匹配的片段，后续文本可能补全成 $$...$$，暂不缓存
+            if stable and (
+                match.group(1) is not None or text[match.start() + 1] != "$"
+            ):
+                self._source = text[:pos]
+                self._converted += "".join(parts)
+                parts.clear()
+            else:
+                stable = False
+        parts.append(text[pos:])
+        return self._converted + "".join(parts)
 
 
 def _process_think_tokens(text: str) -> str:
@@ -239,20 +291,123 @@ def print_markdown(content, style=None):
     console.print(Markdown(md_text, justify="left"))
 
 
+# 围栏代码块的起始行，例如 ``` 或 ~~~python
+_FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# 列表项的起始行，例如 "- item" 或 "1. item"
+_LIST_ITEM_PATTERN = re.compile(r"^ {0,3}(?:[-*+]|\d{1,9}[.)])(?:\s|$)")
+
+
+class MarkdownBlockSplitter:
+    """
+    把流式到达的 Markdown 文本切分为已完成的块和仍在增长的尾部块
+
+    空行之后出现新的非缩进行时，空行之前的内容即为已完成的块（围栏代码块内部的空行和
+    松散列表项之间的空行除外）。每一行只扫描一次，因此切分的开销只与新到达的文本长度有关。
+    """
+
+    def __init__(self):
+        self.pending = ""  # 尚未完成的尾部文本
+        self._scan_pos = 0  # pending 中已扫描到的位置，总是位于行首
+        self._fence: Optional[str] = None  # 当前所在围栏代码块的标记
+        self._blank_seen = False  # 上一行是否为空行
+        self._list_open = False  # 当前块是否是列表
+
+    def feed(self, chunk: str) -> str:
+        """
+        追加文本
+
+        Returns:
+            新完成的块，没有则返回空字符串
+        """
+        self.pending += chunk
+        completed_end = 0
+        while True:
+            newline = self.pending.find("\n", self._scan_pos)
+            if newline == -1:
+                break
+            line_start = self._scan_pos
+            line = self.pending[line_start:newline]
+            self._scan_pos = newline + 1
+
+            if self._fence:
+                # 围栏内的内容（包括空行）都属于同一个块
+                stripped = line.strip()
+                if stripped.startswith(self._fence) and not stripped.strip(
+                    self._fence[0]
+                ):
+                    self._fence = None
+                continue
+
+            if not line.strip():
+                self._blank_seen = True
+                continue
+
+            # 空行后的缩进行可能是列表项的延续，不能作为新块的开始
+            is_list_item = bool(_LIST_ITEM_PATTERN.match(line))
+            if self._blank_seen and line[0] not in " \t":
+                # 松散列表的各项之间虽有空行，仍需作为一个整体渲染才能保持编号和间距
+                if not (is_list_item and self._list_open):
+                    completed_end = line_start
+                    self._list_open = is_list_item
+            elif is_list_item:
+                self._list_open = True
+            self._blank_seen = False
+
+            fence = _FENCE_PATTERN.match(line)
+            if fence:
+                self._fence = fence.group(1)
+
+        if not completed_end:
+            return ""
+        completed = self.pending[:completed_end]
+        self.pending = self.pending[completed_end:]
+        self._scan_pos -= completed_end
+        return completed
+
+    def flush(self) -> str:
+        """返回剩余的全部文本并清空"""
+        remaining, self.pending = self.pending, ""
+        self._scan_pos = 0
+        self._fence = None
+        self._blank_seen = False
+        self._list_open = False
+        return remaining
+
+
+def _prepare_markdown(
+    text: str,
+    enhance_links: bool,
+    latex_processor: Optional[LatexStreamProcessor] = None,
+) -> str:
+    """对一段 Markdown 文本做公式、思考标记和链接处理"""
+    if latex_processor is not None:
+        text = latex_processor.process(text)
+    else:
+        text = _process_latex_tokens(text)
+    text = _process_think_tokens(text)
+    if enhance_links:
+        text = process_markdown_links(text)
+    return text
+
+
 def render_markdown_stream(
-    text_stream: Iterable[str],
+    text_stream: Union[Iterable[str], StreamBuffer],
     *,
     console_instance: Optional[Console] = None,
-    refresh_per_second: int = 120,
+    refresh_per_second: int = 30,
     enhance_links: bool = True,
 ) -> str:
     """
     流式渲染 Markdown 文本
 
+    已完成的块只处理和渲染一次，并打印在动态区域上方；动态区域只重新解析仍在增长的
+    最后一个块，因此每次更新的开销不随回答长度增长。
+
     Args:
-        text_stream: 文本流迭代器
+        text_stream: 文本流迭代器，或由后台线程写入的 StreamBuffer；
+            传入 StreamBuffer 时按帧合并增量，每帧只渲染一次
         console_instance: 可选的 Console 实例，默认使用全局 console
-        refresh_per_second: 刷新频率，默认 120 Hz
+        refresh_per_second: 刷新频率，默认 30 Hz，为 0 时每个增量都渲染
         enhance_links: 是否增强链接显示，默认为 True
 
     Returns:
@@ -261,68 +416,77 @@ def render_markdown_stream(
     console_instance = console_instance or console
     accumulated: list[str] = []  # 使用列表收集字符串，效率更高
 
+    # 共享缓冲区已保存完整文本，无需再收集一份
+    buffer = text_stream if isinstance(text_stream, StreamBuffer) else None
+    if buffer is not None:
+        text_stream = buffer.frames(1 / refresh_per_second if refresh_per_second else 0)
+
+    def _full_text() -> str:
+        return buffer.getvalue() if buffer is not None else "".join(accumulated)
+
     # 对于非交互终端（如重定向到文件），直接顺序输出即可
     if not _is_interactive(console_instance):
         for chunk in text_stream:
             if chunk:
-                accumulated.append(chunk)
+                if buffer is None:
+                    accumulated.append(chunk)
                 # 保留 <think> 标记但确保其独占一行
                 printable = _process_think_tokens(_process_latex_tokens(chunk))
                 console_instance.print(printable, end="", soft_wrap=True)
         console_instance.print()  # 最后补一个换行
-        return "".join(accumulated)
-
-    # 交互式终端使用 Live 动态刷新，获得更流畅的体验
+        return _full_text()
+
+    splitter = MarkdownBlockSplitter()
+    # 尾部块每帧都会重新处理，只转换新闭合的公式
+    tail_latex = LatexStreamProcessor()
+    printed_blocks = 0
+
+    def _print_block(block: str) -> None:
+        nonlocal printed_blocks
+        markdown = Markdown(_prepare_markdown(block, enhance_links))
+        segments = list(console_instance.render(markdown))
+        # rich 在列表、表格等块前会自带一个空行；其余块需要手动补上块间距，与整篇渲染时一致
+        if printed_blocks and not (segments and segments[0].text == "\n"):
+            console_instance.print()
+        console_instance.print(Segments(segments))
+        printed_blocks += 1
+
+    # 交互式终端使用 Live 动态刷新尾部块，已完成的块打印在其上方
     with Live(
         Markdown(""),
         console=console_instance,
-        refresh_per_second=refresh_per_second,
-        transient=True,  # 退出时清理 Live 区域，随后输出最终结果
-        auto_refresh=True,
+        refresh_per_second=refresh_per_second or 120,
+        transient=True,  # 退出时清理 Live 区域，随后输出最后一个块
+        # 按帧读取时每帧主动刷新一次，不需要额外的刷新线程
+        auto_refresh=buffer is None,
     ) as live:
-        content_so_far = ""
         for chunk in text_stream:
             if not chunk:
                 continue
-            accumulated.append(chunk)
-            content_so_far = "".join(accumulated)
-
-            # 处理 <think> 标记以确保独立成行并用特殊样式显示
-            processed_content = _process_think_tokens(
-                _process_latex_tokens(content_so_far)
-            )
-
-            if enhance_links:
-                processed_content = process_markdown_links(processed_content)
+            if buffer is None:
+                accumulated.append(chunk)
 
-            # 保证内容可见: 通过确保较大的内容不会被截断
-            # 这里使用空行确保内容显示在终端高度的最下方
-            # 注意：这与 transient=True 配合使用可正常工作
-            extra_lines = max(0, console_instance.height - 10)
+            completed = splitter.feed(chunk)
+            if completed:
+                _print_block(completed)
 
-            # 滚动到最后一行的技巧
-            content_to_display = processed_content
-            if "\n" in content_to_display:
+            # 尾部块过长时（如很长的代码块）只显示最后几行，保证内容在视野内
+            content_to_display = _prepare_markdown(
+                splitter.pending, enhance_links, tail_latex
+            )
+            max_lines = max(1, console_instance.height - 5)
+            if content_to_display.count("\n") >= max_lines:
                 lines = content_to_display.splitlines()
-                if len(lines) > console_instance.height - 5:
-                    # 若内容太长，只显示最后几行
-                    content_to_display = "\n".join(
-                        lines[-(console_instance.height - 5) :]
-                    )
+                content_to_display = "\n".join(lines[-max_lines:])
 
-            # 确保内容始终保持在视野内
-            content_with_padding = content_to_display + "\n" * extra_lines
+            live.update(Markdown(content_to_display), refresh=buffer is not None)
 
-            live.update(Markdown(content_with_padding))
-
-    # Live 区域已被清理，再次打印最终内容供用户滚动查看
-    final_text = "".join(accumulated)
-    final_text = _process_think_tokens(_process_latex_tokens(final_text))
-    if enhance_links:
-        final_text = process_markdown_links(final_text)
-    console_instance.print(Markdown(final_text))
+    # Live 区域已被清理，打印最后一个块
+    remaining = splitter.flush()
+    if remaining.strip():
+        _print_block(remaining)
 
-    return final_text
+    return _prepare_markdown(_full_text(), enhance_links)
 
 
 # 用户交互函数
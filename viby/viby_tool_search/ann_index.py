@@ -0,0 +1,314 @@
+"""
+工具检索的近似最近邻索引
+
+使用倒排文件（IVF）结构：用球面 k-means 把工具向量划分为若干聚类，查询时只扫描
+与查询最接近的 nprobe 个聚类中的工具。聚类中心和每个工具所属的聚类保存在缓存目录中，
+工具目录变化时按名称增量插入和删除，工具数量比训练时增长一倍后重新训练聚类中心。
+
+只依赖 NumPy，工具数量较少时由 EmbeddingManager 直接精确检索。
+"""
+
+import json
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from viby.viby_tool_search.embedding_manager import normalize_rows, top_k_similar
+
+logger = logging.getLogger(__name__)
+
+# k-means 迭代次数
+KMEANS_ITERATIONS = 10
+# 每个聚类最多使用的训练样本数，限制训练耗时
+KMEANS_SAMPLES_PER_LIST = 256
+# 工具数量相对训练时增长到该倍数后重新训练聚类中心
+RETRAIN_GROWTH = 2.0
+
+
+def train_centroids(
+    vectors: np.ndarray, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0
+) -> np.ndarray:
+    """
+    用球面 k-means 训练聚类中心
+
+    Args:
+        vectors: 行已归一化的向量
+        nlist: 聚类数
+        iterations: 迭代次数
+        seed: 随机数种子
+
+    Returns:
+        形状为 (nlist, dim) 且行已归一化的聚类中心
+    """
+    rng = np.random.default_rng(seed)
+    nlist = max(1, min(nlist, len(vectors)))
+    sample_size = min(len(vectors), nlist * KMEANS_SAMPLES_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        # 空聚类重新取一个随机样本作为中心
+        empty = ~np.any(sums, axis=1)
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """按名称增量维护的 IVF 工具向量索引"""
+
+    def __init__(self, path: Path, model_name: str, nlist: int = 0, nprobe: int = 8):
+        """
+        Args:
+            path: 索引文件路径
+            model_name: 嵌入模型名称，与已有索引不一致时重新训练
+            nlist: 聚类数，0 表示按工具数量的平方根选择
+            nprobe: 每次查询扫描的聚类数，越大召回率越高、延迟越高
+        """
+        self.path = Path(path)
+        self.model_name = model_name
+        self.nlist = nlist
+        self.nprobe = max(1, nprobe)
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_size = 0
+        # 每个聚类中的工具名称和行已归一化的向量
+        self._list_names: List[List[str]] = []
+        self._list_vectors: List[np.ndarray] = []
+        # 工具名称 -> 所属聚类
+        self._where: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._where)
+
+    def _assignments(self) -> Dict[str, int]:
+        """读取已保存的聚类中心，返回保存时各工具所属的聚类"""
+        if not self.path.exists():
+            return {}
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                if (meta.get("model"), meta.get("nlist")) != (
+                    self.model_name,
+                    self.nlist,
+                ):
+                    return {}
+                self.centroids = np.ascontiguousarray(data["centroids"], np.float32)
+                self.trained_size = int(meta.get("trained_size", 0))
+                names = data["names"].tolist()
+                lists = data["lists"].tolist()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"读取工具近似检索索引失败: {e}")
+            self.centroids = None
+            return {}
+        return dict(zip(names, lists))
+
+    def sync(self, embeddings: Dict[str, np.ndarray]) -> bool:
+        """
+        使索引与工具向量一致：删除已移除的工具，插入新增的工具
+
+        首次调用时加载已保存的索引，向量维度变化或工具数量增长较多时重新训练聚类中心。
+        工具向量内容变化时应先 remove 再调用本方法。
+
+        Returns:
+            索引是否发生变化，需要保存
+        """
+        if not embeddings:
+            changed = bool(self._where)
+            self._reset_lists()
+            return changed
+
+        dim = next(iter(embeddings.values())).shape[-1]
+        changed = False
+        if self.centroids is None:
+            saved = self._assignments()
+            if self.centroids is not None and self.centroids.shape[1] != dim:
+                self.centroids = None
+            self._reset_lists()
+            if self.centroids is not None:
+                for name, list_id in saved.items():
+                    if name in embeddings and 0 <= list_id < len(self.centroids):
+                        self._add(name, embeddings[name], list_id)
+            changed = len(self) != len(saved)
+
+        if (
+            self.centroids is None
+            or len(embeddings) > self.trained_size * RETRAIN_GROWTH
+        ):
+            self._train(embeddings)
+            return True
+
+        for name in [name for name in self._where if name not in embeddings]:
+            self.remove(name)
+            changed = True
+        for name, vector in embeddings.items():
+            if name not in self._where:
+                self.insert(name, vector)
+                changed = True
+        return changed
+
+    def _reset_lists(self) -> None:
+        """按当前聚类中心清空各聚类"""
+        count = 0 if self.centroids is None else len(self.centroids)
+        self._list_names = [[] for _ in range(count)]
+        self._list_vectors = [
+            np.empty((0, self.centroids.shape[1]), np.float32) for _ in range(count)
+        ]
+        self._where = {}
+
+    def _train(self, embeddings: Dict[str, np.ndarray]) -> None:
+        """重新训练聚类中心并分配所有工具"""
+        names = list(embeddings)
+        vectors = normalize_rows(np.stack([embeddings[name] for name in names]))
+        nlist = self.nlist or int(np.sqrt(len(names)))
+        start = time.perf_counter()
+        self.centroids = train_centroids(vectors, nlist)
+        self.trained_size = len(names)
+        self._reset_lists()
+
+        assignments = np.argmax(vectors @ self.centroids.T, axis=1)
+        for list_id in range(len(self.centroids)):
+            members = np.flatnonzero(assignments == list_id)
+            self._list_names[list_id] = [names[i] for i in members]
+            self._list_vectors[list_id] = np.ascontiguousarray(vectors[members])
+            self._where.update((names[i], list_id) for i in members)
+        logger.info(
+            f"已训练工具近似检索索引: {len(names)} 个工具, {len(self.centroids)} 个聚类, "
+            f"耗时 {time.perf_counter() - start:.2f} 秒"
+        )
+
+    def _add(self, name: str, vector: np.ndarray, list_id: int) -> None:
+        self._list_names[list_id].append(name)
+        self._list_vectors[list_id] = np.vstack(
+            [self._list_vectors[list_id], normalize_rows(vector)[None, :]]
+        )
+        self._where[name] = list_id
+
+    def insert(self, name: str, vector: np.ndarray) -> None:
+        """把工具加入与其向量最接近的聚类"""
+        vector = normalize_rows(vector)
+        self._add(name, vector, int(np.argmax(self.centroids @ vector)))
+
+    def remove(self, name: str) -> None:
+        """从索引中删除工具，不存在时忽略"""
+        list_id = self._where.pop(name, None)
+        if list_id is None:
+            return
+        position = self._list_names[list_id].index(name)
+        del self._list_names[list_id][position]
+        self._list_vectors[list_id] = np.delete(
+            self._list_vectors[list_id], position, axis=0
+        )
+
+    def search(self, query: np.ndarray, top_k: int) -> Tuple[List[str], np.ndarray]:
+        """
+        在最接近查询的 nprobe 个聚类中检索，候选不足 top_k 时继续扫描后续聚类
+
+        Returns:
+            (工具名称, 相似度)，按相似度降序排列
+        """
+        if not len(self) or top_k <= 0:
+            return [], np.empty(0, dtype=np.float32)
+        query = normalize_rows(query)
+        order = np.argsort(self.centroids @ query)[::-1]
+        probe = list(order[: self.nprobe])
+        candidates = sum(len(self._list_names[i]) for i in probe)
+        for list_id in order[self.nprobe :]:
+            if candidates >= top_k:
+                break
+            probe.append(list_id)
+            candidates += len(self._list_names[list_id])
+
+        names = [name for i in probe for name in self._list_names[i]]
+        vectors = np.concatenate([self._list_vectors[i] for i in probe])
+        indices, scores = top_k_similar(vectors, query, top_k)
+        return [names[i] for i in indices], scores
+
+    def save(self) -> None:
+        """保存聚类中心和工具所属的聚类，先写临时文件再替换"""
+        if self.centroids is None:
+            return
+        meta = {
+            "model": self.model_name,
+            "nlist": self.nlist,
+            "trained_size": self.trained_size,
+        }
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(
+                    f,
+                    meta=np.array(json.dumps(meta)),
+                    centroids=self.centroids,
+                    names=np.array(list(self._where), dtype=str),
+                    lists=np.array(list(self._where.values()), dtype=np.int32),
+                )
+            tmp_path.replace(self.path)
+        except OSError as e:
+            logger.warning(f"保存工具近似检索索引失败: {e}")
+
+
+def benchmark(
+    tool_count: int = 20000,
+    dim: int = 384,
+    top_k: int = 5,
+    nprobe: int = 8,
+    queries: int = 200,
+    seed: int = 0,
+) -> Tuple[float, float, float]:
+    """
+    在带聚类结构的随机向量上比较精确检索和 IVF 检索
+
+    Returns:
+        (精确检索平均耗时, IVF 检索平均耗时, IVF 的 top_k 召回率)，耗时单位为秒
+    """
+    import tempfile
+
+    rng = np.random.default_rng(seed)
+    # 工具描述的向量通常按功能聚集，用高斯混合模拟
+    topics = normalize_rows(rng.standard_normal((200, dim), dtype=np.float32))
+    members = rng.integers(0, len(topics), tool_count)
+    vectors = normalize_rows(
+        topics[members]
+        + 0.08 * rng.standard_normal((tool_count, dim), dtype=np.float32)
+    )
+    embeddings = {f"tool_{i}": vector for i, vector in enumerate(vectors)}
+    query_vectors = topics[rng.integers(0, len(topics), queries)] + 0.08 * (
+        rng.standard_normal((queries, dim), dtype=np.float32)
+    )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = IVFIndex(Path(tmp_dir) / "index.npz", "benchmark", nprobe=nprobe)
+        index.sync(embeddings)
+
+    exact_results = []
+    start = time.perf_counter()
+    for query in query_vectors:
+        exact_results.append(top_k_similar(vectors, query, top_k)[0])
+    exact = (time.perf_counter() - start) / queries
+
+    ivf_results = []
+    start = time.perf_counter()
+    for query in query_vectors:
+        ivf_results.append(index.search(query, top_k)[0])
+    approximate = (time.perf_counter() - start) / queries
+
+    hits = sum(
+        len({f"tool_{i}" for i in expected} & set(found))
+        for expected, found in zip(exact_results, ivf_results)
+    )
+    return exact, approximate, hits / (queries * top_k)
+
+
+if __name__ == "__main__":
+    for tool_count in (2000, 10000, 50000):
+        exact, approximate, recall = benchmark(tool_count)
+        print(
+            f"{tool_count:>6} 个工具: 精确 {exact * 1e6:8.1f} µs/查询, "
+            f"IVF {approximate * 1e6:8.1f} µs/查询, 召回率 {recall:.3f}"
+        )
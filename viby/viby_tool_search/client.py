@@ -315,6 +315,37 @@ def search_similar_tools(query: str, top_k: int = 5) -> Dict[str, List]:
         return {}
 
 
+def embed_texts(texts: List[str]):
+    """
+    使用嵌入模型服务器为文本生成归一化的嵌入向量
+
+    Returns:
+        float32 的 numpy 数组，服务器未运行或请求失败时返回 None
+    """
+    if not is_server_running():
+        return None
+
+    try:
+        response = requests.post(
+            f"http://localhost:{DEFAULT_PORT}/embed",
+            json={"texts": texts},
+            timeout=300,
+        )
+        if response.status_code != 200:
+            logger.warning(
+                f"{get_text('TOOLS', 'call_server_failed', '调用嵌入模型服务失败')}: {response.status_code} {response.text}"
+            )
+            return None
+        import numpy as np
+
+        return np.asarray(response.json()["embeddings"], dtype=np.float32)
+    except Exception as e:
+        logger.warning(
+            f"{get_text('TOOLS', 'call_server_failed', '调用嵌入模型服务失败')}: {e}"
+        )
+        return None
+
+
 def update_tools() -> bool:
     """
     更新工具嵌入向量
@@ -4,11 +4,13 @@ Embedding生成和相似度搜索工具
 用于MCP工具检索系统的embedding相关功能
 """
 
+import hashlib
 import json
+import time
 import numpy as np
 from pathlib import Path
 from datetime import datetime
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterable, List, Any, Optional, Tuple
 import logging
 from dataclasses import dataclass
 
@@ -30,6 +32,48 @@ class Tool:
     annotations: Optional[Any] = None
 
 
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """
+    将向量按行做 L2 归一化
+
+    Returns:
+        连续存储的 float32 数组，零向量保持为零
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.ascontiguousarray(vectors / np.maximum(norms, np.finfo(np.float32).tiny))
+
+
+def top_k_similar(
+    matrix: np.ndarray, query: np.ndarray, top_k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    在行已归一化的矩阵中查找与查询最相似的 top_k 行
+
+    一次矩阵乘法得到全部余弦相似度，argpartition 选出前 top_k 个后只对这几个排序
+
+    Args:
+        matrix: 形状为 (n, dim) 且行已归一化的矩阵
+        query: 形状为 (dim,) 的查询向量，无需预先归一化
+        top_k: 返回数量
+
+    Returns:
+        (行索引, 相似度)，按相似度降序排列
+    """
+    count = matrix.shape[0]
+    top_k = min(max(int(top_k), 0), count)
+    if top_k == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+
+    scores = matrix @ normalize_rows(query)
+    if top_k < count:
+        indices = np.argpartition(scores, count - top_k)[count - top_k :]
+    else:
+        indices = np.arange(count)
+    indices = indices[np.argsort(scores[indices])[::-1]]
+    return indices, scores[indices]
+
+
 class EmbeddingManager:
     """工具embedding管理器，负责生成、存储和检索工具的embedding向量"""
 
@@ -40,6 +84,11 @@ class EmbeddingManager:
         self.model = None  # 延迟加载模型
         self.tool_embeddings: Dict[str, np.ndarray] = {}
         self.tool_info: Dict[str, Dict] = {}
+        # 检索用的行归一化矩阵及与行对应的工具名称，由 tool_embeddings 构建
+        self._matrix = np.empty((0, 0), dtype=np.float32)
+        self._names: List[str] = []
+        # 工具数量较多且启用时使用的近似最近邻索引，见 ann_index 模块
+        self.ann_index = None
 
         # 使用全局配置单例
         self.embedding_config = config.get_embedding_config()
@@ -56,6 +105,7 @@ class EmbeddingManager:
         self.embedding_file = self.cache_dir / "tool_embeddings.npz"
         self.tool_info_file = self.cache_dir / "tool_info.json"
         self.meta_file = self.cache_dir / "meta.json"
+        self.ann_index_file = self.cache_dir / "tool_ann_index.npz"
 
         # 尝试加载缓存的embeddings
         self._load_cached_embeddings()
@@ -96,6 +146,26 @@ class EmbeddingManager:
                 return False
         return True
 
+    def encode(self, texts: List[str]) -> Optional[np.ndarray]:
+        """
+        为一组文本生成归一化的嵌入向量
+
+        Returns:
+            形状为 (len(texts), dim) 的 float32 数组，模型不可用时返回 None
+        """
+        if not self._load_model():
+            return None
+        try:
+            embeddings = self.model.encode(
+                list(texts), convert_to_numpy=True, normalize_embeddings=True
+            )
+        except Exception as e:
+            logger.error(
+                f"{get_text('TOOLS', 'generate_embedding_failed', '生成嵌入向量失败')}: {e}"
+            )
+            return None
+        return np.asarray(embeddings, dtype=np.float32)
+
     def _load_cached_embeddings(self):
         """从缓存加载工具embeddings"""
         try:
@@ -119,6 +189,46 @@ class EmbeddingManager:
             # 重置状态，后续会重新生成
             self.tool_embeddings = {}
             self.tool_info = {}
+        self._build_matrix()
+        self._sync_ann_index()
+
+    def _build_matrix(self):
+        """根据 tool_embeddings 重建检索矩阵，tool_embeddings 变化后调用"""
+        self._names = list(self.tool_embeddings)
+        if self._names:
+            self._matrix = normalize_rows(
+                np.stack([self.tool_embeddings[name] for name in self._names])
+            )
+        else:
+            self._matrix = np.empty((0, 0), dtype=np.float32)
+
+    def _sync_ann_index(self, changed: Iterable[str] = ()):
+        """
+        按配置增量更新近似最近邻索引，工具数量低于阈值时不使用索引
+
+        Args:
+            changed: 名称不变但向量已变化的工具
+        """
+        options = self.embedding_config
+        if not options.get("ann_index", False) or len(self._names) < options.get(
+            "ann_min_tools", 5000
+        ):
+            self.ann_index = None
+            return
+
+        if self.ann_index is None:
+            from viby.viby_tool_search.ann_index import IVFIndex
+
+            self.ann_index = IVFIndex(
+                self.ann_index_file,
+                options.get("model_name", "paraphrase-multilingual-MiniLM-L12-v2"),
+                nlist=options.get("ann_nlist", 0),
+                nprobe=options.get("ann_nprobe", 8),
+            )
+        for name in changed:
+            self.ann_index.remove(name)
+        if self.ann_index.sync(self.tool_embeddings):
+            self.ann_index.save()
 
     def _save_embeddings_to_cache(self):
         """将embeddings保存到缓存"""
@@ -130,9 +240,10 @@ class EmbeddingManager:
             serializable_tool_info = {}
             for name, info in self.tool_info.items():
                 serializable_info = {}
-                # 只需保存文本描述和定义（标准MCP格式）
+                # 只需保存文本描述、定义（标准MCP格式）和文本哈希
                 serializable_info["text"] = info.get("text", "")
                 serializable_info["definition"] = info.get("definition", {})
+                serializable_info["hash"] = info.get("hash", "")
                 serializable_tool_info[name] = serializable_info
 
             # 记录即将保存的工具数量和名称
@@ -259,44 +370,74 @@ class EmbeddingManager:
             f"{get_text('TOOLS', 'prepare_update', '准备更新')} {len(processed_tools)} {get_text('TOOLS', 'tools_embedding', '个工具的嵌入')}"
         )
 
-        # 确保嵌入模型加载
-        if not self._load_model():
-            logger.error(
-                get_text("TOOLS", "embedding_model_load_failed", "嵌入模型加载失败")
-            )
-            return False
-
-        # 生成文本和嵌入
-        names, texts = (
-            zip(
-                *[
-                    (name, self._get_tool_description_text(name, definition))
-                    for name, definition in processed_tools.items()
-                ]
-            )
-            if processed_tools
-            else ([], [])
+        # 生成文本和内容哈希，哈希包含模型名称，模型变化时全部重新生成
+        model_name = self.embedding_config.get(
+            "model_name", "paraphrase-multilingual-MiniLM-L12-v2"
         )
-        try:
-            embeddings = self.model.encode(list(texts), convert_to_numpy=True)
-        except Exception as e:
-            logger.error(
-                f"{get_text('TOOLS', 'generate_embedding_failed', '生成嵌入向量失败')}: {e}"
+        texts = {
+            name: self._get_tool_description_text(name, definition)
+            for name, definition in processed_tools.items()
+        }
+        hashes = {
+            name: self._text_hash(model_name, text) for name, text in texts.items()
+        }
+
+        # 文本未变化的工具复用已有的嵌入，只为新增或变化的工具生成
+        embeddings = {
+            name: self.tool_embeddings[name]
+            for name in processed_tools
+            if name in self.tool_embeddings
+            and self.tool_info.get(name, {}).get("hash") == hashes[name]
+        }
+        to_encode = [name for name in processed_tools if name not in embeddings]
+        logger.info(
+            get_text("TOOLS", "embeddings_reused").format(
+                reused=len(embeddings), encoded=len(to_encode)
             )
-            return False
+        )
 
-        # 更新embeddings和info，忽略数量不匹配的情况
+        if to_encode:
+            # 确保嵌入模型加载
+            if not self._load_model():
+                logger.error(
+                    get_text("TOOLS", "embedding_model_load_failed", "嵌入模型加载失败")
+                )
+                return False
+            try:
+                encoded = self.model.encode(
+                    [texts[name] for name in to_encode], convert_to_numpy=True
+                )
+            except Exception as e:
+                logger.error(
+                    f"{get_text('TOOLS', 'generate_embedding_failed', '生成嵌入向量失败')}: {e}"
+                )
+                return False
+            # 忽略数量不匹配的情况
+            embeddings.update(zip(to_encode, encoded))
+
+        # 更新embeddings和info，保持工具的原有顺序，已移除的工具被丢弃
+        changed = [name for name in to_encode if name in self.tool_embeddings]
         self.tool_embeddings = {
-            n: embeddings[i] for i, n in enumerate(names) if i < len(embeddings)
+            name: embeddings[name] for name in processed_tools if name in embeddings
         }
         self.tool_info = {
-            n: {"definition": processed_tools[n], "text": texts[i]}
-            for i, n in enumerate(names)
-            if i < len(embeddings)
+            name: {
+                "definition": processed_tools[name],
+                "text": texts[name],
+                "hash": hashes[name],
+            }
+            for name in self.tool_embeddings
         }
+        self._build_matrix()
+        self._sync_ann_index(changed)
         self._save_embeddings_to_cache()
         return True
 
+    @staticmethod
+    def _text_hash(model_name: str, text: str) -> str:
+        """工具描述文本和模型名称的内容哈希，用于判断嵌入是否需要重新生成"""
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
     def search_similar_tools(self, query: str, top_k: int = 5) -> Dict[str, List[Tool]]:
         """
         搜索与查询最相关的工具
@@ -313,7 +454,7 @@ class EmbeddingManager:
             logger.error(get_text("TOOLS", "model_load_failed", "加载模型失败"))
             return {}
 
-        if not self.tool_embeddings:
+        if not self._names:
             logger.warning(
                 get_text(
                     "TOOLS",
@@ -332,22 +473,18 @@ class EmbeddingManager:
             )
             return {}
 
-        # 计算所有工具与查询的相似度
-        similarities = {}
-        for name, embedding in self.tool_embeddings.items():
-            # 计算余弦相似度
-            similarity = np.dot(query_embedding, embedding) / (
-                np.linalg.norm(query_embedding) * np.linalg.norm(embedding)
-            )
-            similarities[name] = float(similarity)
-
-        # 按相似度降序排序
-        sorted_tools = sorted(similarities.items(), key=lambda x: x[1], reverse=True)
+        if self.ann_index is not None:
+            # 工具较多时只扫描与查询最接近的几个聚类
+            names, scores = self.ann_index.search(query_embedding, top_k)
+        else:
+            # 一次矩阵乘法计算所有工具与查询的余弦相似度
+            indices, scores = top_k_similar(self._matrix, query_embedding, top_k)
+            names = [self._names[index] for index in indices]
 
         # 获取top_k个工具并按服务器名称分组
         result_dict = {}
 
-        for name, score in sorted_tools[:top_k]:
+        for name, score in zip(names, scores):
             # 从缓存的工具信息中获取定义
             if name not in self.tool_info:
                 logger.warning(
@@ -372,7 +509,43 @@ class EmbeddingManager:
             if server_name not in result_dict:
                 result_dict[server_name] = []
 
-            logger.info(f"相似度: {score}")
+            logger.info(f"相似度: {float(score)}")
             result_dict[server_name].append(tool)
 
         return result_dict
+
+
+def benchmark(
+    tool_count: int = 10000,
+    dim: int = 384,
+    top_k: int = 5,
+    iterations: int = 200,
+    seed: int = 0,
+) -> float:
+    """
+    测量在随机工具向量上检索 top_k 的平均耗时，不包含查询编码
+
+    Args:
+        tool_count: 模拟的工具数量
+        dim: 向量维度，默认与 paraphrase-multilingual-MiniLM-L12-v2 一致
+        top_k: 每次返回的数量
+        iterations: 查询次数
+        seed: 随机数种子
+
+    Returns:
+        平均每次检索耗时（秒）
+    """
+    rng = np.random.default_rng(seed)
+    matrix = normalize_rows(rng.standard_normal((tool_count, dim), dtype=np.float32))
+    queries = rng.standard_normal((iterations, dim), dtype=np.float32)
+
+    start = time.perf_counter()
+    for query in queries:
+        top_k_similar(matrix, query, top_k)
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == "__main__":
+    for tool_count in (100, 1000, 10000, 50000):
+        per_query = benchmark(tool_count)
+        print(f"{tool_count:>6} 个工具: {per_query * 1e6:8.1f} µs/查询")
@@ -11,6 +11,7 @@ import logging
 import time
 import sys
 import uvicorn
+from typing import List
 from fastapi import FastAPI, BackgroundTasks, HTTPException
 from pydantic import BaseModel
 from datetime import datetime
@@ -70,6 +71,10 @@ class SearchRequest(BaseModel):
     top_k: int = 5
 
 
+class EmbedRequest(BaseModel):
+    texts: List[str]
+
+
 def run_server():
     """运行FastAPI服务器"""
     # 配置日志
@@ -136,6 +141,20 @@ def run_server():
             logger.error(f"{get_text('TOOLS', 'search_failed', '搜索失败')}: {e}")
             raise HTTPException(status_code=500, detail=str(e))
 
+    # 生成嵌入向量端点，供会话历史语义搜索等功能复用已加载的模型
+    @app.post("/embed")
+    def embed(request: EmbedRequest):
+        embeddings = embedding_manager.encode(request.texts)
+        if embeddings is None:
+            raise HTTPException(
+                status_code=500,
+                detail=get_text("TOOLS", "model_load_failed", "加载模型失败"),
+            )
+        return {
+            "model": embedding_manager.embedding_config.get("model_name"),
+            "embeddings": embeddings.tolist(),
+        }
+
     # 更新工具端点
     @app.post("/update")
     async def update_tools():